@@ -5,7 +5,6 @@ import re
 from dateutil.parser import parse
 from .. import util
 from .. import geocoding_util
-import rtree
 import json
 import os
 import argparse
@@ -91,9 +90,7 @@ def snap_inter_and_non_inter(summary):
         os.path.join(PROCESSED_DATA_FP, 'maps/inters_segments.geojson'))
 
     # Create spatial index for quick lookup
-    segments_index = rtree.index.Index()
-    for idx, element in enumerate(inter):
-        segments_index.insert(idx, element.geometry.bounds)
+    inter, segments_index = util.index_segments(inter, segment=True)
     print("Snapping tmcs to intersections")
 
     # Turn the summary into the format that works for reprojection
@@ -489,7 +486,8 @@ def parse_conflicts():
     print("parsed " + str(count) + " TMC files")
     return summary
 
-if __name__ == '__main__':
+def main(args=None):
+    global RAW_DATA_FP, PROCESSED_DATA_FP, STANDARDIZED_DATA_FP, ATR_FP, TMC_FP
 
     parser = argparse.ArgumentParser()
 
@@ -500,7 +498,7 @@ if __name__ == '__main__':
     parser.add_argument('--forceupdate', action='store_true',
                         help='Whether force update the maps')
 
-    args = parser.parse_args()
+    args = parser.parse_args(args)
     if args.datadir:
         RAW_DATA_FP = os.path.join(args.datadir, 'raw')
         PROCESSED_DATA_FP = os.path.join(args.datadir, 'processed')
@@ -510,7 +508,7 @@ if __name__ == '__main__':
 
     if not os.path.exists(TMC_FP):
         print("No TMC directory, skipping...")
-        sys.exit()
+        return
     if not os.path.exists(os.path.join(STANDARDIZED_DATA_FP, 'volume.json')):
         # At the moment this is true, but it probably can be skipped if
         # not available
@@ -527,8 +525,8 @@ if __name__ == '__main__':
         summary = parse_conflicts()
         address_records = snap_inter_and_non_inter(summary)
 
-        items = json.load(
-            open(os.path.join(PROCESSED_DATA_FP, 'crash_joined.json')))
+        items = util.read_json_records(
+            os.path.join(PROCESSED_DATA_FP, 'crash_joined.json'))
 
         all_crashes, crashes_by_location = util.group_json_by_location(items)
 
@@ -547,7 +545,5 @@ if __name__ == '__main__':
         print("Read in " + str(len(address_records)) + " records")
 
 
-
-
-
-
+if __name__ == '__main__':
+    main()
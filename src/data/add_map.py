@@ -1,8 +1,8 @@
 import argparse
+import shapely
+from . import geometry
 from . import util
 from shapely.ops import unary_union
-from shapely.geometry import Point
-import rtree
 import os
 from .segment import Segment
 
@@ -15,6 +15,14 @@ PROCESSED_DATA_FP = None
 MAP_FP = None
 
 
+def _all_within(line, polygon):
+    """
+    Check whether all of a line's coordinates are within a polygon
+    """
+    return bool(shapely.within(shapely.points(
+        shapely.get_coordinates(line)), polygon).all())
+
+
 def add_match_features(line, features):
     """
     Add the properties from the features dict to the line
@@ -55,6 +63,7 @@ def get_mapping(lines, features):
     new_id = 0
     while buff <= 20:
         print("Looking at buffer " + str(buff))
+        line_buffers = geometry.buffer([x['line'] for x in lines], buff)
         for i in range(len(lines)):
             util.track(i, 1000, len(lines))
             if 'matches' in list(lines[i].keys()):
@@ -66,11 +75,7 @@ def get_mapping(lines, features):
                 if 'id' not in list(lines[i]['candidates'][j][1].keys()):
                     lines[i]['candidates'][j][1]['id'] = new_id
                     new_id += 1
-                match = True
-
-                for coord in candidate[0].coords:
-                    if not Point(coord).within(lines[i]['line'].buffer(buff)):
-                        match = False
+                match = _all_within(candidate[0], line_buffers[i])
                 if match:
                     matched_candidates.append((candidate, buff))
 
@@ -89,15 +94,14 @@ def get_mapping(lines, features):
         matched_candidates = []
         if 'matches' in list(lines[i].keys()):
             continue
+        candidate_buffers = geometry.buffer(
+            [x[0] for x in lines[i]['candidates']], 20)
         for j, candidate in enumerate(lines[i]['candidates']):
             if 'id' not in list(lines[i]['candidates'][j][1].keys()):
                 lines[i]['candidates'][j][1]['id'] = new_id
                 new_id += 1
 
-            match = True
-            for coord in lines[i]['line'].coords:
-                if not Point(coord).within(candidate[0].buffer(20)):
-                    match = False
+            match = _all_within(lines[i]['line'], candidate_buffers[j])
             if match:
                 matched_candidates.append((candidate, 20))
                 if lines[i]['candidates'][j][1]['id'] not in list(buff_match.keys()):
@@ -157,10 +161,11 @@ def get_int_mapping(lines, buffered, buffered_index):
     print("Getting intersection mappings")
 
     line_results = []
+    line_buffers = geometry.buffer([x.geometry for x in lines], 10)
     # Go through each line from the osm map
     for i, line in enumerate(lines):
         util.track(i, 1000, len(lines))
-        line_buffer = line.geometry.buffer(10)
+        line_buffer = line_buffers[i]
 
         best_match = {}
         best_overlap = 0
@@ -261,7 +266,9 @@ def add_int_features(inters, int_lines, featlist):
     return indexed_inters.values()
 
 
-if __name__ == '__main__':
+def main(args=None):
+    global PROCESSED_DATA_FP, MAP_FP
+
     # Read osm map file
     parser = argparse.ArgumentParser()
 
@@ -276,7 +283,7 @@ if __name__ == '__main__':
         'AADT', 'SPEEDLIMIT', 'Struct_Cnd', 'Surface_Tp', 'F_F_Class'],
         help="List of segment features to include")
 
-    args = parser.parse_args()
+    args = parser.parse_args(args)
     
     feats = args.features
 
@@ -294,15 +301,12 @@ if __name__ == '__main__':
 
     new_map_non_inter = util.read_geojson(non_inters_new_file)
 
-    # Index for the new map
-    new_buffered = []
-    new_index = rtree.index.Index()
-
     # Buffer all the new lines
-    for idx, new_line in enumerate(new_map_non_inter):
-        b = new_line.geometry.buffer(20)
-        new_buffered.append((b, new_line.geometry, new_line.properties))
-        new_index.insert(idx, b.bounds)
+    new_buffered = list(zip(
+        geometry.buffer([x.geometry for x in new_map_non_inter], 20),
+        [x.geometry for x in new_map_non_inter],
+        [x.properties for x in new_map_non_inter]))
+    new_index = util.bulk_index([x[0].bounds for x in new_buffered])
 
     non_ints_with_candidates = get_candidates(
         new_buffered, new_index, osm_map_non_inter)
@@ -319,15 +323,12 @@ if __name__ == '__main__':
     new_map_inter = util.read_geojson(os.path.join(
         MAP_FP, args.map2dir, 'inters_segments.geojson'))
 
-    orig_buffered_inter = []
-    orig_index_inter = rtree.index.Index()
-
-    new_buffered_inter = []
-    new_index_inter = rtree.index.Index()
-    for idx, new_line in enumerate(new_map_inter):
-        b = new_line.geometry.buffer(10)
-        new_buffered_inter.append((b, new_line.geometry, new_line.properties))
-        new_index_inter.insert(idx, b.bounds)
+    new_buffered_inter = list(zip(
+        geometry.buffer([x.geometry for x in new_map_inter], 10),
+        [x.geometry for x in new_map_inter],
+        [x.properties for x in new_map_inter]))
+    new_index_inter = util.bulk_index(
+        [x[0].bounds for x in new_buffered_inter])
 
     int_results = get_int_mapping(
         osm_map_inter, new_buffered_inter, new_index_inter)
@@ -340,6 +341,5 @@ if __name__ == '__main__':
     util.write_segments(non_inters, inters, MAP_FP)
 
 
-    
-
-
+if __name__ == '__main__':
+    main()
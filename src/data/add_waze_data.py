@@ -1,4 +1,6 @@
 import argparse
+import numpy as np
+from . import geometry
 from . import util
 import os
 import json
@@ -187,10 +189,8 @@ def add_jams(items, road_segments, inters, num_snapshots):
     roads, roads_index = util.index_segments(
         road_segments, geojson=True, segment=True)
 
-    road_buffers = []
-
-    for road in roads:
-        road_buffers.append(road.geometry.buffer(3))
+    road_buffers = geometry.buffer([x.geometry for x in roads], 3)
+    road_lengths = geometry.lengths([x.geometry for x in roads])
 
     print("read in {} road segments".format(len(roads)))
 
@@ -201,24 +201,32 @@ def add_jams(items, road_segments, inters, num_snapshots):
         count += 1
 
         if item['properties']['eventType'] == 'jam':
-            for idx in roads_index.intersection(item['geometry'].bounds):
-                segment = roads[idx]
-                buff = road_buffers[idx]
-
-                # But if the roads share a name,
-                # increase buffer size, in case of a median segment
-                # Waze does not appear to specify which direction
-                if 'street' in item['properties'] and segment.properties['name'] and \
-                   item['properties']['street'].split()[0] == segment.properties['name'].split()[0]:
-                    buff = segment.geometry.buffer(10)
-                overlap = buff.intersection(item['geometry'])
-
-                if not overlap.length or \
-                   (overlap.length < 20 and segment.geometry.length > 20):
+            candidates = np.array(list(roads_index.intersection(
+                item['geometry'].bounds)), dtype=np.int64)
+            buffs = road_buffers[candidates]
+
+            # But if the roads share a name,
+            # increase buffer size, in case of a median segment
+            # Waze does not appear to specify which direction
+            same_name = [
+                i for i, idx in enumerate(candidates)
+                if 'street' in item['properties']
+                and roads[idx].properties['name']
+                and item['properties']['street'].split()[0]
+                == roads[idx].properties['name'].split()[0]]
+            if same_name:
+                buffs[same_name] = geometry.buffer(
+                    [roads[candidates[i]].geometry for i in same_name], 10)
+            overlaps = geometry.lengths(
+                geometry.clip(buffs, item['geometry']))
+
+            for idx, overlap in zip(candidates, overlaps):
+                if not overlap or \
+                   (overlap < 20 and road_lengths[idx] > 20):
                     # Skip segments with no overlap
                     # or very short overlaps
                     continue
-                waze_info[segment.properties['segment_id']].append(item)
+                waze_info[roads[idx].properties['segment_id']].append(item)
     # Add waze features
     roads_with_jams = []
 
@@ -260,7 +268,7 @@ def make_map(filename, datadir):
         geojson.dump(geojson.FeatureCollection(geojson_items), outfile)
 
 
-if __name__ == '__main__':
+def main(args=None):
     parser = argparse.ArgumentParser()
 
     parser.add_argument("-d", "--datadir", type=str,
@@ -268,8 +276,12 @@ if __name__ == '__main__':
     parser.add_argument('--forceupdate', action='store_true',
                         help='Whether to force update of the waze data')
 
-    args = parser.parse_args()
+    args = parser.parse_args(args)
 
     infile = os.path.join(args.datadir, 'standardized', 'waze.json')
 #    make_map(infile, os.path.join(args.datadir, 'processed', 'maps'))
     map_segments(args.datadir, infile, forceupdate=args.forceupdate)
+
+
+if __name__ == '__main__':
+    main()
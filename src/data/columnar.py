@@ -0,0 +1,271 @@
+"""
+Columnar storage for the intermediate files passed between stages.
+
+By default, segments are passed between stages as geojson and records
+(e.g. crash_joined.json) as json. Setting intermediate_format: parquet in
+the city's config file stores them as parquet instead: one typed column
+per property, and for segments, a WKB geometry column with geoparquet
+metadata, so the files can also be opened with geopandas.read_parquet.
+Geometries are stored in 3857 projection, the projection the pipeline
+works in, so they don't need to be reprojected when read or written.
+
+Only one format of a file is kept on disk at a time; readers use whichever
+is there. Parquet needs pyarrow, which is optional
+"""
+import json
+import os
+import numpy as np
+import pyproj
+import shapely
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+INTERMEDIATE_FORMATS = ['geojson', 'parquet']
+
+# Column names used for geometries, and for the properties
+# that a row doesn't have at all (as opposed to having set to null)
+GEOMETRY_COLUMN = 'geometry'
+ABSENT_COLUMN = '_absent'
+
+# Key in the parquet file's metadata listing which columns are
+# json-encoded, because their values are lists, dicts, or of mixed types
+METADATA_KEY = b'crash_model'
+
+_CRS = pyproj.CRS('EPSG:3857')
+
+
+def intermediate_file(filename, fmt=None):
+    """
+    Get the path an intermediate file is stored at in a given format
+    Args:
+        filename - the file's geojson or json path,
+            e.g. processed/crash_joined.json
+        fmt - 'geojson' or 'parquet'. If not given, the format the
+            file is stored in now, or geojson if it doesn't exist yet
+    Returns:
+        path
+    """
+    parquet_file = os.path.splitext(filename)[0] + '.parquet'
+    if fmt is None:
+        fmt = 'parquet' if os.path.exists(parquet_file) else 'geojson'
+    if fmt not in INTERMEDIATE_FORMATS:
+        raise ValueError("Unknown intermediate format {}".format(fmt))
+    return parquet_file if fmt == 'parquet' else filename
+
+
+def stored_format(filename):
+    """
+    Get the format an intermediate file is stored in
+    Args:
+        filename - the file's geojson or json path
+    Returns:
+        'geojson' or 'parquet'
+    """
+    if intermediate_file(filename).endswith('.parquet'):
+        return 'parquet'
+    return 'geojson'
+
+
+def output_file(filename, fmt=None):
+    """
+    Get the path to write an intermediate file to, removing
+    any copy of it in another format so it can't be read by mistake
+    Args:
+        filename - the file's geojson or json path
+        fmt - format to write, defaults to the format it's stored in now
+    Returns:
+        path
+    """
+    path = intermediate_file(filename, fmt)
+    for other in INTERMEDIATE_FORMATS:
+        other_path = intermediate_file(filename, other)
+        if other_path != path and os.path.exists(other_path):
+            os.remove(other_path)
+    return path
+
+
+def _kind(value):
+    if isinstance(value, (bool, np.bool_)):
+        return 'bool'
+    if isinstance(value, (int, np.integer)):
+        return 'int'
+    if isinstance(value, (float, np.floating)):
+        return 'float'
+    if isinstance(value, str):
+        return 'str'
+    return None
+
+
+def _column_type(values):
+    """
+    Get the arrow type for a column's values, or None if they
+    can't all be stored as one arrow type and need to be json-encoded
+    """
+    kinds = set(_kind(x) for x in values if x is not None)
+    if not kinds:
+        return pyarrow.null()
+    if len(kinds) > 1:
+        return None
+    kind = kinds.pop()
+    if kind == 'int' and not all(
+            -2 ** 63 <= x < 2 ** 63 for x in values if x is not None):
+        return None
+    return {
+        'bool': pyarrow.bool_(),
+        'int': pyarrow.int64(),
+        'float': pyarrow.float64(),
+        'str': pyarrow.string(),
+    }.get(kind)
+
+
+def _to_json(value):
+    # numpy scalars aren't json serializable
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError("{} is not json serializable".format(type(value)))
+
+
+def write_table(filename, properties, geometries=None):
+    """
+    Write a list of property dicts, and optionally their geometries,
+    to a parquet file
+    Args:
+        filename
+        properties - list of dicts
+        geometries - list of shapely geometries in 3857 projection
+    """
+    if pyarrow is None:
+        raise SystemExit(
+            "pyarrow is needed to write {}, install it or set ".format(
+                filename) + "intermediate_format to geojson")
+
+    keys = []
+    seen = set()
+    for item in properties:
+        for key in item:
+            if key not in seen:
+                seen.add(key)
+                keys.append(key)
+    if GEOMETRY_COLUMN in seen or ABSENT_COLUMN in seen:
+        raise ValueError("Properties can't be named {} or {}".format(
+            GEOMETRY_COLUMN, ABSENT_COLUMN))
+
+    columns = {}
+    json_columns = []
+    for key in keys:
+        values = [x.get(key) for x in properties]
+        column_type = _column_type(values)
+        if column_type is None:
+            json_columns.append(key)
+            values = [json.dumps(x, default=_to_json) if x is not None
+                      else None for x in values]
+            column_type = pyarrow.string()
+        columns[key] = pyarrow.array(values, type=column_type)
+
+    absent = [[x for x in keys if x not in item] for item in properties]
+    # Also written if there's nothing else, so the number of rows is kept
+    if any(absent) or not columns and geometries is None:
+        columns[ABSENT_COLUMN] = pyarrow.array(
+            absent, type=pyarrow.list_(pyarrow.string()))
+
+    metadata = {METADATA_KEY: json.dumps({
+        'columns': keys,
+        'json_columns': json_columns,
+    }).encode()}
+
+    if geometries is not None:
+        columns[GEOMETRY_COLUMN] = pyarrow.array(
+            shapely.to_wkb(np.array(geometries, dtype=object)),
+            type=pyarrow.binary())
+        metadata[b'geo'] = json.dumps({
+            'version': '1.0.0',
+            'primary_column': GEOMETRY_COLUMN,
+            'columns': {GEOMETRY_COLUMN: {
+                'encoding': 'WKB',
+                'geometry_types': sorted(
+                    set(x.geom_type for x in geometries)),
+                'crs': _CRS.to_json_dict(),
+            }},
+        }).encode()
+
+    table = pyarrow.table(columns).replace_schema_metadata(metadata)
+    pyarrow.parquet.write_table(table, filename)
+
+
+def _read_rows(batch, keys, json_columns):
+    """
+    Turn a table or record batch written by write_table
+    into a list of property dicts
+    """
+    columns = []
+    for key in keys:
+        values = batch.column(key).to_pylist()
+        if key in json_columns:
+            values = [json.loads(x) if x is not None else None
+                      for x in values]
+        columns.append(values)
+
+    properties = [dict(zip(keys, row)) for row in zip(*columns)] \
+        if keys else [{} for _ in range(batch.num_rows)]
+    if ABSENT_COLUMN in batch.schema.names:
+        for item, absent in zip(
+                properties, batch.column(ABSENT_COLUMN).to_pylist()):
+            for key in absent:
+                del item[key]
+    return properties
+
+
+def _metadata(schema):
+    metadata = json.loads(schema.metadata[METADATA_KEY])
+    return metadata['columns'], set(metadata['json_columns'])
+
+
+def read_table(filename):
+    """
+    Read a parquet file written by write_table
+    Args:
+        filename
+    Returns:
+        list of property dicts, and list of shapely geometries
+        (in 3857 projection), or None if the file has no geometries
+    """
+    if pyarrow is None:
+        raise SystemExit(
+            "pyarrow is needed to read {}".format(filename))
+
+    table = pyarrow.parquet.read_table(filename)
+    properties = _read_rows(table, *_metadata(table.schema))
+
+    geometries = None
+    if GEOMETRY_COLUMN in table.column_names:
+        geometries = list(shapely.from_wkb(
+            np.array(table.column(GEOMETRY_COLUMN).to_pylist(),
+                     dtype=object)))
+    return properties, geometries
+
+
+def iter_table(filename, batch_size=10000):
+    """
+    Read the properties in a parquet file written by write_table
+    a batch of rows at a time, so the whole file isn't held in memory
+    Args:
+        filename
+        batch_size - number of rows to read at once
+    Yields:
+        property dicts
+    """
+    if pyarrow is None:
+        raise SystemExit(
+            "pyarrow is needed to read {}".format(filename))
+
+    parquet_file = pyarrow.parquet.ParquetFile(filename)
+    keys, json_columns = _metadata(parquet_file.schema_arrow)
+    columns = [x for x in parquet_file.schema_arrow.names
+               if x != GEOMETRY_COLUMN]
+    for batch in parquet_file.iter_batches(
+            batch_size=batch_size, columns=columns):
+        for item in _read_rows(batch, keys, json_columns):
+            yield item
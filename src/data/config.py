@@ -1,3 +1,4 @@
+import importlib.util
 import sys
 import pytz
 import yaml
@@ -44,6 +45,15 @@ class Configuration(object):
                or config['map_geography'] != 'shapefile':
                 sys.exit('If boundary_shapefile is set, map_geography must be shapefile')
 
+        # Open street map extract in raw/maps to read the roads from,
+        # instead of downloading them, see data.osm_extract
+        self.osm_extract = config.get('osm_extract')
+
+        # Date of the open street map data to download, so the maps are
+        # the same whenever they're made, see data.graph_cache
+        self.osm_date = str(config['osm_date']) \
+            if config.get('osm_date') else None
+
         self.default_features, self.categorical_features, \
             self.continuous_features = self.get_feature_list(config)
 
@@ -71,6 +81,20 @@ class Configuration(object):
         else:
             self.tmc_cols = None
 
+        # How intermediate files are stored between stages, see data.columnar
+        self.intermediate_format = config.get('intermediate_format') \
+            or 'geojson'
+        if self.intermediate_format not in ['geojson', 'parquet']:
+            sys.exit('intermediate_format must be geojson or parquet')
+        if self.intermediate_format == 'parquet' \
+           and importlib.util.find_spec('pyarrow') is None:
+            sys.exit('pyarrow is required for intermediate_format parquet')
+
+        # How intersections are found, see data.create_segments
+        self.segmentation = config.get('segmentation') or 'buffer'
+        if self.segmentation not in ['buffer', 'topology']:
+            sys.exit('segmentation must be buffer or topology')
+
         self.features = self.default_features + self.categorical_features \
             + self.continuous_features
 
@@ -5,13 +5,21 @@
 # Draws on: http://bit.ly/2m7469y
 # Developed by: bpben
 
-import rtree
-import json
+import concurrent.futures
 import copy
+import heapq
+import multiprocessing
+import numpy as np
+import pandas as pd
+import shapely
+import shapely.ops
 from shapely.ops import unary_union
 from collections import defaultdict
+from . import geometry
 from . import util
+from .stages import report_count
 import argparse
+import json
 import os
 import re
 from shapely.geometry import MultiLineString, LineString
@@ -29,6 +37,17 @@ MAP_FP = os.path.join(BASE_DIR, 'data/processed/maps')
 PROCESSED_DATA_FP = os.path.join(BASE_DIR, 'data/processed')
 DATA_FP = None
 
+# Ways of finding intersections, see segment_roads
+SEGMENTATIONS = ['buffer', 'topology']
+
+# Width of the square tiles, in meters, that intersection buffers and
+# roads are split into so they can be processed on several processes
+TILE_SIZE = 2000
+
+# Data that the processes working on tiles share. It's set before
+# they're forked, so they don't each have to be sent a copy
+_shared = {}
+
 
 def get_intersection_buffers(intersections, intersection_buffer_units,
                              debug=False):
@@ -43,8 +62,8 @@ def get_intersection_buffers(intersections, intersection_buffer_units,
         these are circles, or groups of overlapping circles
     """
 
-    buffered_intersections = [intersection['geometry'].buffer(
-        intersection_buffer_units) for intersection in intersections]
+    buffered_intersections = geometry.buffer(
+        [x['geometry'] for x in intersections], intersection_buffer_units)
 
     buffered_intersections = unary_union(buffered_intersections)
     if debug:
@@ -56,9 +75,8 @@ def get_intersection_buffers(intersections, intersection_buffer_units,
     results = []
 
     # Index the intersection points for fast lookup
-    inter_index = rtree.index.Index()
-    for idx, inter_point in enumerate(intersections):
-        inter_index.insert(idx, inter_point['geometry'].bounds)
+    inter_index = util.bulk_index(
+        [x['geometry'].bounds for x in intersections])
 
     # Get the points that overlap with the buffers
     for buff in buffered_intersections.geoms:
@@ -85,57 +103,65 @@ def get_connections(points, segments):
         segments - a list of segment objects
     Returns:
         A list of tuples for each intersection.
-        Each tuple contains a set of segment objects
-        and the buffer of the unary_union of the segment objects
+        Each tuple contains a list of segment objects, without duplicates,
+        in the order they were given, and the buffer of the unary_union of the segment objects
         with a little bit of padding, because of a slight precision error
         in shapely operations
     """
-    # Create a dict with each intersection point's coords as key
-    # The values are the point itself and an empty list that will
-    # store all the linestrings with a connection to the point
+    # The lines within a tiny distance of each intersection point, and
+    # of each other line, and which of all of them (lines first, then
+    # points) intersect each other. Found with a spatial index, rather
+    # than comparing every pair
+    lines = [x.geometry for x in segments]
+    point_shapes = [p.point for p in points]
+    near_point = _adjacent(point_shapes, lines, distance=.0001)
+    near_line = _adjacent(lines, lines, distance=.0001)
+    touching = _adjacent(lines + point_shapes, lines + point_shapes)
+
+    # Each intersection point expands to include all lines near it,
+    # and then the lines near those lines, each line only being
+    # added if it's near the point or a line added before it.
+    # Its members are the point, then the lines, by position
     inters = []
-
-    for p in points:
-        inters.append([p.point, []])
-
-    # Get a starting list of all lines that touch any of the
-    # intersection points
-    for line in segments:
-        for i, (curr_shape, _) in enumerate(inters):
-            if line.geometry.distance(curr_shape) < .0001:
-                inters[i][1].append(line)
-                # point expands, includes all geometry of near lines
-                inters[i][0] = unary_union([inters[i][0], line.geometry])
-
-    # Merge connected components
+    owners = defaultdict(list)
+    for i in range(len(points)):
+        members = [len(lines) + i]
+        candidates = list(near_point[i])
+        heapq.heapify(candidates)
+        last = -1
+        while candidates:
+            j = heapq.heappop(candidates)
+            if j <= last:
+                continue
+            last = j
+            members.append(j)
+            for k in near_line[j]:
+                if k > j:
+                    heapq.heappush(candidates, k)
+        for member in members:
+            owners[member].append(i)
+        inters.append(members)
+
+    # Merge each expanded point with the points after it that intersect
+    # it, in order, skipping points that have already been merged
     resulting_inters = []
-    connected_lines = []
-    while inters:
-        curr = inters.pop(0)
+    merged = set()
+    for i, members in enumerate(inters):
+        if i in merged:
+            continue
         # TODO: this ignores any points without connected segments
         # we may not want to do this - but it does seem to work for Boston, at least
-        if len(curr[1]) == 0:
+        if len(members) == 1:
             continue
-        if inters:
-            # get the polygon buffer of the points if they intersect current
-            connected = [x[1] for x in inters if x[0].intersects(
-                    curr[0]
-            )]
-
-            # if there are points intersecting current
-            if connected:
-                connected_lines = set(
-                    curr[1] + [x for y in connected for x in y]
-                )
-            else:
-            # otherwise, just take the current polygon
-                connected_lines = set(curr[1])
-       # if no other intersections, just take the current polygon
-        else:
-            connected_lines = set(curr[1])
-        # remove from iteration if it intersects current
-        inters = [x for x in inters if not x[0].intersects(curr[0])]
-        
+        connected = sorted(set(
+            j for member in members for other in touching[member]
+            for j in owners[other]
+            if j > i and j not in merged))
+        connected_lines = [segments[x] for x in sorted(set(
+            members[1:] + [x for j in connected for x in inters[j][1:]]))]
+        merged.update(connected)
+
+        # The geometry is only made once, for the merged intersection
         resulting_inters.append((connected_lines, unary_union(
             [x.geometry for x in connected_lines]).buffer(.001)
         ))
@@ -143,12 +169,47 @@ def get_connections(points, segments):
     return resulting_inters
 
 
-def find_non_ints(roads, int_buffers):
+def _adjacent(geometries, others, distance=None):
+    """
+    Find which of the other geometries each geometry intersects,
+    or comes within a distance of, using a spatial index of the others
+    Args:
+        geometries - list of shapely geometries
+        others - list of shapely geometries
+        distance - if given, the distance (exclusive) instead
+    Returns:
+        list of lists of positions in others, one for each geometry
+    """
+    adjacent = [[] for _ in geometries]
+    if not geometries or not others:
+        return adjacent
+    tree = shapely.STRtree(others)
+    if distance is None:
+        ids, other_ids = tree.query(geometries, predicate='intersects')
+    else:
+        bounds = shapely.bounds(geometries)
+        ids, other_ids = tree.query(shapely.box(
+            bounds[:, 0] - distance, bounds[:, 1] - distance,
+            bounds[:, 2] + distance, bounds[:, 3] + distance))
+        near = shapely.distance(
+            np.array(geometries, dtype=object)[ids],
+            np.array(others, dtype=object)[other_ids]) < distance
+        ids, other_ids = ids[near], other_ids[near]
+    for i, j in zip(ids.tolist(), other_ids.tolist()):
+        adjacent[i].append(j)
+    return adjacent
+
+
+def find_non_ints(roads, int_buffers, workers=1):
     """
     Find the segments that aren't intersections
     Args:
         roads - a list of tuples of shapely shape and dict of segment info
         int_buffers - a list of IntersectionBuffer objects
+        workers - number of processes to use. The intersection buffers
+            and roads are split into tiles, which are processed separately
+            and put back together in order, so the results are the same
+            however many processes are used
     Returns:
         tuple consisting of:
             non_int_lines - list in same format as input roads, just a subset
@@ -164,62 +225,75 @@ def find_non_ints(roads, int_buffers):
     # Create index for quick lookup
     print("creating rindex")
 
-    road_lines_index = rtree.index.Index()
-    buffered_lines = []
-    for idx, road in enumerate(roads):
-        b = road.geometry.buffer(20)
-        buffered_lines.append((b, road))
-        road_lines_index.insert(idx, b.bounds)
+    road_lines_index = util.bulk_index(geometry.bounds(geometry.buffer(
+        [x.geometry for x in roads], 20)))
+
+    print("Generating intersection segments")
+    _shared.update(roads=roads, road_lines_index=road_lines_index,
+                   int_buffers=int_buffers)
+    connections = _map_tiles(_connect_tile, _tiles(
+        range(len(int_buffers)), [x.buffer for x in int_buffers]), workers)
+    connections = [connections[i] for i in range(len(int_buffers))]
+
+    inter_segments, connected_segment_ids = _make_intersections(roads, [
+        (int_buffer.points, [lines for lines, _ in int_segments])
+        for int_buffer, (_, int_segments) in zip(int_buffers, connections)])
+
+    # Each road overlapping an intersection buffer, and the buffers of the
+    # intersections found in it. The roads that don't overlap any don't
+    # need to be split into separate intersection and non intersection
+    # segments
+    road_int_buffers = defaultdict(list)
+    for matched, int_segments in connections:
+        for r in matched:
+            road_int_buffers[r] += [buffered for _, buffered in int_segments]
+
+    # The part of each road outside the intersections it overlaps
+    overlapping = sorted(road_int_buffers)
+    _shared['road_int_buffers'] = road_int_buffers
+    differences = _map_tiles(_difference_tile, _tiles(
+        overlapping, [roads[i].geometry for i in overlapping]), workers)
+    _shared.clear()
+
+    non_int_lines = _make_non_intersections(
+        roads, differences, inter_segments, connected_segment_ids)
+    return non_int_lines, inter_segments
 
+
+def _make_intersections(roads, connections):
+    """
+    Make the intersection segments, numbering them in order
+    Args:
+        roads - list of road segments
+        connections - list with, for each intersection buffer (or group
+            of intersection nodes), the intersection points in it and a list
+            of the intersections found there. Each intersection is a list
+            of its lines, as tuples of the road's position and the line
+    Returns:
+        list of Intersections, and dict of the ids of the intersections
+        connected to each road, by its orig_id
+    """
     inter_segments = []
-    roads_with_int_segments = {}
     count = 0
-    print("Generating intersection segments")
     connected_segment_ids = defaultdict(list)
 
     # Go through each intersection buffer object
-    for i, int_buffer in enumerate(int_buffers):
-        util.track(i, 1000, len(int_buffers))
-        match_segments = []
-        matched_roads = []
-
-        # Add the portion of each road that intersects intersection buffer
-        # to match_segments. These are possible connections
-        # If the road intersects, add that to matched_roads
-        for idx in road_lines_index.intersection(int_buffer.buffer.bounds):
-            road = roads[idx]
-            if road.geometry.intersects(int_buffer.buffer):
-                match_segments.append(Segment(road.geometry.intersection(
-                    int_buffer.buffer), road.properties))
-                matched_roads.append(road)
-
-        # Get the connections that touch a point in the intersection buffer
-        int_segments = get_connections(int_buffer.points, match_segments)
-
-        # Each road_with_int is a road segment and a list of lists of segments
-        # representing the intersections associated with that road
-        # We store these, because the roads that do not have any intersections
-        # associated with them don't need to be split into separate
-        # intersection and non intersection segments
-        # TODO: turn these into intersection objects
-        for r in matched_roads:
-            if r.properties['id'] not in roads_with_int_segments:
-                roads_with_int_segments[r.properties['id']] = []
-            roads_with_int_segments[r.properties['id']] += int_segments
-
-        for int_segment in int_segments:
+    for points, intersections in connections:
+        for lines in intersections:
+            int_segment = [Segment(line, roads[x].properties)
+                           for x, line in lines]
 
             # Get the ids of the adjacent non-intersection segments
-            connected = [x.properties['orig_id'] for x in int_segment[0]]
+            connected = [x.properties['orig_id'] for x in int_segment]
             # create intersection object
             inter_segment = Intersection(
                     segment_id=count,
-                    lines=[x.geometry for x in int_segment[0]],
-                    data=[x.properties for x in int_segment[0]],
+                    lines=[x.geometry for x in int_segment],
+                    data=[x.properties for x in int_segment],
                     properties={
                         'id': count
                     },
-                    nodes=[x for x in int_buffer.points],
+                    nodes=[x for x in points],
                     connected_segments=connected
                 )
             inter_segments.append(inter_segment)
@@ -227,7 +301,24 @@ def find_non_ints(roads, int_buffers):
                 connected_segment_ids[idx].append(count)
 
             count += 1
-    
+    return inter_segments, connected_segment_ids
+
+
+def _make_non_intersections(roads, differences, inter_segments,
+                            connected_segment_ids):
+    """
+    Make the non-intersection segments, numbering them in order, and
+    update the intersections' connected segments to use their ids
+    Args:
+        roads - list of road segments
+        differences - dict of the part of each road outside the
+            intersections, by position, for the roads that overlap any
+        inter_segments - list of Intersections
+        connected_segment_ids - dict of the ids of the intersections
+            connected to each road, by its orig_id
+    Returns:
+        list of non-intersection segments
+    """
     non_int_lines = []
     # Store the mappings of non intersection orig_id to id
     # We'll need this to give intersections the appropriate mapping
@@ -241,19 +332,13 @@ def find_non_ints(roads, int_buffers):
         util.track(i, 1000, len(roads))
 
         # If there's no overlap between the road segment and any intersections
-        if road.properties['id'] not in roads_with_int_segments:
+        if i not in differences:
             non_int_lines.append(road)
             road.properties['id'] = '00' + str(non_int_count)
             orig_to_id[road.properties['orig_id']] = road.properties['id']
         else:
 
-            # Check against each separate intersection
-            road_info = roads_with_int_segments[road.properties['id']]
-
-            diff = road.geometry
-            for inter in road_info:
-                buffered_int = inter[1]
-                diff = diff.difference(buffered_int)
+            diff = differences[i]
 
             # check if there is any part of the segment outside buffer
             if not diff.is_empty:
@@ -292,14 +377,322 @@ def find_non_ints(roads, int_buffers):
             orig_to_id[x] for x in inter_segment.connected_segments
             if x in orig_to_id]
 
+    return non_int_lines
+
+
+def find_segments_by_topology(roads, inter_nodes, buffer_size=20):
+    """
+    Find the intersection and non-intersection segments from which
+    intersection nodes the roads start and end at, rather than by
+    overlaying buffers around the nodes on the roads.
+    Intersection nodes joined by a road no longer than two buffers are
+    grouped into one intersection, as their buffers would overlap.
+    Each intersection is made of the stubs, buffer_size long, of the roads
+    where they meet its nodes, and of the whole of the short roads
+    joining them. The rest of each road is a non-intersection segment
+    Args:
+        roads - list of road segments, with the osmids of the nodes they
+            go from and to in their from and to properties
+        inter_nodes - list of intersection nodes, with their osmids
+        buffer_size - length of the road stubs, in meters
+    Returns:
+        non_int_lines, inter_segments, as returned by find_non_ints
+    """
+    nodes = {x['properties']['osmid']: i for i, x in enumerate(inter_nodes)}
+
+    # Group the nodes, each group by its first node
+    parent = list(range(len(inter_nodes)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    ends = [_road_ends(road, nodes, inter_nodes) for road in roads]
+    for road, (start, end) in zip(roads, ends):
+        if start is not None and end is not None \
+                and road.geometry.length <= 2 * buffer_size:
+            start, end = find(start), find(end)
+            parent[max(start, end)] = min(start, end)
+
+    print("Generating intersection segments")
+    # Lines of each group's intersection, by road
+    group_lines = defaultdict(lambda: defaultdict(list))
+    differences = {}
+    for i, (road, (start, end)) in enumerate(zip(roads, ends)):
+        start = find(start) if start is not None else None
+        end = find(end) if end is not None else None
+        if start is None and end is None:
+            continue
+        length = road.geometry.length
+
+        if start == end and length <= 2 * buffer_size:
+            group_lines[start][i].append(road.geometry)
+            differences[i] = LineString()
+            continue
+
+        start_offset, end_offset = 0, length
+        if start is not None:
+            group_lines[start][i].append(
+                _stub(road.geometry, 0, buffer_size))
+            start_offset = buffer_size
+        if end is not None:
+            group_lines[end][i].append(
+                _stub(road.geometry, length - buffer_size, length))
+            end_offset = length - buffer_size
+        differences[i] = shapely.ops.substring(
+            road.geometry, start_offset, end_offset) \
+            if start_offset < end_offset else LineString()
+
+    groups = defaultdict(list)
+    for i in range(len(inter_nodes)):
+        groups[find(i)].append(i)
+
+    connections = []
+    for group in sorted(group_lines):
+        points = [Record(inter_nodes[x]['properties'],
+                         point=inter_nodes[x]['geometry'])
+                  for x in groups[group]]
+        lines = [(i, x[0] if len(x) == 1 else MultiLineString(x))
+                 for i, x in sorted(group_lines[group].items())]
+        connections.append((points, [lines]))
+    inter_segments, connected_segment_ids = _make_intersections(
+        roads, connections)
+
+    non_int_lines = _make_non_intersections(
+        roads, differences, inter_segments, connected_segment_ids)
     return non_int_lines, inter_segments
 
 
+def _road_ends(road, nodes, inter_nodes):
+    """
+    Get the intersection nodes at the start and end of a road's line.
+    The line doesn't always run from its from node to its to node, so
+    which end each is at is found by where the nodes are
+    Args:
+        road - road segment
+        nodes - dict of the positions of the intersection nodes
+            in inter_nodes, by osmid
+        inter_nodes - list of intersection nodes
+    Returns:
+        tuple of the positions of the nodes at the start and end,
+        None if there isn't an intersection node there
+    """
+    from_node = nodes.get(road.properties['from'])
+    to_node = nodes.get(road.properties['to'])
+    if from_node is None and to_node is None:
+        return None, None
+    first = shapely.Point(road.geometry.coords[0])
+    last = shapely.Point(road.geometry.coords[-1])
+    if from_node is not None:
+        point = inter_nodes[from_node]['geometry']
+        reverse = point.distance(first) > point.distance(last)
+    else:
+        point = inter_nodes[to_node]['geometry']
+        reverse = point.distance(last) > point.distance(first)
+    if reverse:
+        return to_node, from_node
+    return from_node, to_node
+
+
+def _stub(line, start, end):
+    # The part of a line between two distances along it,
+    # or the whole line if it's shorter
+    if start <= 0 and end >= line.length:
+        return line
+    return shapely.ops.substring(line, max(start, 0), min(end, line.length))
+
+
+def _has_topology(roads, inter_nodes):
+    """
+    Check whether the roads have the nodes they go from and to, and the
+    intersection nodes have osmids, which alternate maps made from city
+    data don't
+    """
+    return all(x.properties.get('from') is not None
+               and x.properties.get('to') is not None for x in roads) \
+        and all(x['properties'].get('osmid') is not None
+                for x in inter_nodes)
+
+
+def segment_roads(roads, inter_nodes, segmentation='buffer', workers=1):
+    """
+    Split roads into intersection and non-intersection segments
+    Args:
+        roads - list of road segments
+        inter_nodes - list of intersection nodes
+        segmentation - buffer, to find intersections by overlaying
+            buffers around the intersection nodes on the roads, or
+            topology, to find them from which nodes the roads meet at
+        workers - number of processes to use, buffer segmentation only
+    Returns:
+        non_int_lines, inter_segments, as returned by find_non_ints
+    """
+    if segmentation == 'topology':
+        if _has_topology(roads, inter_nodes):
+            return find_segments_by_topology(roads, inter_nodes, 20)
+        print("Roads don't have from and to nodes, " +
+              "using buffer segmentation")
+
+    # Initial buffer = 20 meters
+    int_buffers = get_intersection_buffers(inter_nodes, 20)
+    print("Found {} intersection buffers".format(len(int_buffers)))
+    return find_non_ints(roads, int_buffers, workers=workers)
+
+
+def compare_segmentations(roads, inter_nodes, workers=1):
+    """
+    Segment the roads both ways, and compare the results
+    Args:
+        roads - list of road segments, which are left unchanged
+        inter_nodes - list of intersection nodes
+        workers - number of processes to use for buffer segmentation
+    Returns:
+        dict with, for each segmentation, the number and total length of
+        its intersection and non-intersection segments, and counts of
+        the intersections made of the same nodes both ways, of
+        different but overlapping nodes, and found only one way
+    """
+    report = {}
+    node_sets = {}
+    for segmentation in SEGMENTATIONS:
+        print("Comparing {} segmentation".format(segmentation))
+        non_inters, inters = segment_roads(
+            copy.deepcopy(roads), inter_nodes, segmentation, workers)
+        report[segmentation] = {
+            'intersections': len(inters),
+            'non_intersections': len(non_inters),
+            'intersection_length': round(float(geometry.lengths(
+                [unary_union(x.lines) for x in inters]).sum()), 2),
+            'non_intersection_length': round(float(geometry.lengths(
+                [x.geometry for x in non_inters]).sum()), 2),
+        }
+        node_sets[segmentation] = [
+            frozenset(x.properties.get('osmid') for x in inter.nodes)
+            for inter in inters]
+
+    buffer_nodes = set(node_sets['buffer'])
+    buffer_node_ids = set().union(*node_sets['buffer'])
+    topology_node_ids = set().union(*node_sets['topology'])
+    report['same_nodes'] = sum(
+        1 for x in node_sets['topology'] if x in buffer_nodes)
+    report['different_nodes'] = sum(
+        1 for x in node_sets['topology']
+        if x not in buffer_nodes and x & buffer_node_ids)
+    report['only_topology'] = sum(
+        1 for x in node_sets['topology'] if not x & buffer_node_ids)
+    report['only_buffer'] = sum(
+        1 for x in node_sets['buffer'] if not x & topology_node_ids)
+    return report
+
+
+def _tiles(positions, geometries):
+    """
+    Group items by the TILE_SIZE square tile they fall in
+    Args:
+        positions - the items' positions
+        geometries - the items' geometries
+    Returns:
+        list of lists of positions, one for each tile
+    """
+    tiles = defaultdict(list)
+    if not len(positions):
+        return []
+    coords = shapely.get_coordinates(shapely.point_on_surface(
+        np.array(geometries, dtype=object)))
+    keys = np.floor(coords / TILE_SIZE).astype(np.int64)
+    for position, key in zip(positions, map(tuple, keys)):
+        tiles[key].append(position)
+    return [tiles[x] for x in sorted(tiles)]
+
+
+def _map_tiles(func, tiles, workers):
+    """
+    Run a function on each tile, on a pool of processes if there's more
+    than one worker. The processes are forked, so they share the data
+    in _shared rather than each being sent a copy
+    Args:
+        func - function taking a list of positions and returning a dict
+            of results by position
+        tiles - list of lists of positions, see _tiles
+        workers - number of processes
+    Returns:
+        dict of results by position, for all the tiles
+    """
+    results = {}
+    if workers > 1 and len(tiles) > 1 \
+            and 'fork' in multiprocessing.get_all_start_methods():
+        with concurrent.futures.ProcessPoolExecutor(
+                min(workers, len(tiles)),
+                mp_context=multiprocessing.get_context('fork')) as executor:
+            for i, tile_results in enumerate(executor.map(func, tiles)):
+                util.track(i, 100, len(tiles))
+                results.update(tile_results)
+    else:
+        for i, tile in enumerate(tiles):
+            util.track(i, 100, len(tiles))
+            results.update(func(tile))
+    return results
+
+
+def _connect_tile(positions):
+    """
+    Find the connections in each of a tile's intersection buffers
+    Args:
+        positions - positions of the buffers in _shared['int_buffers']
+    Returns:
+        dict of the positions of the roads overlapping each buffer,
+        and the intersections found in it, as returned by get_connections
+        but with each line as the road's position and its geometry
+    """
+    roads = _shared['roads']
+    results = {}
+    for i in positions:
+        int_buffer = _shared['int_buffers'][i]
+
+        # Add the portion of each road that intersects intersection buffer
+        # to match_segments. These are possible connections
+        # If the road intersects, add that to matched
+        candidates = list(_shared['road_lines_index'].intersection(
+            int_buffer.buffer.bounds))
+        geometries = geometry.as_array(
+            [roads[idx].geometry for idx in candidates])
+        intersects = shapely.intersects(geometries, int_buffer.buffer)
+        matched = [idx for idx, x in zip(candidates, intersects) if x]
+        match_segments = [
+            Segment(x, roads[idx].properties) for idx, x in zip(
+                matched, geometry.clip(
+                    geometries[intersects], int_buffer.buffer))]
+
+        # Get the connections that touch a point in the intersection buffer
+        int_segments = get_connections(int_buffer.points, match_segments)
+        road_positions = dict(zip(match_segments, matched))
+        results[i] = (matched, [
+            ([(road_positions[x], x.geometry) for x in lines], buffered)
+            for lines, buffered in int_segments])
+    return results
+
+
+def _difference_tile(positions):
+    """
+    Find the part of each of a tile's roads outside the
+    intersection buffers it overlaps
+    Args:
+        positions - positions of the roads in _shared['roads']
+    Returns:
+        dict of geometries by position
+    """
+    return dict(zip(positions, geometry.multi_difference(
+        [_shared['roads'][i].geometry for i in positions],
+        [_shared['road_int_buffers'][i] for i in positions])))
+
+
 def add_point_based_features(non_inters: list, inters: list,
                              jsonfile: str,
                              feats_filename=None,
                              additional_feats_filename=None,
-                             forceupdate=False):
+                             forceupdate=False, fmt=None):
     """
     Add any point-based set of features to existing segment data.
     If it isn't already attached to the segments
@@ -311,9 +704,11 @@ def add_point_based_features(non_inters: list, inters: list,
         addtiional_feats_filename (optional) - file for additional
             points-based data, in json format
         forceupdate - if True, re-snap points and write to file
+        fmt - format to write jsonfile in, see util.write_json_records
     """
 
-    if forceupdate or not os.path.exists(jsonfile):
+    if forceupdate or not os.path.exists(
+            util.columnar.intermediate_file(jsonfile)):
         features = []
         if feats_filename:
             features = util.read_records_from_geojson(feats_filename)
@@ -330,74 +725,86 @@ def add_point_based_features(non_inters: list, inters: list,
         # Dump to file
         print("output {} point-based features to {}".format(
             len(features), jsonfile))
-        with open(jsonfile, 'w') as f:
-            json.dump([r.properties for r in features], f)
+        util.write_json_records(
+            [r.properties for r in features], jsonfile, fmt)
 
     else:
         features = util.read_records(jsonfile, None)
         print("Read {} point-based features from file".format(len(features)))
-    matches = {}
-
-    aggregation_values = defaultdict(dict)
-
-    for feature in features:
-        near = feature.near_id
-        feat_type = feature.properties['feature']
-        feat_agg_type = ""
-
-        if 'feat_agg' in feature.properties:
-            feat_agg_type = feature.properties['feat_agg']
-            date = feature.properties['date']
-
-        if near:
-            if str(near) not in matches:
-                matches[str(near)] = {}
-
-            # only accepts "latest value", otherwise just count
-            if feat_agg_type == 'latest':
-                try:
-                    if 'value' in feature.properties:
-                        aggregation_values[(str(near), feat_type)][date] = feature.properties['value']
-                    elif 'category' in feature.properties:
-                        aggregation_values[(str(near), feat_type)][date] = feature.properties['category']
-                except KeyError as e:
-                    raise KeyError(f"feature_agg 'latest' specified but no value in key {e}")
-            else:
-                if feat_type not in matches[str(near)]:
-                    matches[str(near)][feat_type] = 0
-                matches[str(near)][feat_type] += 1
-
-    # if latest, sorts dates for each near/feat_type and puts latest in proper loc. in matches dict 
-    for str_near, feat_type in aggregation_values.keys(): 
-        values_all_dates = aggregation_values[(str_near, feat_type)]
-        latest_date = max(values_all_dates.keys())
-        matches[str_near][feat_type] = values_all_dates[latest_date]
+    matches = aggregate_point_features(features)
 
     # Add point data to intersections
-    for i, inter in enumerate(inters):
-
-        if str(inter.properties['id']) in list(matches.keys()):
-            matched_features = matches[str(inter.properties['id'])]
-            
+    for inter in inters:
+        matched_features = matches.get(str(inter.properties['id']))
+        if matched_features:
             # Since intersections consist of multiple segments, add the
             # point-based properties to each of them
             for prop in inter.data:
-                for feat in matched_features:
-                    prop[feat] = matched_features[feat]
+                prop.update(matched_features)
 
     # Add point data to non-intersections
-    for i, non_inter in enumerate(non_inters):
-        if str(non_inter.properties['id']) in list(matches.keys()):
-
-            matched_features = matches[non_inter.properties['id']]
+    for non_inter in non_inters:
+        matched_features = matches.get(str(non_inter.properties['id']))
+        if matched_features:
+            # The properties can be shared with intersections' data, so
+            # they're replaced by a copy with the features, not changed
+            non_inter.properties = {
+                **non_inter.properties, **matched_features}
 
-            n = copy.deepcopy(non_inter)
-            for feat in matched_features:
-                n.properties[feat] = matched_features[feat]
+    return non_inters, inters
 
-            non_inters[i] = n
 
-    return non_inters, inters
+def aggregate_point_features(features):
+    """
+    Aggregate point-based features by the segment they're snapped to.
+    Features are counted, except those with a feat_agg of latest,
+    for which the value (or category) with the latest date is kept,
+    the last given if there are several with that date
+    Args:
+        features - snapped records, with properties feature and,
+            for latest features, feat_agg, date, and value or category
+    Returns:
+        dict of segment id to dict of feature values, with each
+        segment's counted features in the order they first appear,
+        followed by its latest features
+    """
+    counted = []
+    latest = []
+    for feature in features:
+        near = feature.near_id
+        if not near:
+            continue
+        properties = feature.properties
+        if properties.get('feat_agg') == 'latest':
+            if 'value' in properties:
+                value = properties['value']
+            elif 'category' in properties:
+                value = properties['category']
+            else:
+                continue
+            latest.append((str(near), properties['feature'],
+                           properties['date'], value))
+        else:
+            counted.append((str(near), properties['feature']))
+
+    keys = ['near', 'feature']
+    matches = defaultdict(dict)
+    counts = pd.DataFrame(counted, columns=keys).groupby(
+        keys, sort=False).size()
+    for (near, feat_type), count in counts.items():
+        matches[near][feat_type] = int(count)
+
+    if latest:
+        latest = pd.DataFrame(
+            latest, columns=keys + ['date', 'value'], dtype=object)
+        order = pd.MultiIndex.from_frame(latest[keys].drop_duplicates())
+        # After a stable sort by date, the last row for each segment
+        # and feature has the latest date
+        latest = latest.sort_values('date', kind='stable').drop_duplicates(
+            keys, keep='last').set_index(keys)['value'].reindex(order)
+        for (near, feat_type), value in latest.items():
+            matches[near][feat_type] = value
+    return matches
 
 
 def get_intersection_name(inter_segments):
@@ -489,7 +896,22 @@ def get_non_intersection_name(non_inter_segment, inters_by_id):
     return segment_street
 
 
-def create_segments_from_json(roads_shp_path, mapfp):
+def create_segments_from_json(roads_shp_path, mapfp, workers=1,
+                              segmentation='buffer', compare=False):
+    """
+    Create the intersection and non-intersection segments from a
+    file of roads and intersection nodes
+    Args:
+        roads_shp_path - geojson file of roads and nodes,
+            typically osm_elements.geojson
+        mapfp - the map's directory
+        workers - number of processes to use
+        segmentation - how to find intersections, see segment_roads
+        compare - if true, also compare the ways of finding
+            intersections, writing segmentation_report.json to mapfp
+    Returns:
+        list of non-intersection segments, list of intersection segments
+    """
     print(roads_shp_path)
     roads, inter_nodes = util.get_roads_and_inters(roads_shp_path)
     print("read in {} road segments".format(len(roads)))
@@ -498,11 +920,22 @@ def create_segments_from_json(roads_shp_path, mapfp):
     for i, road in enumerate(roads):
         road.properties['orig_id'] = int(str(99) + str(i))
 
-    # Initial buffer = 20 meters
-    int_buffers = get_intersection_buffers(inter_nodes, 20)
-    print("Found {} intersection buffers".format(len(int_buffers)))
-    non_int_lines, inter_segments = find_non_ints(
-        roads, int_buffers)
+    if compare:
+        report = compare_segmentations(roads, inter_nodes, workers=workers)
+        for segmentation_type in SEGMENTATIONS:
+            print("{}: {} intersections, {} non-intersections".format(
+                segmentation_type,
+                report[segmentation_type]['intersections'],
+                report[segmentation_type]['non_intersections']))
+        print("{} intersections the same both ways, {} different, ".format(
+            report['same_nodes'], report['different_nodes']) +
+            "{} only found by topology, {} only by buffer".format(
+                report['only_topology'], report['only_buffer']))
+        with open(os.path.join(mapfp, 'segmentation_report.json'), 'w') as f:
+            json.dump(report, f, indent=4)
+
+    non_int_lines, inter_segments = segment_roads(
+        roads, inter_nodes, segmentation, workers=workers)
 
     non_int_w_ids = []
 
@@ -517,16 +950,16 @@ def create_segments_from_json(roads_shp_path, mapfp):
         for x in inter_nodes
     }
 
-    for i, segment in enumerate(non_int_lines):
+    centers = util.reproject(geometry.center_points(
+        [x.geometry for x in non_int_lines]), transformer_3857_to_4326)
+    for i, (segment, center) in enumerate(zip(non_int_lines, centers)):
         segment.properties['id'] = '00' + str(i)
         segment.properties['inter'] = 0
         segment.properties['display_name'] = get_non_intersection_name(
             segment, inters_by_id)
         non_int_w_ids.append(segment)
 
-        x, y = util.get_center_point(segment)
-        x, y = util.reproject(
-            [[x, y]], transformer_3857_to_4326)[0]['coordinates']
+        x, y = center['coordinates']
 
         segment.properties['center_y'] = round(y, 4)
         segment.properties['center_x'] = round(x, 4)
@@ -563,14 +996,16 @@ def create_segments_from_json(roads_shp_path, mapfp):
                 intersection.data)
             segment_data.append(segment)
 
-        x, y = util.get_center_point(intersection)
-        x, y = util.reproject(
-            [[x, y]], transformer_3857_to_4326)[0]['coordinates']
-        intersection.properties['center_x'] = x
-        intersection.properties['center_y'] = y
         intersection.data = segment_data
         union_inter.append(intersection)
 
+    centers = util.reproject(geometry.center_points(
+        [x.geometry for x in union_inter]), transformer_3857_to_4326)
+    for intersection, center in zip(union_inter, centers):
+        x, y = center['coordinates']
+        intersection.properties['center_x'] = x
+        intersection.properties['center_y'] = y
+
     return non_int_w_ids, union_inter
 
 
@@ -599,7 +1034,8 @@ def update_intersection_properties(inters, config):
     return inters
 
 
-if __name__ == '__main__':
+def main(args=None):
+    global DATA_FP, PROCESSED_DATA_FP, MAP_FP
 
     parser = argparse.ArgumentParser()
     parser.add_argument("-d", "--datadir", type=str,
@@ -614,8 +1050,14 @@ if __name__ == '__main__':
                         "within the maps directory")
     parser.add_argument('--forceupdate', action='store_true',
                         help='Whether to force update the points-based data')
-
-    args = parser.parse_args()
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                        help="Number of processes to create segments with")
+    parser.add_argument("--compare", action='store_true',
+                        help="Compare buffer and topology segmentation, " +
+                        "writing segmentation_report.json to the map " +
+                        "directory")
+
+    args = parser.parse_args(args)
     DATA_FP = args.datadir
     PROCESSED_DATA_FP = os.path.join(args.datadir, 'processed')
     MAP_FP = os.path.join(args.datadir, 'processed/maps')
@@ -631,7 +1073,11 @@ if __name__ == '__main__':
     if args.altroad:
         elements = args.altroad
 
-    non_inters, inters = create_segments_from_json(elements, MAP_FP)
+    config = data.config.Configuration(args.config)
+
+    non_inters, inters = create_segments_from_json(
+        elements, MAP_FP, workers=args.workers,
+        segmentation=config.segmentation, compare=args.compare)
 
     feats_file = os.path.join(MAP_FP, 'features.geojson')
     additional_feats_file = os.path.join(
@@ -649,10 +1095,17 @@ if __name__ == '__main__':
             jsonfile,
             feats_filename=feats_file,
             additional_feats_filename=additional_feats_file,
-            forceupdate=args.forceupdate
+            forceupdate=args.forceupdate,
+            fmt=config.intermediate_format
         )
-    config = data.config.Configuration(args.config)
-    
+
     inters = update_intersection_properties(inters, config)
-    util.write_segments(non_inters, inters, MAP_FP)
+    report_count('intersections', len(inters))
+    report_count('non_intersections', len(non_inters))
+    report_count('segments_created', len(inters) + len(non_inters))
+    util.write_segments(non_inters, inters, MAP_FP,
+                        fmt=config.intermediate_format)
 
+
+if __name__ == '__main__':
+    main()
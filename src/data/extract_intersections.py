@@ -130,7 +130,8 @@ def write_intersections(inters, roads):
         geojson.dump(elements, outfile)
 
 
-if __name__ == '__main__':
+def main(args=None):
+    global MAP_DATA_FP
 
     parser = argparse.ArgumentParser()
     parser.add_argument("shp", help="Segments shape file")
@@ -145,7 +146,7 @@ if __name__ == '__main__':
     parser.add_argument('--forceupdate', action='store_true',
                         help='Whether to force update the maps')
 
-    args = parser.parse_args()
+    args = parser.parse_args(args)
 
     # Import shapefile specified at commandline
     shp = args.shp
@@ -185,3 +186,7 @@ if __name__ == '__main__':
 
     print("writing intersections and road segments to geojson")
     write_intersections(inters, roads)
+
+
+if __name__ == '__main__':
+    main()
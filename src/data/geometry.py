@@ -0,0 +1,155 @@
+"""
+Geometry operations on whole arrays of geometries at once.
+
+Segments are processed many at a time, e.g. every road in a map is
+buffered, or every segment's center point found. Calling shapely on each
+geometry in a python loop spends much of its time in the loop rather than
+in GEOS. These functions take a list or array of geometries and make one
+vectorized shapely call for all of them, giving the same results, in the
+same order, as calling the shapely method on each.
+
+Geometries are returned as numpy object arrays, and coordinates as
+arrays with a row of x, y for each geometry.
+"""
+import numpy as np
+import shapely
+
+
+def as_array(geometries):
+    """
+    Get a list of geometries as a numpy object array
+    Args:
+        geometries - list or array of shapely geometries
+    Returns:
+        1-dimensional object array
+    """
+    if isinstance(geometries, np.ndarray) and geometries.dtype == object:
+        return geometries
+    array = np.empty(len(geometries), dtype=object)
+    array[:] = list(geometries)
+    return array
+
+
+def buffer(geometries, distance):
+    """
+    Buffer each geometry
+    Args:
+        geometries - list or array of geometries
+        distance - buffer distance, or array of one for each geometry
+    Returns:
+        array of polygons
+    """
+    # With as many segments per quarter circle as the buffer method
+    # uses, which is more than shapely.buffer does by default
+    return shapely.buffer(as_array(geometries), distance, quad_segs=16)
+
+
+def bounds(geometries):
+    """
+    Get each geometry's bounds
+    Args:
+        geometries - list or array of geometries
+    Returns:
+        list of (minx, miny, maxx, maxy), as util.bulk_index takes
+    """
+    return [tuple(x) for x in shapely.bounds(
+        as_array(geometries)).tolist()]
+
+
+def clip(geometries, polygons):
+    """
+    Get the part of each geometry inside a polygon
+    Args:
+        geometries - list or array of geometries
+        polygons - one polygon for all of them, or list or array of
+            one for each geometry
+    Returns:
+        array of geometries
+    """
+    if not isinstance(polygons, shapely.Geometry):
+        polygons = as_array(polygons)
+    return shapely.intersection(as_array(geometries), polygons)
+
+
+def multi_difference(geometries, others):
+    """
+    Subtract a list of other geometries from each geometry, one at a time
+    in order, as chaining difference calls would. Each round subtracts
+    the next of their others from all the geometries that have one
+    Args:
+        geometries - list or array of geometries
+        others - list of lists of geometries, one list for each geometry
+    Returns:
+        array of geometries
+    """
+    results = as_array(geometries).copy()
+    counts = np.array([len(x) for x in others], dtype=np.int64)
+    for i in range(counts.max() if len(counts) else 0):
+        positions = np.flatnonzero(counts > i)
+        results[positions] = shapely.difference(
+            results[positions], as_array([others[x][i] for x in positions]))
+    return results
+
+
+def lengths(geometries):
+    """
+    Get each geometry's length
+    Args:
+        geometries - list or array of geometries
+    Returns:
+        array of floats
+    """
+    return shapely.length(as_array(geometries))
+
+
+def centroids(geometries):
+    """
+    Get each geometry's centroid
+    Args:
+        geometries - list or array of geometries
+    Returns:
+        array of x, y coordinates, nan for empty geometries
+    """
+    return _coordinates(shapely.centroid(as_array(geometries)))
+
+
+def center_points(geometries):
+    """
+    Get the center point of each line, as util.get_center_point does.
+    For a linestring, it's the point half way along it; for a
+    multilinestring, the point on it nearest the center of its bounds
+    Args:
+        geometries - list or array of geometries
+    Returns:
+        array of x, y coordinates, nan for empty geometries and
+        geometries that aren't lines
+    """
+    geometries = as_array(geometries)
+    points = np.full(len(geometries), None, dtype=object)
+    types = shapely.get_type_id(geometries)
+    empty = shapely.is_empty(geometries)
+
+    is_line = (types == shapely.GeometryType.LINESTRING) & ~empty
+    points[is_line] = shapely.line_interpolate_point(
+        geometries[is_line], .5, normalized=True)
+
+    is_multi = (types == shapely.GeometryType.MULTILINESTRING) & ~empty
+    if is_multi.any():
+        multis = geometries[is_multi]
+        # From the bounds' lower left corner to their upper right
+        diagonals = shapely.linestrings(
+            shapely.bounds(multis).reshape(-1, 2, 2))
+        centers = shapely.line_interpolate_point(
+            diagonals, .5, normalized=True)
+        points[is_multi] = shapely.line_interpolate_point(
+            multis, shapely.line_locate_point(multis, centers))
+    return _coordinates(points)
+
+
+def _coordinates(points):
+    # x, y of each point, nan where there isn't one
+    coords = np.full((len(points), 2), np.nan)
+    has_point = ~shapely.is_missing(points) & ~shapely.is_empty(points)
+    if has_point.any():
+        coords[has_point] = shapely.get_coordinates(points[has_point])
+    return coords
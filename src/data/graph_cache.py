@@ -0,0 +1,147 @@
+"""
+A cache of the road graphs made from open street map, shared by every
+city and run.
+
+Downloading a city's roads from Overpass and simplifying them is slow,
+and a forced map update used to redo both even when only the crash data
+had changed. Graphs are cached under a key made from what determines
+them: the boundary they're within (hashed, so any change to it is a new
+key), where they come from (Overpass, a city place lookup, or the hash of
+an extract file), the network type and the osmnx settings that change
+the graph, including the Overpass date the data is from. So a cached
+graph is only reused for exactly the query that made it, whichever city
+made it.
+
+Both the unsimplified graph, which node features like signals and
+crossings are read from, and the simplified one are kept. They're
+pickled, as networkx graphs round trip through pickle exactly, so a
+cached graph gives the same maps a new download would.
+"""
+import hashlib
+import json
+import os
+import pickle
+import osmnx as ox
+import shapely
+
+# The road network downloaded for every city
+NETWORK_TYPE = 'drive'
+
+
+def geometry_hash(geometry):
+    """
+    Hash a boundary, the same for equal geometries however their
+    coordinates are ordered
+    Args:
+        geometry - shapely geometry
+    Returns:
+        hex digest string
+    """
+    return hashlib.sha256(
+        shapely.to_wkb(shapely.normalize(geometry))).hexdigest()
+
+
+def file_hash(filename):
+    """
+    Hash a file's contents, a block at a time
+    Args:
+        filename
+    Returns:
+        hex digest string
+    """
+    sha = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def graph_key(query):
+    """
+    Make the cache key for a graph query
+    Args:
+        query - dict describing where the graph comes from, with its
+            boundary, a shapely geometry in 4326 projection, under
+            'boundary', and anything else that identifies the data
+            (e.g. the extract's hash) as json serializable values
+    Returns:
+        hex digest string
+    """
+    description = dict(query)
+    description['boundary'] = geometry_hash(query['boundary'])
+    description.update({
+        'network_type': NETWORK_TYPE,
+        'osmnx': ox.__version__,
+        'useful_tags_node': sorted(set(ox.settings.useful_tags_node)),
+        'useful_tags_way': sorted(set(ox.settings.useful_tags_way)),
+        'overpass_settings': ox.settings.overpass_settings,
+        'default_access': ox.settings.default_access,
+    })
+    return hashlib.sha256(json.dumps(
+        description, sort_keys=True).encode()).hexdigest()
+
+
+def read_graphs(cache_dir, key):
+    """
+    Read the graphs cached under a key
+    Args:
+        cache_dir - cache directory
+        key - from graph_key
+    Returns:
+        unsimplified and simplified graphs, or None if they aren't cached
+    """
+    filename = os.path.join(cache_dir, key + '.pickle')
+    if not os.path.exists(filename):
+        return None
+    with open(filename, 'rb') as f:
+        cached = pickle.load(f)
+    return cached['unsimplified'], cached['simplified']
+
+
+def write_graphs(cache_dir, key, G1, G):
+    """
+    Cache graphs under a key, replacing any that are there
+    Args:
+        cache_dir - cache directory, made if it doesn't exist
+        key - from graph_key
+        G1 - unsimplified graph
+        G - simplified graph
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    filename = os.path.join(cache_dir, key + '.pickle')
+    # Written to a temporary file first, so a city running at the same
+    # time never reads a partly written one
+    tmp_file = '{}_{}'.format(filename, os.getpid())
+    with open(tmp_file, 'wb') as f:
+        pickle.dump({'unsimplified': G1, 'simplified': G}, f,
+                    protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, filename)
+
+
+def get_graphs(query, download, cache_dir=None):
+    """
+    Get the unsimplified and simplified graphs for a query, from the
+    cache if they're in it, otherwise by downloading and simplifying
+    them and adding them to it
+    Args:
+        query - dict describing the graph, see graph_key
+        download - function with no args that gets the unsimplified graph
+        cache_dir - cache directory, or None to not use a cache
+    Returns:
+        unsimplified graph and simplified graph
+    """
+    if cache_dir is None:
+        G1 = download()
+        return G1, ox.simplify_graph(G1)
+
+    key = graph_key(query)
+    cached = read_graphs(cache_dir, key)
+    if cached is not None:
+        print("Using cached road graph " + key)
+        return cached
+
+    G1 = download()
+    G = ox.simplify_graph(G1)
+    write_graphs(cache_dir, key, G1, G)
+    print("Cached road graph " + key)
+    return G1, G
@@ -6,12 +6,13 @@
 # Draws on: http://bit.ly/2m7469y
 # Developed by: bpben
 
-import json
 from . import util
+from .stages import report_count
+from .record import RecordBatch
 import os
 import argparse
-from shapely.geometry import Point
-import pandas as pd
+import numpy as np
+import shapely
 import geopandas as gpd
 import data.config
 
@@ -27,39 +28,126 @@ RAW_DATA_FP = os.path.join(BASE_DIR, 'data/standardized')
 PROCESSED_DATA_FP = os.path.join(BASE_DIR, 'data/processed')
 
 
+# Number of crashes snapped at a time, for each worker process;
+# memory use depends on this rather than on the size of the crash file
+BATCH_SIZE = 10000
+
+
+# Where each crash snapped to, kept between runs
+SNAP_CACHE_FILE = 'crash_snap_cache.json'
+TOLERANCE = 30
+
+
 def snap_records(
         combined_seg, segments_index, infile,
-        startyear=None, endyear=None):
+        startyear=None, endyear=None, fmt=None, batch_size=BATCH_SIZE,
+        workers=1, map_fingerprint=None):
+    """
+    Snap crashes to their nearest segments, writing the ones that snap
+    to crash_joined.json
+    Args:
+        combined_seg - list of segments
+        segments_index - rtree index of the segments
+        infile - standardized crash file
+        startyear, endyear - optional date range of crashes
+        fmt - format to write crash_joined in, defaults to the one on disk
+        batch_size - number of crashes snapped at a time, per process
+        workers - number of processes to snap with
+        map_fingerprint - hash of the map's segment files. If given,
+            crashes whose id and location are in the snap cache made for
+            this map aren't snapped again, and the cache is updated
+    """
 
     print("reading crash data...")
-    records = util.read_records(infile, 'crash', startyear, endyear)
+    records = util.iter_record_batches(
+        infile, 'crash', startyear, endyear, batch_size * workers)
 
     # Find nearest crashes - 30 tolerance
-    print("snapping crash records to segments")
-    util.find_nearest(
-        records, combined_seg, segments_index, 30, type_record=True)
-    record_num = len(records)
-    records = [x for x in records if x.near_id]
-    dropped_records = record_num - len(records)
-    if dropped_records:
-        print("Dropped {} crashes that don't map to a segment".format(dropped_records))
-        print("{} crashes remain".format(len(records)))
+    print("snapping crash records to segments, using tolerance {}".format(
+        TOLERANCE))
+    if workers > 1:
+        print("snapping on {} processes".format(workers))
+    counts = {'read': 0, 'dropped': 0, 'cached': 0}
+
+    cache = None
+    cache_file = os.path.join(PROCESSED_DATA_FP, SNAP_CACHE_FILE)
+    if map_fingerprint:
+        cache = util.snapping.read_snap_cache(
+            cache_file, map_fingerprint, TOLERANCE)
+
+    pool = util.snapping.SnapPool(
+        util.snapping.SegmentTree(combined_seg), workers)
+
+    def snap(batch):
+        if cache is None:
+            util.find_nearest(
+                batch, combined_seg, segments_index, TOLERANCE,
+                verbose=False, tree=pool)
+            return
+
+        ids = [str(x.get('id')) for x in batch.properties]
+        hashes = [util.snapping.location_hash(x['location'])
+                  for x in batch.properties]
+        entries = [cache.get(x) for x in ids]
+        cached = np.array([bool(entry) and entry[0] == location_hash
+                           for entry, location_hash in zip(entries, hashes)],
+                          dtype=bool)
+        batch.near_ids[cached] = [
+            entry[1] for entry, x in zip(entries, cached) if x]
+        counts['cached'] += int(cached.sum())
+
+        unsnapped = batch.take(~cached)
+        distances = util.find_nearest(
+            unsnapped, combined_seg, segments_index, TOLERANCE,
+            verbose=False, tree=pool)
+        batch.near_ids[~cached] = unsnapped.near_ids
+        for index, near_id, distance in zip(
+                np.flatnonzero(~cached), unsnapped.near_ids, distances):
+            if 'id' in batch.properties[index]:
+                cache[ids[index]] = [
+                    hashes[index], near_id,
+                    None if np.isnan(distance) else float(distance)]
+
+    def snapped():
+        for batch in records:
+            snap(batch)
+            counts['read'] += len(batch)
+            matched = batch.near_ids.astype(bool)
+            counts['dropped'] += int((~matched).sum())
+            for properties in batch.iter_properties(matched):
+                yield properties
+
     jsonfile = os.path.join(
         PROCESSED_DATA_FP, 'crash_joined.json')
 
     print("output crash data to " + jsonfile)
-    with open(jsonfile, 'w') as f:
-        json.dump([r.properties for r in records], f)
+    with pool:
+        util.write_json_records(snapped(), jsonfile, fmt)
 
+    print("Read in data from {} crashes".format(counts['read']))
+    report_count('crashes_read', counts['read'])
+    report_count('crashes_dropped', counts['dropped'])
+    if cache is not None:
+        print("{} crashes were already snapped, snapped {} more".format(
+            counts['cached'], counts['read'] - counts['cached']))
+        report_count('crashes_cached', counts['cached'])
+        util.snapping.write_snap_cache(
+            cache, cache_file, map_fingerprint, TOLERANCE)
+    if counts['dropped']:
+        print("Dropped {} crashes that don't map to a segment".format(
+            counts['dropped']))
+        print("{} crashes remain".format(counts['read'] - counts['dropped']))
 
-def make_crash_rollup(crashes_json, split_columns=[]):
+
+def make_crash_rollup(crashes, split_columns=[]):
     """
     Generates a GeoDataframe with the total number of crashes, number of bike,
     pedestrian and vehicle crashes, along with a comma-separated string
     of crash dates per unique lat/lng pair
 
     Inputs:
-        - a json of standardized crash data
+        - a RecordBatch of standardized crash data, with flags for the
+          split columns, or a list of standardized crash dicts
 
     Output:
         - a list of GeoDataframes
@@ -69,52 +157,83 @@ def make_crash_rollup(crashes_json, split_columns=[]):
             - list of unique dates that crashes occurred
             - GeoJSON point features created from the latitude and longitude
     """
+    if not isinstance(crashes, RecordBatch):
+        crashes = RecordBatch.from_items(crashes, 'crash', split_columns)
+    return make_crash_rollup_from_batches([crashes], split_columns)
+
 
-    crash_locations = {
-        'all': {}
-    }
-    for column in split_columns:
-        crash_locations[column] = {}
-
-    # Make multiple crash rollup files
-    for crash in crashes_json:
-        loc = (crash['location']['longitude'], crash['location']['latitude'])
-
-        if loc not in crash_locations['all']:
-            crash_locations['all'][loc] = {
-                'coordinates': Point(loc),
-                'total_crashes': 0,
-                'crash_dates': [],
-            }
-        crash_locations['all'][loc]['total_crashes'] += 1
-        date = crash['dateOccurred']
-
-        crash_locations['all'][loc]['crash_dates'].append(date)
+def make_crash_rollup_from_batches(batches, split_columns=[]):
+    """
+    Makes the same rollups as make_crash_rollup, from crashes read a
+    batch at a time, e.g. by util.iter_record_batches. Only each
+    location's count and dates are kept, not the crashes
+    Args:
+        batches - iterable of RecordBatches, with flags for the
+            split columns
+        split_columns - list of split columns
+    Returns:
+        dict of GeoDataFrames, see make_crash_rollup
+    """
+    rollups = {x: {} for x in ['all'] + list(split_columns)}
+    for crashes in batches:
+        locations = np.column_stack([crashes.longitude, crashes.latitude])
+        dates = np.array([x['dateOccurred'] for x in crashes.properties],
+                         dtype=str)
+        _add_to_rollup(rollups['all'], locations, dates)
         for column in split_columns:
-            if column in crash:
-                if loc not in crash_locations[column]:
-                    crash_locations[column][loc] = {
-                        'coordinates': Point(loc),
-                        'total_crashes': 0,
-                        'crash_dates': [],
-                    }
-                crash_locations[column][loc]['total_crashes'] += 1
-                crash_locations[column][loc]['crash_dates'].append(crash['dateOccurred'])
-
-    crashes_agg = {}
-    for crash_type in crash_locations.keys():
-        crashes_agg_gdf = gpd.GeoDataFrame(
-            pd.DataFrame.from_dict(crash_locations[crash_type], orient='index'),
-            geometry='coordinates'
-        )
-        crashes_agg_gdf.index = range(len(crashes_agg_gdf))
-        crashes_agg_gdf['crash_dates'] = crashes_agg_gdf['crash_dates'].apply(
-            lambda x: ",".join(sorted(set(x))))
-        crashes_agg[crash_type] = crashes_agg_gdf
+            flags = crashes.flags[column]
+            _add_to_rollup(rollups[column], locations[flags], dates[flags])
+    return {column: _rollup_frame(rollup)
+            for column, rollup in rollups.items()}
 
-    return crashes_agg
 
-if __name__ == '__main__':
+def _add_to_rollup(rollup, locations, dates):
+    """
+    Add crashes to a rollup, a dict of each location's count and
+    set of dates, with the locations in the order they first appear
+    """
+    if not len(locations):
+        return
+
+    _, first, inverse = np.unique(
+        locations, axis=0, return_index=True, return_inverse=True)
+    order = np.argsort(first)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    groups = rank[inverse.reshape(-1)]
+
+    totals = np.bincount(groups)
+    by_group = np.argsort(groups, kind='stable')
+    group_dates = np.split(dates[by_group], np.cumsum(totals)[:-1])
+    for location, total, location_dates in zip(
+            locations[first[order]].tolist(), totals.tolist(), group_dates):
+        entry = rollup.setdefault(tuple(location), [0, set()])
+        entry[0] += total
+        entry[1].update(location_dates.tolist())
+
+
+def _rollup_frame(rollup):
+    """
+    Make a GeoDataFrame from a rollup made by _add_to_rollup
+    """
+    if not rollup:
+        return gpd.GeoDataFrame({
+            'coordinates': gpd.GeoSeries([]),
+            'total_crashes': np.array([], dtype=np.int64),
+            'crash_dates': np.array([], dtype=object),
+        }, geometry='coordinates')
+
+    locations = np.array(list(rollup.keys()), dtype=float)
+    return gpd.GeoDataFrame({
+        'coordinates': gpd.GeoSeries(shapely.points(locations)),
+        'total_crashes': np.array(
+            [x[0] for x in rollup.values()], dtype=np.int64),
+        'crash_dates': [",".join(sorted(x[1])) for x in rollup.values()],
+    }, geometry='coordinates')
+
+
+def main(args=None):
+    global RAW_DATA_FP, PROCESSED_DATA_FP, MAP_FP
 
     parser = argparse.ArgumentParser()
     parser.add_argument("-c", "--config", type=str,
@@ -125,8 +244,13 @@ if __name__ == '__main__':
                         help="Can limit data to crashes this year or later")
     parser.add_argument("-end", "--endyear", type=str,
                         help="Can limit data to crashes this year or earlier")
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                        help="Number of processes to snap crashes with")
+    parser.add_argument('--forceupdate', action='store_true',
+                        help='Snap every crash again, rather than only ' +
+                        'ones that are new or have moved since the last run')
 
-    args = parser.parse_args()
+    args = parser.parse_args(args)
     config = data.config.Configuration(args.config)
     
     # Can override the hardcoded data directory
@@ -139,11 +263,18 @@ if __name__ == '__main__':
     snap_records(
         combined_seg, segments_index,
         os.path.join(RAW_DATA_FP, 'crashes.json'),
-        startyear=args.startyear, endyear=args.endyear)
+        startyear=args.startyear, endyear=args.endyear,
+        fmt=config.intermediate_format, workers=args.workers,
+        map_fingerprint=None if args.forceupdate
+        else util.segments_fingerprint(MAP_FP))
 
-    with open(os.path.join(PROCESSED_DATA_FP, 'crash_joined.json')) as crash_file:
-        data = json.load(crash_file)
-    crashes_agg_list = make_crash_rollup(data, config.split_columns)
+    # Rolled up a batch at a time, so the snapped crashes are never all
+    # in memory
+    crashes = util.iter_record_batches(
+        os.path.join(PROCESSED_DATA_FP, 'crash_joined.json'), 'crash',
+        split_columns=config.split_columns)
+    crashes_agg_list = make_crash_rollup_from_batches(
+        crashes, config.split_columns)
 
     crashes_agg_path = os.path.join(
         args.datadir, "processed", "crashes_rollup.geojson")
@@ -167,3 +298,7 @@ if __name__ == '__main__':
             filename,
             driver="GeoJSON"
         )
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,17 @@
 # -*- coding: utf-8 -*-
 import os
-import subprocess
 import argparse
 import data.config
+from .stages import Build, MAP_CONFIG_KEYS, FEATURE_CONFIG_KEYS, \
+    CRASH_CONFIG_KEYS, STORAGE_CONFIG_KEYS, SEGMENT_CONFIG_KEYS
+from .columnar import intermediate_file
 
 DATA_FP = os.path.dirname(
     os.path.dirname(
         os.path.dirname(
             os.path.abspath(__file__)))) + '/data/'
     
-if __name__ == '__main__':
-
+def main(args=None):
     parser = argparse.ArgumentParser()
     # Can give a config file
     parser.add_argument("-c", "--config", type=str, required=True,
@@ -26,12 +27,19 @@ if __name__ == '__main__':
                         "in form YYYY-MM-DD")
     parser.add_argument('--forceupdate', action='store_true',
                         help='Whether to force update the maps')
+    parser.add_argument('--isolated', action='store_true',
+                        help='Run each step in its own python process')
+    parser.add_argument('--workers', type=int,
+                        help='Number of processes to create segments ' +
+                        'and snap crashes with')
 
-    args = parser.parse_args()
+    args = parser.parse_args(args)
 
     config_file = args.config
-    startdate = None
-    enddate = None
+    # Crashes outside these dates are left out when they're joined to
+    # segments
+    startdate = args.startdate
+    enddate = args.enddate
 
     config = data.config.Configuration(config_file)
 
@@ -42,7 +50,6 @@ if __name__ == '__main__':
 
     recreate = False
     outputdir = config.city.split(',')[0]
-    additional_features = None
     if config.additional_map_features:
         extra_map = config.additional_map_features['extra_map']
 
@@ -54,63 +61,109 @@ if __name__ == '__main__':
     if os.path.exists(os.path.join(DATA_FP, 'standardized', 'waze.json')):
         waze = True
 
+    build = Build(DATA_FP, config_file=config_file,
+                  forceupdate=recreate, isolated=args.isolated)
+
+    # Segments and joined records are stored as geojson/json or parquet,
+    # depending on the config
+    def stored(filename):
+        return intermediate_file(filename, config.intermediate_format)
+
+    # Stages that can use several processes are told how many, but
+    # changing it doesn't make them rerun
+    workers_args = ['--workers', str(args.workers)] if args.workers else []
+
+    maps = os.path.join('processed', 'maps')
+    segment_files = [
+        stored(os.path.join(maps, 'inters_segments.geojson')),
+        stored(os.path.join(maps, 'non_inters_segments.geojson')),
+    ]
+    all_segment_files = segment_files + [
+        stored(os.path.join(maps, 'inter_and_non_int.geojson'))]
+
     print("Generating maps for " + config.city + ' in ' + DATA_FP)
     if recreate:
         print("Overwriting existing data...")
     # Get the maps out of open street map, both projections
-    subprocess.check_call([
-        'python',
-        '-m',
-        'data.osm_create_maps',
+    # The crash file is also read here, but only to see whether the
+    # city polygon should be expanded, so new crashes don't cause
+    # the maps to be downloaded again
+    build.run('osm_create_maps', [
         '-c',
         config_file,
         '-d',
         DATA_FP,
-    ] + (['--forceupdate'] if recreate else []))
+    ] + (['--forceupdate'] if recreate else []),
+        inputs=[os.path.join('raw', 'maps')]
+        if config.map_geography == 'shapefile' or config.osm_extract
+        else [],
+        outputs=[
+            os.path.join(maps, 'osm.gpkg'),
+            os.path.join(maps, 'features.geojson'),
+            os.path.join(maps, 'osm_elements.geojson'),
+        ],
+        config_keys=MAP_CONFIG_KEYS,
+        force_args=['--forceupdate'])
 
     # Add waze data if applicable
     if waze:
         print("Adding Waze features")
-        subprocess.check_call([
-            'python',
-            '-m',
-            'data.add_waze_data',
+        build.run('add_waze_data', [
             '-d',
             DATA_FP
-        ] + (['--forceupdate'] if recreate else []))
+        ] + (['--forceupdate'] if recreate else []),
+            inputs=[
+                os.path.join('standardized', 'waze.json'),
+                os.path.join(maps, 'osm_elements.geojson'),
+            ],
+            outputs=[
+                os.path.join(maps, 'osm_elements.geojson'),
+                os.path.join(maps, 'jams.geojson'),
+            ],
+            force_args=['--forceupdate'])
     else:
         print("No Waze data found, skipping...")
     
     # Create segments on the open street map data
-    subprocess.check_call([
-        'python',
-        '-m',
-        'data.create_segments',
+    build.run('create_segments', [
         '-d',
         DATA_FP,
         '-c',
         config_file
-    ])
+    ],
+        inputs=[
+            os.path.join(maps, 'osm_elements.geojson'),
+            os.path.join(maps, 'features.geojson'),
+            os.path.join('standardized', 'points.json'),
+        ],
+        outputs=all_segment_files + [
+            stored(os.path.join('processed', 'points_joined.json'))],
+        config_keys=FEATURE_CONFIG_KEYS + STORAGE_CONFIG_KEYS +
+        SEGMENT_CONFIG_KEYS,
+        force_args=['--forceupdate'],
+        runtime_args=workers_args)
 
     if extra_map:
+        newmap = os.path.join(maps, outputdir)
         # Extract intersections from the new city file
         # Write to a subdirectory so files created from osm aren't overwritten
         # Eventually, directory of additional files should also be an argument
-        subprocess.check_call([
-            'python',
-            '-m',
-            'data.extract_intersections',
+        build.run('extract_intersections', [
             os.path.join(extra_map),
             '-d',
             DATA_FP,
             '-n',
             outputdir
-        ] + (['--forceupdate'] if recreate else []))
+        ] + (['--forceupdate'] if recreate else []),
+            # Shapefiles come with sidecar files, so use the whole directory
+            inputs=[os.path.dirname(os.path.abspath(extra_map))],
+            outputs=[
+                os.path.join(newmap, 'inters.pkl'),
+                os.path.join(newmap, 'elements.geojson'),
+            ],
+            force_args=['--forceupdate'])
 
-        subprocess.check_call([
-            'python',
-            '-m',
-            'data.create_segments',
+        build.run('create_segments', [
             '-d',
             DATA_FP,
             '-c',
@@ -120,21 +173,34 @@ if __name__ == '__main__':
             '-r',
             os.path.join(
                 DATA_FP, 'processed', 'maps', outputdir, 'elements.geojson')
-        ] + (['--forceupdate'] if recreate else []))
+        ] + (['--forceupdate'] if recreate else []),
+            stage_id='create_segments_' + outputdir,
+            inputs=[
+                os.path.join(newmap, 'elements.geojson'),
+                os.path.join('standardized', 'points.json'),
+            ],
+            outputs=[
+                stored(os.path.join(newmap, 'inters_segments.geojson')),
+                stored(os.path.join(newmap, 'non_inters_segments.geojson')),
+                stored(os.path.join(newmap, 'inter_and_non_int.geojson')),
+            ],
+            config_keys=FEATURE_CONFIG_KEYS + STORAGE_CONFIG_KEYS +
+            SEGMENT_CONFIG_KEYS,
+            force_args=['--forceupdate'],
+            runtime_args=workers_args)
 
         # Map the additional map segments to the open street map segments
-        subprocess.check_call([
-            'python',
-            '-m',
-            'data.add_map',
+        build.run('add_map', [
             DATA_FP,
             outputdir,
-        ])
+        ],
+            inputs=segment_files + [
+                stored(os.path.join(newmap, 'inters_segments.geojson')),
+                stored(os.path.join(newmap, 'non_inters_segments.geojson')),
+            ],
+            outputs=all_segment_files)
 
-    subprocess.check_call([
-        'python',
-        '-m',
-        'data.join_segments_crash',
+    build.run('join_segments_crash', [
         '-d',
         DATA_FP,
         '-c',
@@ -142,31 +208,54 @@ if __name__ == '__main__':
     ]
         + (['-start', startdate] if startdate else [])
         + (['-end', enddate] if enddate else [])
+        + (['--forceupdate'] if recreate else []),
+        inputs=[os.path.join('standardized', 'crashes.json')] + segment_files,
+        outputs=[
+            stored(os.path.join('processed', 'crash_joined.json')),
+            os.path.join('processed', 'crashes_rollup.geojson'),
+        ] + [
+            os.path.join('processed', 'crashes_rollup_' + x + '.geojson')
+            for x in config.split_columns
+        ],
+        config_keys=CRASH_CONFIG_KEYS + STORAGE_CONFIG_KEYS,
+        runtime_args=workers_args
     )
 
-    subprocess.check_call([
-        'python',
-        '-m',
-        'data.propagate_volume',
+    build.run('propagate_volume', [
         '-d',
         DATA_FP
-    ] + (['--forceupdate'] if recreate else []))
-    subprocess.check_call([
-        'python',
-        '-m',
-        'data.TMC_scraping.parse_tmc',
+    ] + (['--forceupdate'] if recreate else []),
+        inputs=[os.path.join('standardized', 'volume.json')] + segment_files,
+        outputs=all_segment_files + [
+            stored(os.path.join('processed', 'snapped_atrs.json')),
+            os.path.join('processed', 'atrs_predicted.csv'),
+        ])
+    build.run('parse_tmc', [
         '-d',
         DATA_FP
-    ] + (['--forceupdate'] if recreate else []))
+    ] + (['--forceupdate'] if recreate else []),
+        inputs=[
+            os.path.join('raw', 'volume', 'TMCs'),
+            os.path.join('standardized', 'volume.json'),
+            stored(os.path.join('processed', 'crash_joined.json')),
+        ] + segment_files,
+        outputs=[os.path.join('processed', 'tmc_summary.json')],
+        force_args=['--forceupdate'])
 
     # Throw in make canonical dataset here too just to keep track
     # of standardized features
-    subprocess.check_call([
-        'python',
-        '-m',
-        'features.make_canon_dataset',
+    build.run('make_canon_dataset', [
         '-d',
         DATA_FP,
         '-c',
         config_file,
-    ])
+    ],
+        inputs=[
+            stored(os.path.join('processed', 'crash_joined.json')),
+            stored(os.path.join(maps, 'inter_and_non_int.geojson')),
+        ],
+        outputs=[os.path.join('processed', 'vz_predict_dataset.csv.gz')],
+        config_keys=FEATURE_CONFIG_KEYS + CRASH_CONFIG_KEYS)
+
+if __name__ == '__main__':
+    main()
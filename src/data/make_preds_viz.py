@@ -19,6 +19,7 @@ import pandas as pd
 import geojson
 import sys
 import data.config
+from .columnar import intermediate_file, read_table
 
 
 def combine_predictions_and_segments(predictions, segments):
@@ -114,16 +115,20 @@ def write_all_preds(DATA_FP, config):
             predictions_file, orient="index", typ="series", dtype=False)
         print("{} found".format(len(preds_data)))
 
-        segments_file = os.path.join(
-            DATA_FP, "processed", "maps", "inter_and_non_int.geojson")
+        segments_file = intermediate_file(os.path.join(
+            DATA_FP, "processed", "maps", "inter_and_non_int.geojson"))
         if not os.path.exists(segments_file):
             sys.exit("segment file not found at {}, exiting".format(segments_file))
 
         # load the segments
         print("loading segments: ", end="")
-        segs_features = pd.read_json(segments_file)
-        # TODO segments data standard should probably key each segment by its id
-        segs_data = segs_features["features"]
+        if segments_file.endswith('.parquet'):
+            segs_data = [{'id': x.get('id', ''), 'properties': x}
+                         for x in read_table(segments_file)[0]]
+        else:
+            segs_features = pd.read_json(segments_file)
+            # TODO segments data standard should probably key each segment by its id
+            segs_data = segs_features["features"]
         print("{} found".format(len(segs_data)))
 
         # output the combined prediction + segment data for use
@@ -137,8 +142,7 @@ def write_all_preds(DATA_FP, config):
             DATA_FP, "processed", output_file))
 
 
-if __name__ == "__main__":
-
+def main(args=None):
     parser = argparse.ArgumentParser()
     parser.add_argument("-d", "--datadir", type=str,
                         help="data directory")
@@ -146,6 +150,10 @@ if __name__ == "__main__":
                         help="yml file for model config"
     )
 
-    args = parser.parse_args()
+    args = parser.parse_args(args)
     config = data.config.Configuration(args.config)
     write_all_preds(args.datadir, config)
+
+
+if __name__ == '__main__':
+    main()
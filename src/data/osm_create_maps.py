@@ -5,13 +5,20 @@ import shutil
 import os
 import re
 import csv
+import hashlib
 import geojson
 import json
 import requests
 import geopandas
+import numpy as np
+import pandas as pd
 from collections import OrderedDict
+from . import geometry
+from . import graph_cache
+from . import osm_extract
 from . import util
-from shapely.geometry import Polygon, LineString, LinearRing
+import shapely
+from shapely.geometry import Polygon, LinearRing, mapping, shape
 import data.config
 from .record import transformer_3857_to_4326
 
@@ -51,7 +58,7 @@ def find_osm_polygon(city):
     return None, None
 
 
-def expand_polygon(polygon, points_file, max_percent=.1):
+def expand_polygon(polygon, points_file, max_percent=.1, cache_file=None):
     """
     Read the crash data, determine what proportion of crashes fall outside
     the city polygon
@@ -60,6 +67,9 @@ def expand_polygon(polygon, points_file, max_percent=.1):
         points_file - json points file
         Optional: max_percent (in case you want to override the maximum
             percent that can be outside the original polygon to buffer)
+        Optional: cache_file - file to keep the result in, which is
+            reused while the points file, polygon and max_percent
+            are the same
     Returns:
         Updated polygon if it was a polygon to start with, None otherwise
     """
@@ -68,24 +78,55 @@ def expand_polygon(polygon, points_file, max_percent=.1):
     if polygon['type'] != 'Polygon':
         return None
 
+    if cache_file:
+        key = hashlib.sha256(json.dumps([
+            graph_cache.file_hash(points_file), polygon, max_percent],
+            sort_keys=True).encode()).hexdigest()
+        if os.path.exists(cache_file):
+            with open(cache_file) as f:
+                cached = json.load(f)
+            if cached['key'] == key:
+                print("Crashes haven't changed, using the last city polygon")
+                return shape(cached['polygon']) if cached['polygon'] \
+                    else None
+
+    result = _expand_polygon(polygon, points_file, max_percent)
+
+    if cache_file:
+        tmp_file = '{}_{}'.format(cache_file, os.getpid())
+        with open(tmp_file, 'w') as f:
+            json.dump({
+                'key': key,
+                'polygon': mapping(result) if result else None,
+            }, f)
+        os.replace(tmp_file, cache_file)
+    return result
+
+
+def _expand_polygon(polygon, points_file, max_percent):
     polygon_coords = util.reproject([x for x in polygon['coordinates'][0]])
     polygon_coords = [x['coordinates'] for x in polygon_coords]
 
     poly_shape = Polygon(polygon_coords)
+    shapely.prepare(poly_shape)
 
-    records = util.read_records(points_file, 'crash')
-
+    # Check the crashes a batch at a time. Only their coordinates are
+    # needed, so they're read as records, without parsing their dates
     outside = []
-    for record in records:
-        if not poly_shape.contains(record.point):
-            outside.append(record.point)
-    outside_rate = len(outside)/len(records)
+    total = 0
+    for batch in util.iter_record_batches(points_file, 'record'):
+        total += len(batch)
+        is_outside = ~shapely.contains_xy(poly_shape, batch.x, batch.y)
+        outside.append(np.column_stack(
+            [batch.x[is_outside], batch.y[is_outside]]))
+    outside = np.concatenate(outside) if outside else np.empty((0, 2))
+    outside_rate = len(outside)/total
 
     if outside_rate > .01 and outside_rate < max_percent:
         print("{}% of crashes fell outside the city polygon".format(
             int(round(outside_rate, 2)*100)
         ))
-        poly_shape = buffer_polygon(poly_shape, outside)
+        poly_shape = buffer_polygon(poly_shape, shapely.points(outside))
 
         # Convert back to 4326 projection
         coords = util.reproject(poly_shape.exterior.coords, transformer_3857_to_4326)
@@ -107,63 +148,127 @@ def buffer_polygon(polygon, points):
     to include points within 250 meters
     Args:
         polygon - shapely polygon
-        points - list of shapely points
+        points - list or array of shapely points
     Returns:
         new polygon with buffered points added
     """
-    not_close = []
-    add_buffers = []
+    points = geometry.as_array(points)
 
     poly_ext = LinearRing(polygon.exterior.coords)
-    for point in points:
-        # Find the distance between the point and the city polygon
-        dist = polygon.distance(point)
-        if dist > 250:
-            not_close.append(point)
-        else:
-            # Create a line between the polygon and the point,
-            # and buffer it
-            point2 = poly_ext.interpolate(poly_ext.project(point))
-            line = LineString([(point.x, point.y), (point2.x, point2.y)])
-            buff = line.buffer(50)
-            add_buffers.append(buff)
-    for buff in add_buffers:
-        polygon = polygon.union(buff)
+    # Find the distance between each point and the city polygon
+    close = shapely.distance(polygon, points) <= 250
+    not_close = np.count_nonzero(~close)
+
+    # Create a line between the polygon and each close point,
+    # and buffer it
+    points = points[close]
+    nearest = shapely.line_interpolate_point(
+        poly_ext, shapely.line_locate_point(poly_ext, points))
+    lines = shapely.linestrings(np.stack([
+        shapely.get_coordinates(points),
+        shapely.get_coordinates(nearest)], axis=1))
+    add_buffers = geometry.buffer(lines, 50)
+
+    # All at once, rather than adding each buffer to the polygon in turn
+    polygon = shapely.union_all(np.append(
+        geometry.as_array([polygon]), add_buffers))
     if not_close:
         print("{} crashes fell outside the buffered city polygon".format(
-            len(not_close)
+            not_close
         ))
     else:
         print("Expanded city polygon to include all crash locations")
     return polygon
 
 
-def get_graph(config):
+def read_boundary_shapefile(config):
     """
-    Use osmnx to get a graph for a city according to shape type
-    specified in config object
+    Read the city boundary from the boundary shapefile
     Args:
         config object
     Returns:
-        osmnx graph object
+        polygon or multipolygon in 4326 projection
+    """
+    print("Reading from shape file")
+    # Read in boundary shapefile and convert it to 4326 projection
+    polygons = geopandas.read_file(os.path.join(
+        RAW_FP, 'maps', config.boundary_shapefile))
+    polygons = polygons.to_crs({'init': 'epsg:4326'})
+    # Add an arbitrary column to group by
+    polygons['groupby'] = 0
+    combined_polys = polygons.dissolve(by='groupby')
+    return combined_polys.geometry[0]
+
+
+def get_extract_boundary(config):
+    """
+    Get the boundary to read roads within from an open street map
+    extract. The city polygon can't be looked up without Nominatim, so
+    unless there's a boundary shapefile, it's the square around the city
+    that graph_from_point would use
+    Args:
+        config object
+    Returns:
+        polygon or multipolygon in 4326 projection
     """
-
     if config.map_geography == 'shapefile':
-        print("Reading from shape file")
-        # Read in boundary shapefile and convert it to 4326 projection
-        polygons = geopandas.read_file(os.path.join(
-            RAW_FP, 'maps', config.boundary_shapefile))
-        polygons = polygons.to_crs({'init': 'epsg:4326'})
-        # Add an arbitrary column to group by
-        polygons['groupby'] = 0
-        combined_polys = polygons.dissolve(by='groupby')
-        poly = combined_polys.geometry[0]
+        return read_boundary_shapefile(config)
+    if config.map_geography != 'radius':
+        print("Can't look up the city polygon without Nominatim, " +
+              "using the roads within {} km of the city".format(
+                  config.city_radius))
+    return radius_boundary(config)
+
+
+def radius_boundary(config):
+    """
+    Get the square around the city that graph_from_point gets roads within
+    Args:
+        config object
+    Returns:
+        polygon in 4326 projection
+    """
+    north, south, east, west = ox.utils_geo.bbox_from_point(
+        (config.city_latitude, config.city_longitude),
+        dist=config.city_radius * 1000)
+    return ox.utils_geo.bbox_to_poly(
+        north=north, south=south, east=east, west=west)
+
+
+def graph_query(config):
+    """
+    Work out how to get a graph for a city according to shape type
+    specified in config object, or from the open street map extract
+    if the config gives one
+    Args:
+        config object
+    Returns:
+        dict describing the query, with the boundary the roads are within
+            in 4326 projection, which the graph cache key is made from,
+        and a function with no args that gets the graph with osmnx
+    """
+
+    if config.osm_extract:
+        extract_file = os.path.join(RAW_FP, 'maps', config.osm_extract)
+        boundary = get_extract_boundary(config)
+        return {
+            'source': 'extract',
+            'boundary': boundary,
+            'extract': graph_cache.file_hash(extract_file),
+        }, lambda: osm_extract.graph_from_extract(extract_file, boundary)
+
+    def from_polygon(poly):
         print("graphing from polygon")
         G1 = ox.graph_from_polygon(poly, network_type='drive',
                                    simplify=False)
         print("finished graphing from polygon")
         return G1
-        
+
+    if config.map_geography == 'shapefile':
+        poly = read_boundary_shapefile(config)
+        return {'source': 'polygon', 'boundary': poly}, \
+            lambda: from_polygon(poly)
+
     # confirm if a polygon is available for this city, which determines which
     # graph function is appropriate
     print("searching nominatim for " + str(config.city) + " polygon")
@@ -171,43 +276,66 @@ def get_graph(config):
 
     if polygon_pos is not None and config.map_geography != 'radius':
         # Check to see if polygon needs to be expanded to include other points
-        polygon = expand_polygon(polygon, os.path.join(
-            STANDARDIZED_FP, 'crashes.json'))
+        expanded = expand_polygon(polygon, os.path.join(
+            STANDARDIZED_FP, 'crashes.json'), cache_file=os.path.join(
+                MAP_FP, 'expanded_polygon.json'))
 
-        if not polygon:
+        if not expanded:
             print("city polygon found in OpenStreetMaps at position " +
                   str(polygon_pos) + ", building graph of roads within " +
                   "specified bounds")
-            G1 = ox.graph_from_place(config.city, network_type='drive',
-                                     simplify=False, which_result=polygon_pos)
-        else:
-            print("using buffered city polygon")
-            G1 = ox.graph_from_polygon(polygon, network_type='drive',
-                                       simplify=False)
+            return {
+                'source': 'place',
+                'boundary': shape(polygon),
+                'place': config.city,
+                'which_result': polygon_pos,
+            }, lambda: ox.graph_from_place(
+                config.city, network_type='drive', simplify=False,
+                which_result=polygon_pos)
+
+        print("using buffered city polygon")
+        return {'source': 'polygon', 'boundary': expanded}, \
+            lambda: from_polygon(expanded)
+
+    print_string = ""
+    if config.map_geography != 'radius':
+        print_string = "No city polygon found in OpenStreetMaps, building "
     else:
-        print_string = ""
-        if config.map_geography != 'radius':
-            print_string = "No city polygon found in OpenStreetMaps, building "
-        else:
-            print_string = "Building "
-        print_string += "graph of roads within {} km of city ({}/{})".format(
-              str(config.city_radius),
-              str(config.city_latitude),
-              str(config.city_longitude))
+        print_string = "Building "
+    print_string += "graph of roads within {} km of city ({}/{})".format(
+          str(config.city_radius),
+          str(config.city_latitude),
+          str(config.city_longitude))
+    print(print_string)
+
+    return {'source': 'polygon', 'boundary': radius_boundary(config)}, \
+        lambda: ox.graph_from_point(
+        (config.city_latitude, config.city_longitude),
+        dist=config.city_radius * 1000,
+        network_type='drive', simplify=False)
 
-        G1 = ox.graph_from_point((config.city_latitude,
-                                  config.city_longitude),
-                                 distance=config.city_radius * 1000,
-                                 network_type='drive', simplify=False)
-    return G1
-    
 
-def simple_get_roads(config, mapfp):
+def osm_timestamp(date):
+    """
+    Get a date as the timestamp Overpass queries data at
+    Args:
+        date - string, either YYYY-MM-DD or a full timestamp
+    Returns:
+        timestamp string, e.g. 2020-01-01T00:00:00Z
+    """
+    if len(date) == 10:
+        return date + 'T00:00:00Z'
+    return date
+
+
+def simple_get_roads(config, mapfp, cache_dir=None):
     """
     Use osmnx to get a simplified version of open street maps for the city
     Writes osm_nodes and osm_ways shapefiles to mapfp
     Args:
         config object
+        cache_dir - graph cache directory, see data.graph_cache, or None
+            to always download the graph
     Returns:
         None
         This function creates the following files
@@ -217,8 +345,13 @@ def simple_get_roads(config, mapfp):
     """
 
     ox.settings.useful_tags_way.append('cycleway')
-    G1 = get_graph(config)
-    G = ox.simplify_graph(G1)
+    if config.osm_date:
+        # Download the map as it was on the date
+        ox.settings.overpass_settings = \
+            '[out:json][timeout:{timeout}][date:"%s"]{maxsize}' % \
+            osm_timestamp(config.osm_date)
+    query, download = graph_query(config)
+    G1, G = graph_cache.get_graphs(query, download, cache_dir)
 
     # Label endpoints
     streets_per_node = ox.stats.count_streets_per_node(G)
@@ -238,19 +371,20 @@ def simple_get_roads(config, mapfp):
     intersections = gdf_nodes[gdf_nodes['dead_end'] == True]
 
     names = {'traffic_signals': 'signal', 'crossing': 'crosswalk'}
-    features = []
-    for _, row in node_feats.iterrows():
-        features.append(geojson.Feature(
-            geometry=geojson.Point((row['x'], row['y'])),
-            id=row.name,
-            properties={'feature': names[row['highway']]},
-        ))
-    for _, row in intersections.iterrows():
-        features.append(geojson.Feature(
-            geometry=geojson.Point((row['x'], row['y'])),
-            id=row.name,
-            properties={'feature': 'intersection'},
-        ))
+    feature_nodes = pd.concat([
+        node_feats.assign(feature=node_feats['highway'].map(names)),
+        intersections.assign(feature='intersection'),
+    ])
+    features = [
+        geojson.Feature(
+            geometry=geojson.Point((x, y)),
+            id=node_id,
+            properties={'feature': feature},
+        )
+        for node_id, x, y, feature in zip(
+            feature_nodes.index.tolist(), feature_nodes['x'].tolist(),
+            feature_nodes['y'].tolist(), feature_nodes['feature'].tolist())
+    ]
 
     features = geojson.FeatureCollection(features)
 
@@ -284,13 +418,33 @@ def clean_and_write(osm_graph_file,
     """
     cleaned_ways = clean_ways(osm_graph_file, DOC_FP)
 
-    nodes = fiona.open(osm_graph_file, layer='nodes')
+    with fiona.open(osm_graph_file, layer='nodes') as layer:
+        nodes = read_features(layer)
     nodes, cleaned_ways = get_connections(cleaned_ways, nodes)
 
     write_geojson(cleaned_ways, nodes,
                   result_file)
 
 
+def read_features(layer):
+    """
+    Read the features in a layer as plain dicts, which are much quicker
+    to get properties from and update than fiona's features
+    Args:
+        layer - open fiona collection
+    Returns:
+        list of dicts with the id, geometry and properties of each feature
+    """
+    return [{
+        'id': x.id,
+        'geometry': {
+            'type': x.geometry.type,
+            'coordinates': x.geometry.coordinates,
+        },
+        'properties': dict(x.properties),
+    } for x in layer]
+
+
 def get_connections(ways, nodes):
     """
     Populate the cross streets for each node,
@@ -302,46 +456,81 @@ def get_connections(ways, nodes):
         nodes - a dict containing the roads connected to each node
         ways - the ways, with a unique osmid-fromnode-to-node string
     """
-    node_info = {}
-    for way in ways:
-        # There are some collector roads and others that don't
-        # have names. Skip these
-        if way['properties']['name']:
-
-            # While we are still merging segments with different names,
-            # just use both roads. This should be revisited
-            if '[' in way['properties']['name']:
-                way['properties']['name'] = re.sub(
-                    r'[^\s\w,]|_', '', way['properties']['name'])
-                way['properties']['name'] = "/".join(
-                    way['properties']['name'].split(', '))
-
-            if way['properties']['from'] not in node_info.keys():
-                node_info[way['properties']['from']] = []
-            node_info[way['properties']['from']].append(
-                way['properties']['name'])
-
-            if way['properties']['to'] not in node_info.keys():
-                node_info[way['properties']['to']] = []
-            node_info[way['properties']['to']].append(
-                way['properties']['name'])
-
-        ident = str(way['properties']['osmid']) + '-' \
-            + str(way['properties']['from']) + '-' \
-            + str(way['properties']['to'])
+    props = pd.DataFrame({
+        key: pd.Series([x['properties'][key] for x in ways], dtype=object)
+        for key in ['name', 'osmid', 'from', 'to']})
+
+    # There are some collector roads and others that don't
+    # have names. Skip these
+    named = props['name'].astype(bool)
+
+    # While we are still merging segments with different names,
+    # just use both roads. This should be revisited
+    merged = named & props['name'].str.contains(
+        '[', regex=False, na=False).astype(bool)
+    props.loc[merged, 'name'] = map_values(
+        props['name'][merged], clean_merged_name)
+    for i, name in zip(np.flatnonzero(merged),
+                       props['name'][merged].tolist()):
+        ways[i]['properties']['name'] = name
+
+    # Each named way's name is added to both its ends' streets, in the
+    # order of the ways
+    ends = pd.DataFrame({
+        'node': np.column_stack([
+            props['from'][named], props['to'][named]]).ravel(),
+        'name': np.repeat(props['name'][named].to_numpy(), 2),
+    })
+    streets = ends.groupby('node', sort=False)['name'].agg(
+        lambda x: ', '.join(set(x)))
+    streets = dict(zip(streets.index.tolist(), streets.tolist()))
+
+    idents = props['osmid'].astype(str) + '-' \
+        + props['from'].astype(str) + '-' \
+        + props['to'].astype(str)
+    for way, ident in zip(ways, idents.tolist()):
         way['properties']['segment_id'] = ident
 
     nodes_with_streets = []
     for node in nodes:
-        if node['properties']['osmid'] in node_info:
-            node['properties']['streets'] = ', '.join(
-                set(node_info[node['properties']['osmid']]))
-        else:
-            node['properties']['streets'] = ''
+        node['properties']['streets'] = streets.get(
+            node['properties']['osmid'], '')
         nodes_with_streets.append(node)
     return nodes_with_streets, ways
 
 
+def clean_merged_name(name):
+    """
+    Make the name of ways merged together with different names, a list
+    of names like "['Main Street', 'Broadway']", into one name with
+    both, e.g. "Main Street/Broadway"
+    Args:
+        name - string
+    Returns:
+        string
+    """
+    return "/".join(re.sub(r'[^\s\w,]|_', '', name).split(', '))
+
+
+def map_values(values, parse):
+    """
+    Parse each of a column's values, parsing each distinct value only
+    once, since a map's ways share a few values of each property
+    Args:
+        values - pandas series
+        parse - function taking a value
+    Returns:
+        numpy array of the parsed values, in the column's order
+    """
+    codes, uniques = pd.factorize(values)
+    parsed = np.empty(len(uniques) + 1, dtype=object)
+    parsed[:-1] = [parse(x) for x in uniques]
+    # Missing values have code -1, so are parsed as None, the last value
+    if (codes < 0).any():
+        parsed[-1] = parse(None)
+    return parsed[codes]
+
+
 def write_keys(DOC_FP, name, keys):
     """
     Since we're creating numeric keys, we'd like to know what
@@ -402,6 +591,20 @@ def get_speed(speed):
     return 0
 
 
+def get_lanes(lanes):
+    """
+    Parse the number of lanes from the openstreetmap lanes property field
+    If there's more than one number (from merged ways), use the highest
+    Args:
+        lanes - a string
+    Returns:
+        lanes - an int
+    """
+    if lanes:
+        return max([int(x) for x in re.findall(r'\d', lanes)])
+    return 0
+
+
 def clean_ways(orig_file, DOC_FP):
     """
     Reads in osm gpkg file, cleans up the features, and reprojects
@@ -423,57 +626,65 @@ def clean_ways(orig_file, DOC_FP):
         a list of reprojected way lines
     """
 
-    way_lines = fiona.open(orig_file, layer='edges')
-
+    with fiona.open(orig_file, layer='edges') as layer:
+        fields = layer.schema['properties']
+        way_lines = read_features(layer)
+
+    def column(key):
+        return pd.Series([x['properties'][key] for x in way_lines],
+                         dtype=object)
+
+    speed = map_values(column('maxspeed'), get_speed).astype(int) \
+        if 'maxspeed' in fields else np.zeros(len(way_lines), dtype=int)
+    width = map_values(column('width'), get_width).astype(int) \
+        if 'width' in fields else np.zeros(len(way_lines), dtype=int)
+    lanes = map_values(column('lanes'), get_lanes).astype(int)
+
+    # All fields need to be int
+    # Make dicts for the fields that aren't to track the value
+    # Write these to file for lookup
+    # Highway types are numbered from 1 in the order they're first seen
+    highway_codes, highway_types = pd.factorize(column('highway'))
     highway_keys = {None: 0}
-    cycleway_keys = {}
-    results = []
+    highway_keys.update({x: i + 1 for i, x in enumerate(highway_types)})
 
-    for way_line in way_lines:
-
-        speed = get_speed(way_line['properties']['maxspeed']) \
-            if 'maxspeed' in list(way_line['properties']) else 0
-        width = get_width(way_line['properties']['width']) \
-            if 'width' in list(way_line['properties']) else 0
-
-        lanes = way_line['properties']['lanes']
-        if lanes:
-            lanes = max([int(x) for x in re.findall(r'\d', lanes)])
-        else:
-            lanes = 0
-
-        # All fields need to be int
-        # Make dicts for the fields that aren't to track the value
-        # Write these to file for lookup
-        if way_line['properties']['highway'] not in list(highway_keys.keys()):
-            highway_keys[way_line['properties']['highway']] = len(highway_keys)
-        if 'cycleway' in way_line['properties'] and \
-           way_line['properties']['cycleway'] and \
-           way_line['properties']['cycleway'] not in list(cycleway_keys.keys()):
-            cycleway_keys[way_line['properties']['cycleway']] = len(cycleway_keys)
-
-        # Width per lane
-        width_per_lane = 0
-        if lanes and width:
-            width_per_lane = round(width/lanes)
-
-        # Use oneway
-        oneway = 0
-        if way_line['properties']['oneway'] == 'True':
-            oneway = 1
+    # and cycleway types from 0, with ways that don't have one 0 as well
+    cycleway_type = np.zeros(len(way_lines), dtype=int)
+    cycleway_keys = {}
+    if 'cycleway' in fields:
+        cycleways = column('cycleway')
+        has_cycleway = cycleways.astype(bool).to_numpy()
+        cycleway_codes, cycleway_types = pd.factorize(
+            cycleways[has_cycleway])
+        cycleway_type[has_cycleway] = cycleway_codes
+        cycleway_keys = {x: i for i, x in enumerate(cycleway_types)}
+
+    # Width per lane
+    width_per_lane = np.zeros(len(way_lines), dtype=int)
+    has_both = (lanes > 0) & (width > 0)
+    width_per_lane[has_both] = np.round(
+        width[has_both] / lanes[has_both]).astype(int)
+
+    # Use oneway
+    oneway = (column('oneway') == 'True').astype(int)
 
+    results = []
+    columns = zip(
+        width.tolist(), lanes.tolist(), (highway_codes + 1).tolist(),
+        cycleway_type.tolist(), speed.tolist(), oneway.tolist(),
+        width_per_lane.tolist())
+    for way_line, (way_width, way_lanes, hwy_type, way_cycleway_type,
+                   way_speed, way_oneway, way_width_per_lane) in zip(
+                       way_lines, columns):
         way_line['properties'].update({
-            'width': width,
-            'lanes': int(lanes),
-            'hwy_type': highway_keys[way_line['properties']['highway']],
-            'cycleway_type': cycleway_keys[way_line['properties']['cycleway']]
-                if 'cycleway' in way_line['properties'] and \
-                    way_line['properties']['cycleway']
-                else 0,
-            'osm_speed': speed,
+            'width': way_width,
+            'lanes': way_lanes,
+            'hwy_type': hwy_type,
+            'cycleway_type': way_cycleway_type,
+            'osm_speed': way_speed,
             'signal': 0,
-            'oneway': oneway,
-            'width_per_lane': width_per_lane
+            'oneway': way_oneway,
+            'width_per_lane': way_width_per_lane
         })
         results.append(way_line)
 
@@ -487,7 +698,14 @@ def write_geojson(way_results, node_results, outfp):
     Given a list of ways, intersection nodes, and all nodes, write them
     out to a geojson file.
     """
-    feats = way_results
+    # Properties without a value are left out, as they are when
+    # writing fiona's features
+    feats = [geojson.Feature(
+        id=way['id'],
+        geometry=way['geometry'],
+        properties={k: v for k, v in way['properties'].items()
+                    if v is not None},
+    ) for way in way_results]
 
     for node in node_results:
         if not node['properties']['dead_end']:
@@ -504,7 +722,9 @@ def write_geojson(way_results, node_results, outfp):
         geojson.dump(feat_collection, outfile)
 
 
-if __name__ == '__main__':
+def main(args=None):
+    global MAP_FP, STANDARDIZED_FP, RAW_FP
+
     parser = argparse.ArgumentParser()
     parser.add_argument("-c", "--config", type=str, required=True,
                         help="Config file")
@@ -513,20 +733,26 @@ if __name__ == '__main__':
     # Can force update
     parser.add_argument('--forceupdate', action='store_true',
                         help='Whether to force update the maps')
+    parser.add_argument('--cachedir', type=str,
+                        help='Directory to cache road graphs in, shared ' +
+                        'by every city. Defaults to .osm_graph_cache ' +
+                        'in the directory above the data directory')
 
-    args = parser.parse_args()
+    args = parser.parse_args(args)
 
     config = data.config.Configuration(args.config)
     MAP_FP = os.path.join(args.datadir, 'processed/maps')
     DOC_FP = os.path.join(args.datadir, 'docs')
     STANDARDIZED_FP = os.path.join(args.datadir, 'standardized')
     RAW_FP = os.path.join(args.datadir, 'raw')
+    cache_dir = args.cachedir or os.path.join(os.path.dirname(
+        os.path.abspath(args.datadir)), '.osm_graph_cache')
 
     # If maps do not exist, create
     if not os.path.exists(os.path.join(MAP_FP, 'osm.gpkg')) \
        or args.forceupdate:
         print('Generating map from open street map...')
-        simple_get_roads(config, MAP_FP)
+        simple_get_roads(config, MAP_FP, cache_dir)
 
     if not os.path.exists(os.path.join(MAP_FP, 'osm_elements.geojson')) \
        or args.forceupdate:
@@ -538,3 +764,6 @@ if __name__ == '__main__':
             DOC_FP
         )
 
+
+if __name__ == '__main__':
+    main()
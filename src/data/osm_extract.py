@@ -0,0 +1,291 @@
+"""
+Making the road graph from a downloaded open street map extract, rather
+than from the Overpass API, for machines that can't reach it.
+
+An extract (a .osm.pbf file, or .osm xml, optionally compressed with
+bz2 or gzip) can cover much more than the city, e.g. a whole state. It's
+streamed through once. Nodes within 500 meters of the city boundary are
+kept as they go by. After them come the ways, and the ones kept are the
+ways osmnx would include in a drive network that have a kept node.
+So only the city's part of the extract is held in memory. Extracts have
+to list their nodes before their ways, as Geofabrik's and osmium's do.
+
+The kept nodes and ways are written to a small .osm file and read with
+osmnx.graph_from_xml. The graph is then truncated to the boundary, the
+way osmnx.graph_from_polygon does with a downloaded one, so the graph
+is the same one downloading would give. The nodes of kept ways that are
+outside the boundary are written at 0, 0. They're only needed so the
+ways can be read, and truncating removes them.
+
+Reading .pbf files needs pyosmium, which is optional
+"""
+import bz2
+import gzip
+import os
+import re
+import tempfile
+import xml.etree.ElementTree as ElementTree
+from xml.sax.saxutils import quoteattr
+import networkx as nx
+import numpy as np
+import osmnx as ox
+import shapely
+try:
+    import osmium
+except ImportError:
+    osmium = None
+
+# Distance in meters around the boundary that roads are read for, so
+# streets are counted correctly at intersections on the boundary
+PERIPHERY = 500
+
+# Number of nodes checked against the boundary at once
+BATCH_SIZE = 100000
+
+# The ways osmnx includes in a drive network, in Overpass filter syntax
+DRIVE_FILTER = (
+    '["highway"]["area"!~"yes"]' + ox.settings.default_access +
+    '["highway"!~"abandoned|bridleway|bus_guideway|construction|corridor|'
+    'cycleway|elevator|escalator|footway|no|path|pedestrian|planned|'
+    'platform|proposed|raceway|razed|service|steps|track"]'
+    '["motor_vehicle"!~"no"]["motorcar"!~"no"]'
+    '["service"!~"alley|driveway|emergency_access|parking|parking_aisle|'
+    'private"]'
+)
+
+
+def parse_filter(osm_filter):
+    """
+    Parse an Overpass way filter made of ["key"] and ["key"!~"regex"]
+    clauses, the kinds osmnx's network filters use
+    Args:
+        osm_filter - filter string
+    Returns:
+        list of tuples of key and compiled regex, or None if the
+        clause only requires the key
+    """
+    clauses = []
+    for key, regex in re.findall(
+            r'\["([^"]+)"(?:!~"([^"]*)")?\]', osm_filter):
+        clauses.append((key, re.compile(regex) if regex else None))
+    return clauses
+
+
+def matches_filter(tags, clauses):
+    """
+    Check whether a way's tags pass a filter
+    Args:
+        tags - dict of the way's tags
+        clauses - parsed filter, from parse_filter
+    Returns:
+        True or False
+    """
+    for key, regex in clauses:
+        if regex is None:
+            if key not in tags:
+                return False
+        elif key in tags and regex.search(tags[key]):
+            return False
+    return True
+
+
+def _open(filename):
+    if filename.endswith('.bz2'):
+        return bz2.open(filename, 'rb')
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rb')
+    return open(filename, 'rb')
+
+
+def _iter_xml(filename):
+    """
+    Stream the nodes and ways from an .osm xml file, clearing each
+    element once it's read so the document isn't built up in memory
+    """
+    with _open(filename) as f:
+        events = ElementTree.iterparse(f, events=('start', 'end'))
+        _, root = next(events)
+        for event, elem in events:
+            if event != 'end':
+                continue
+            if elem.tag == 'node':
+                yield ('node', int(elem.get('id')), float(elem.get('lon')),
+                       float(elem.get('lat')),
+                       {x.get('k'): x.get('v') for x in elem.iter('tag')})
+            elif elem.tag == 'way':
+                yield ('way', int(elem.get('id')),
+                       [int(x.get('ref')) for x in elem.iter('nd')],
+                       {x.get('k'): x.get('v') for x in elem.iter('tag')})
+            elif elem.tag != 'relation':
+                continue
+            root.clear()
+
+
+def _iter_pbf(filename):
+    """
+    Stream the nodes and ways from an .osm.pbf file with pyosmium
+    """
+    if osmium is None or not hasattr(osmium, 'FileProcessor'):
+        raise SystemExit(
+            "pyosmium 3.7 or later is needed to read {}, ".format(filename) +
+            "install it or use an .osm extract")
+    for obj in osmium.FileProcessor(filename):
+        if obj.is_node():
+            if obj.location.valid():
+                yield ('node', obj.id, obj.location.lon, obj.location.lat,
+                       {x.k: x.v for x in obj.tags})
+        elif obj.is_way():
+            yield ('way', obj.id, [x.ref for x in obj.nodes],
+                   {x.k: x.v for x in obj.tags})
+
+
+def iter_elements(filename):
+    """
+    Stream the nodes and ways from an extract, in the order they're in
+    Args:
+        filename - .osm.pbf or .osm file, which can be bz2 or gzip
+            compressed
+    Yields:
+        ('node', id, lon, lat, tags) and ('way', id, node ids, tags)
+    """
+    if filename.endswith('.pbf'):
+        return _iter_pbf(filename)
+    return _iter_xml(filename)
+
+
+def read_extract(filename, boundary, osm_filter=DRIVE_FILTER):
+    """
+    Read the nodes and ways for a boundary out of an extract
+    Args:
+        filename - extract file, see iter_elements
+        boundary - polygon in 4326 projection
+        osm_filter - Overpass filter for the ways to keep
+    Returns:
+        dict of the kept nodes' lon, lat and tags, by id,
+        and list of tuples of the kept ways' ids, node ids and tags
+    """
+    clauses = parse_filter(osm_filter)
+    node_tags = set(ox.settings.useful_tags_node)
+    way_tags = set(ox.settings.useful_tags_way)
+    shapely.prepare(boundary)
+    minx, miny, maxx, maxy = boundary.bounds
+
+    nodes = {}
+    ways = []
+    batch = []
+
+    def add_nodes():
+        # Keep the nodes in the batch that are within the boundary
+        coords = np.array([(x[0], x[1]) for x in batch], dtype=float)
+        inside = (coords[:, 0] >= minx) & (coords[:, 0] <= maxx) \
+            & (coords[:, 1] >= miny) & (coords[:, 1] <= maxy)
+        inside[inside] = shapely.intersects_xy(
+            boundary, coords[inside, 0], coords[inside, 1])
+        for i in np.flatnonzero(inside):
+            lon, lat, node_id, tags = batch[i]
+            nodes[node_id] = (lon, lat, {
+                k: v for k, v in tags.items() if k in node_tags})
+        del batch[:]
+
+    count = 0
+    reading_ways = False
+    for element in iter_elements(filename):
+        count += 1
+        if count % 1000000 == 0:
+            print("Read {} elements, kept {} nodes and {} ways".format(
+                count, len(nodes), len(ways)))
+        if element[0] == 'node':
+            if reading_ways:
+                raise SystemExit(
+                    "{} doesn't list its nodes before its ways, ".format(
+                        filename) + "sort it with osmium sort first")
+            _, node_id, lon, lat, tags = element
+            batch.append((lon, lat, node_id, tags))
+            if len(batch) >= BATCH_SIZE:
+                add_nodes()
+        else:
+            if batch:
+                add_nodes()
+            reading_ways = True
+            _, way_id, refs, tags = element
+            if matches_filter(tags, clauses) \
+                    and any(x in nodes for x in refs):
+                ways.append((way_id, refs, {
+                    k: v for k, v in tags.items() if k in way_tags}))
+    if batch:
+        add_nodes()
+    return nodes, ways
+
+
+def write_osm(nodes, ways, filename):
+    """
+    Write nodes and ways to an .osm xml file. Nodes the ways go
+    through that aren't in nodes are written at 0, 0
+    Args:
+        nodes - dict of lon, lat and tags by id
+        ways - list of tuples of id, node ids and tags
+        filename
+    """
+    def tag_lines(tags):
+        return ''.join('  <tag k={} v={}/>\n'.format(
+            quoteattr(k), quoteattr(v)) for k, v in tags.items())
+
+    with open(filename, 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        f.write('<osm version="0.6">\n')
+        written = set()
+        for _, refs, _ in ways:
+            for ref in refs:
+                if ref in written:
+                    continue
+                written.add(ref)
+                lon, lat, tags = nodes.get(ref, (0, 0, {}))
+                f.write(' <node id="{}" lat="{!r}" lon="{!r}">\n'.format(
+                    ref, lat, lon))
+                f.write(tag_lines(tags))
+                f.write(' </node>\n')
+        for way_id, refs, tags in ways:
+            f.write(' <way id="{}">\n'.format(way_id))
+            f.write(''.join('  <nd ref="{}"/>\n'.format(x) for x in refs))
+            f.write(tag_lines(tags))
+            f.write(' </way>\n')
+        f.write('</osm>\n')
+
+
+def graph_from_extract(filename, boundary):
+    """
+    Make the drive network graph within a boundary from an extract,
+    as osmnx.graph_from_polygon(boundary, network_type='drive',
+    simplify=False) would from Overpass
+    Args:
+        filename - extract file, see iter_elements
+        boundary - polygon or multipolygon in 4326 projection
+    Returns:
+        osmnx graph object
+    """
+    # Roads are read for a little way past the boundary
+    boundary_utm, crs_utm = ox.projection.project_geometry(boundary)
+    buffered, _ = ox.projection.project_geometry(
+        boundary_utm.buffer(PERIPHERY), crs=crs_utm, to_latlong=True)
+
+    print("Reading roads from " + filename)
+    nodes, ways = read_extract(filename, buffered)
+    print("Kept {} nodes and {} ways".format(len(nodes), len(ways)))
+    if not ways:
+        raise SystemExit("No roads found in {} within the city".format(
+            filename))
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        osm_file = os.path.join(tmpdir, 'city.osm')
+        write_osm(nodes, ways, osm_file)
+        G_buff = ox.graph_from_xml(osm_file, simplify=False, retain_all=True)
+
+    G_buff = ox.truncate.truncate_graph_polygon(
+        G_buff, buffered, retain_all=True)
+    G = ox.truncate.truncate_graph_polygon(G_buff, boundary)
+
+    # Streets are counted in the buffered graph, so intersections on
+    # the boundary are counted with the streets going out of it
+    nx.set_node_attributes(G, values=ox.stats.count_streets_per_node(
+        G_buff, nodes=G.nodes), name='street_count')
+    return G
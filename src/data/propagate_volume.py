@@ -1,7 +1,7 @@
 import json
 import os
-import rtree
 import argparse
+from . import geometry
 from . import util
 from .record import Record
 import numpy as np
@@ -9,7 +9,6 @@ import pandas as pd
 from pandas import json_normalize
 import geopandas as gpd
 from sklearn.neighbors import KNeighborsRegressor
-import sys
 
 
 BASE_DIR = os.path.dirname(
@@ -100,7 +99,10 @@ def propagate_volume():
     Returns:
         None - writes results to file
     """
-    # Read in segments
+    # Read in segments, and write what's derived from them
+    # in the same format
+    fmt = util.columnar.stored_format(os.path.join(
+        PROCESSED_DATA_FP, 'maps', 'inters_segments.geojson'))
     inter = util.read_geojson(os.path.join(
         PROCESSED_DATA_FP, 'maps', 'inters_segments.geojson'))
     non_inter = util.read_geojson(
@@ -111,12 +113,9 @@ def propagate_volume():
     # Combine inter + non_inter
     combined_seg = inter + non_inter
 
-    # # Create spatial index for quick lookup
-    segments_index = rtree.index.Index()
-    for idx, element in enumerate(combined_seg):
-        segments_index.insert(idx, element.geometry.bounds)
-
-    print('Created spatial index')
+    # Open the map's spatial index, built when the segments were written
+    segments_index = util.open_segments_index(
+        os.path.join(PROCESSED_DATA_FP, 'maps'), combined_seg)
 
     volume = read_volume()
 
@@ -126,8 +125,9 @@ def propagate_volume():
 
     # Should deprecate once imputed atrs are used, but for the moment
     # this is needed for make_canon_dataset
-    with open(os.path.join(PROCESSED_DATA_FP, 'snapped_atrs.json'), 'w') as f:
-        json.dump([x['properties'] for x in volume], f)
+    util.write_json_records(
+        [x['properties'] for x in volume],
+        os.path.join(PROCESSED_DATA_FP, 'snapped_atrs.json'), fmt)
 
     volume_df = json_normalize(volume)
     
@@ -180,12 +180,13 @@ def propagate_volume():
     seg_df = pd.concat([seg_df['geometry'], seg_df.seg_id.apply(
         pd.Series)['id']], axis=1)
 
-    # change to geo df for centroid method
+    # change to geo df
     seg_gdf = gpd.GeoDataFrame(seg_df['id'], geometry=seg_df['geometry'])
 
     # create two columns for x and y of centroid of segment
-    seg_gdf['px'] = seg_gdf.geometry.centroid.apply(lambda p: p.x)
-    seg_gdf['py'] = seg_gdf.geometry.centroid.apply(lambda p: p.y)
+    centroids = geometry.centroids(seg_df['geometry'])
+    seg_gdf['px'] = centroids[:, 0]
+    seg_gdf['py'] = centroids[:, 1]
     
     # merge atrs and seg_gdf
     merged_df = pd.merge(seg_gdf, volume_df, on='id', how='left')
@@ -243,7 +244,8 @@ def propagate_volume():
     )
 
 
-if __name__ == '__main__':
+def main(args=None):
+    global PROCESSED_DATA_FP, STANDARDIZED_DATA_FP
 
     parser = argparse.ArgumentParser()
     parser.add_argument("-d", "--datadir", type=str,
@@ -252,15 +254,17 @@ if __name__ == '__main__':
     parser.add_argument('--forceupdate', action='store_true',
                         help='Whether force update the maps')
 
-    args = parser.parse_args()
+    args = parser.parse_args(args)
     if args.datadir:
         PROCESSED_DATA_FP = os.path.join(args.datadir, 'processed')
         STANDARDIZED_DATA_FP = os.path.join(args.datadir, 'standardized')
 
     if not os.path.exists(os.path.join(STANDARDIZED_DATA_FP, 'volume.json')):
         print("No volumes found, skipping...")
-        sys.exit()
+        return
 
     propagate_volume()
 
 
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,6 @@
+import datetime
+import numpy as np
+import shapely
 from pyproj import Transformer
 from . import util
 from dateutil.parser import parse
@@ -46,10 +49,253 @@ class Record(object):
 
 
 class Crash(Record):
-    def __init__(self, properties):
-        Record.__init__(self, properties)
+    def __init__(self, properties, point=None):
+        Record.__init__(self, properties, point)
 
     @property
     def timestamp(self):
         return parse(self.properties['dateOccurred'])
 
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+_MICROSECOND = datetime.timedelta(microseconds=1)
+
+
+def parse_timestamp(value):
+    """
+    Parse a date string, trying the much faster iso format parser first
+    """
+    try:
+        return datetime.datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return parse(value)
+
+
+class RecordBatch(object):
+    """
+    A batch of records, stored column by column: numpy arrays of their
+    points in 3857 projection, their 4326 longitude and latitude, their
+    timestamps (crashes only), their near_ids, and flags for whether they
+    have each split column, plus a side table of their property dicts.
+
+    Timestamps are stored as the local time they were given in, with the
+    offset from UTC (nan if they were given without a time zone), so each
+    date is only parsed once.
+
+    Indexing or iterating over a batch gives objects with the same API
+    as Record and Crash, backed by the batch's columns
+    """
+
+    def __init__(self, properties, x, y, longitude, latitude,
+                 record_type=None, near_ids=None, timestamps=None,
+                 utc_offsets=None, flags=None):
+        self.properties = properties
+        self.x = x
+        self.y = y
+        self.longitude = longitude
+        self.latitude = latitude
+        self.record_type = record_type
+        if near_ids is None:
+            near_ids = np.array(
+                [x.get('near_id') for x in properties], dtype=object)
+        self.near_ids = near_ids
+        self.timestamps = timestamps
+        self.utc_offsets = utc_offsets
+        self.flags = flags or {}
+
+    @classmethod
+    def from_items(cls, items, record_type, split_columns=[]):
+        """
+        Make a batch out of a list of dicts with a location,
+        reprojecting all of their points at once
+        Args:
+            items - list of dicts
+            record_type - 'crash' for crashes, whose dateOccurred are
+                parsed into timestamps, otherwise records
+            split_columns - properties to keep flags for
+        Returns:
+            RecordBatch
+        """
+        longitude = np.array(
+            [x['location']['longitude'] for x in items], dtype=float)
+        latitude = np.array(
+            [x['location']['latitude'] for x in items], dtype=float)
+        x, y = util.transform_coords(
+            longitude, latitude, transformer_4326_to_3857)
+
+        timestamps = utc_offsets = None
+        if record_type == 'crash':
+            parsed = [parse_timestamp(x['dateOccurred']) for x in items]
+            # Much faster than numpy converting the datetimes itself
+            timestamps = np.array(
+                [(x.replace(tzinfo=None) - _EPOCH) // _MICROSECOND
+                 for x in parsed], dtype=np.int64).view('datetime64[us]')
+            utc_offsets = np.array(
+                [x.utcoffset().total_seconds() if x.tzinfo else np.nan
+                 for x in parsed], dtype=float)
+
+        flags = {column: np.array([column in x for x in items], dtype=bool)
+                 for column in split_columns}
+        return cls(list(items), np.asarray(x, dtype=float),
+                   np.asarray(y, dtype=float), longitude, latitude,
+                   record_type=record_type, timestamps=timestamps,
+                   utc_offsets=utc_offsets, flags=flags)
+
+    @classmethod
+    def concatenate(cls, batches, record_type=None, split_columns=[]):
+        """
+        Join a list of batches of the same record type into one
+        """
+        if not batches:
+            return cls.from_items([], record_type, split_columns)
+
+        def join(name):
+            values = [getattr(x, name) for x in batches]
+            return None if values[0] is None else np.concatenate(values)
+
+        return cls(
+            [x for batch in batches for x in batch.properties],
+            join('x'), join('y'), join('longitude'), join('latitude'),
+            record_type=batches[0].record_type,
+            near_ids=join('near_ids'),
+            timestamps=join('timestamps'),
+            utc_offsets=join('utc_offsets'),
+            flags={column: np.concatenate([x.flags[column] for x in batches])
+                   for column in batches[0].flags})
+
+    def __len__(self):
+        return len(self.properties)
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            if index < 0:
+                index += len(self)
+            if not 0 <= index < len(self):
+                raise IndexError("record index out of range")
+            return BatchRecord(self, index)
+        return self.take(index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield BatchRecord(self, index)
+
+    def take(self, index):
+        """
+        Get a new batch of some of the records
+        Args:
+            index - slice, boolean mask or array of positions
+        Returns:
+            RecordBatch
+        """
+        positions = np.arange(len(self))[index]
+
+        def take(values):
+            return None if values is None else values[positions]
+
+        return RecordBatch(
+            [self.properties[x] for x in positions],
+            self.x[positions], self.y[positions],
+            self.longitude[positions], self.latitude[positions],
+            record_type=self.record_type,
+            near_ids=self.near_ids[positions],
+            timestamps=take(self.timestamps),
+            utc_offsets=take(self.utc_offsets),
+            flags={k: v[positions] for k, v in self.flags.items()})
+
+    @property
+    def coords(self):
+        "Array of x, y coordinates in 3857 projection, one row per record"
+        return np.column_stack([self.x, self.y])
+
+    @property
+    def points(self):
+        "Array of shapely points in 3857 projection"
+        return shapely.points(self.x, self.y)
+
+    def in_range(self, start=None, end=None):
+        """
+        Get which crashes happened in a date range. A date given without
+        a time zone is taken to be in each crash's local time
+        Args:
+            start - datetime, crashes at or after which are included
+            end - datetime, crashes before which are included
+        Returns:
+            boolean array
+        """
+        mask = np.ones(len(self), dtype=bool)
+        for date, after in ((start, True), (end, False)):
+            if date is None:
+                continue
+            timestamps = self.timestamps
+            if date.tzinfo is not None:
+                # Compare in UTC, taking crashes without a time zone as UTC
+                offsets = np.nan_to_num(self.utc_offsets)
+                timestamps = timestamps - (offsets * 1e6).astype(
+                    'timedelta64[us]')
+                date = date.astimezone(
+                    datetime.timezone.utc).replace(tzinfo=None)
+            date = np.datetime64(date, 'us')
+            mask &= (timestamps >= date) if after else (timestamps < date)
+        return mask
+
+    def timestamp(self, index):
+        """
+        Get a crash's timestamp as a datetime, with its time zone
+        if it was given one
+        """
+        timestamp = self.timestamps[index].astype(datetime.datetime)
+        offset = self.utc_offsets[index]
+        if np.isnan(offset):
+            return timestamp
+        return timestamp.replace(tzinfo=datetime.timezone(
+            datetime.timedelta(seconds=float(offset))))
+
+    def iter_properties(self, mask=None):
+        """
+        Get the records' property dicts, with their near_ids
+        Args:
+            mask - optional boolean array of which records to get
+        Yields:
+            dicts
+        """
+        for index in range(len(self)):
+            if mask is None or mask[index]:
+                yield BatchRecord(self, index).properties
+
+
+class BatchRecord(Record):
+    """
+    One record in a RecordBatch, with the same API as Record (and Crash,
+    for crashes), reading from and writing to the batch's columns
+    """
+
+    def __init__(self, batch, index):
+        self.batch = batch
+        self.index = index
+
+    @property
+    def point(self):
+        return shapely.Point(self.batch.x[self.index],
+                             self.batch.y[self.index])
+
+    @property
+    def properties(self):
+        properties = self.batch.properties[self.index]
+        near_id = self.batch.near_ids[self.index]
+        if near_id is not None:
+            properties['near_id'] = near_id
+        return properties
+
+    def _get_near_id(self):
+        return self.batch.near_ids[self.index]
+
+    def _set_near_id(self, near_id):
+        self.batch.near_ids[self.index] = near_id
+
+    near_id = property(_get_near_id, _set_near_id)
+
+    @property
+    def timestamp(self):
+        if self.batch.timestamps is not None:
+            return self.batch.timestamp(self.index)
+        return self.batch.properties[self.index].get('timestamp', '')
@@ -0,0 +1,218 @@
+"""
+Snapping many points to their nearest segments at once.
+
+A point's candidate segments are those whose bounding box intersects
+the box within tolerance of the point, the same candidates an rtree
+query on the point's buffer gives. Candidates for a whole batch of
+points are found with one query on a packed STRtree, and their
+distances are computed together. Of the candidates, the nearest
+is chosen; when several are equally near, the one earliest in the list
+of segments is, the first that was inserted into the segments' rtree
+index. So ties are broken the same way whether the index was built
+one segment at a time, bulk loaded or read from disk, and whatever
+order a query on it returns them in.
+
+Large batches can be split into chunks and snapped on a pool of
+processes. The workers are forked, so they share the parent's segments
+and indexes rather than each being sent a copy.
+
+Where each crash snapped to can be kept in a snap cache between runs,
+so only new or moved crashes have to be snapped again. The cache is
+only valid for the map and tolerance it was made with.
+"""
+import concurrent.futures
+import hashlib
+import json
+import multiprocessing
+import os
+import numpy as np
+import shapely
+
+# Number of points a worker process snaps at a time
+CHUNK_SIZE = 5000
+
+# Trees that pools of worker processes are snapping to, by pool. A pool's
+# workers are forked after its tree is added, so they can find it here
+_shared_trees = {}
+
+
+class SegmentTree(object):
+    """
+    A packed spatial index over a list of segments,
+    for finding the nearest segments to many points at once
+    """
+
+    def __init__(self, segments):
+        """
+        Args:
+            segments - list of Segments
+        """
+        self.geometries = np.array(
+            [x.geometry for x in segments], dtype=object)
+        self.tree = shapely.STRtree(self.geometries)
+
+    def __len__(self):
+        return len(self.geometries)
+
+    def nearest(self, coords, tolerance):
+        """
+        Find the nearest segment to each point
+        Args:
+            coords - array of x, y coordinates, one row per point
+            tolerance - distance from a point that a segment's bounding
+                box has to come within for the segment to be considered
+        Returns:
+            array with the position of each point's nearest segment in
+            the list of segments, or -1 if there isn't one, and array of
+            the distances to them (nan if there isn't one)
+        """
+        coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+        nearest = np.full(len(coords), -1, dtype=np.int64)
+        distances = np.full(len(coords), np.nan)
+        if not len(coords) or not len(self):
+            return nearest, distances
+
+        boxes = shapely.box(
+            coords[:, 0] - tolerance, coords[:, 1] - tolerance,
+            coords[:, 0] + tolerance, coords[:, 1] + tolerance)
+        point_ids, segment_ids = self.tree.query(boxes)
+        if not len(point_ids):
+            return nearest, distances
+
+        candidate_distances = shapely.distance(
+            shapely.points(coords[point_ids]), self.geometries[segment_ids])
+
+        # Sort the candidates by point, then distance, then position in
+        # the list, so each point's nearest candidate comes first, and of
+        # equally near ones, the earliest
+        order = np.lexsort((segment_ids, candidate_distances, point_ids))
+        point_ids = point_ids[order]
+        segment_ids = segment_ids[order]
+        candidate_distances = candidate_distances[order]
+        first = np.ones(len(point_ids), dtype=bool)
+        first[1:] = point_ids[1:] != point_ids[:-1]
+
+        nearest[point_ids[first]] = segment_ids[first]
+        distances[point_ids[first]] = candidate_distances[first]
+
+        return nearest, distances
+
+
+def _nearest_chunk(pool_id, coords, tolerance):
+    # Runs in a worker process
+    return _shared_trees[pool_id].nearest(coords, tolerance)
+
+
+class SnapPool(object):
+    """
+    Snaps points to a SegmentTree's segments on a pool of processes,
+    a chunk of points per process at a time. Has the same nearest method
+    as SegmentTree, and gives the same results in the same order
+    """
+
+    def __init__(self, tree, workers, chunk_size=CHUNK_SIZE):
+        """
+        Args:
+            tree - SegmentTree
+            workers - number of processes; if 1, or if processes can't be
+                forked on this platform, points are snapped in this one
+            chunk_size - number of points each process snaps at a time
+        """
+        self.tree = tree
+        self.chunk_size = chunk_size
+        self.executor = None
+        if workers and workers > 1:
+            if 'fork' in multiprocessing.get_all_start_methods():
+                _shared_trees[id(self)] = tree
+                self.executor = concurrent.futures.ProcessPoolExecutor(
+                    workers, mp_context=multiprocessing.get_context('fork'))
+            else:
+                print("Can't fork worker processes, snapping in one process")
+
+    def __len__(self):
+        return len(self.tree)
+
+    def nearest(self, coords, tolerance):
+        """
+        Find the nearest segment to each point, see SegmentTree.nearest
+        """
+        coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+        if self.executor is None or len(coords) <= self.chunk_size:
+            return self.tree.nearest(coords, tolerance)
+
+        chunks = [coords[i:i + self.chunk_size]
+                  for i in range(0, len(coords), self.chunk_size)]
+        results = list(self.executor.map(
+            _nearest_chunk, [id(self)] * len(chunks), chunks,
+            [tolerance] * len(chunks)))
+        return (np.concatenate([x[0] for x in results]),
+                np.concatenate([x[1] for x in results]))
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+            del _shared_trees[id(self)]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def location_hash(location):
+    """
+    Hash a record's latitude and longitude, to tell if it has moved
+    Args:
+        location - dict with latitude and longitude
+    Returns:
+        hex digest string
+    """
+    return hashlib.sha1('{!r},{!r}'.format(
+        location['latitude'], location['longitude']).encode()).hexdigest()
+
+
+def read_snap_cache(filename, fingerprint, tolerance):
+    """
+    Read a snap cache written by write_snap_cache. It's empty if the file
+    doesn't exist, or was made for a different map or tolerance
+    Args:
+        filename
+        fingerprint - hash of the map's segment files, from
+            util.segments_fingerprint
+        tolerance - tolerance the records are being snapped with
+    Returns:
+        dict of record id to list of location hash, near_id and distance
+        (None if the record didn't snap to a segment)
+    """
+    if not os.path.exists(filename):
+        return {}
+    with open(filename) as f:
+        cache = json.load(f)
+    if cache.get('fingerprint') != fingerprint \
+            or cache.get('tolerance') != tolerance:
+        print("Segments have changed since crashes were last snapped, " +
+              "snapping all of them")
+        return {}
+    return cache['records']
+
+
+def write_snap_cache(records, filename, fingerprint, tolerance):
+    """
+    Write a snap cache, replacing any that's there
+    Args:
+        records - dict of record id to list of location hash,
+            near_id and distance
+        filename
+        fingerprint - hash of the map's segment files
+        tolerance
+    """
+    tmp_file = '{}_{}'.format(filename, os.getpid())
+    with open(tmp_file, 'w') as f:
+        json.dump({
+            'fingerprint': fingerprint,
+            'tolerance': tolerance,
+            'records': records,
+        }, f)
+    os.replace(tmp_file, filename)
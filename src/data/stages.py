@@ -0,0 +1,623 @@
+import concurrent.futures
+import datetime
+import hashlib
+import importlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import yaml
+try:
+    import resource
+except ImportError:
+    # Not available on windows, where peak memory isn't recorded
+    resource = None
+
+# Every step of the pipeline, mapped to the module that implements it.
+# Each of these modules has a main(args) function taking the same
+# command line arguments as running it with python -m
+STAGES = {
+    'standardize_crashes': 'data_standardization.standardize_crashes',
+    'standardize_volume': 'data_standardization.standardize_volume',
+    'standardize_point_data': 'data_standardization.standardize_point_data',
+    'standardize_waze_data': 'data_standardization.standardize_waze_data',
+    'make_dataset': 'data.make_dataset',
+    'osm_create_maps': 'data.osm_create_maps',
+    'add_waze_data': 'data.add_waze_data',
+    'create_segments': 'data.create_segments',
+    'extract_intersections': 'data.extract_intersections',
+    'add_map': 'data.add_map',
+    'join_segments_crash': 'data.join_segments_crash',
+    'propagate_volume': 'data.propagate_volume',
+    'parse_tmc': 'data.TMC_scraping.parse_tmc',
+    'make_canon_dataset': 'features.make_canon_dataset',
+    'train_model': 'models.train_model',
+    'make_preds_viz': 'data.make_preds_viz',
+}
+
+MANIFEST_FILE = 'build_manifest.json'
+# Each pipeline invocation writes a run manifest to this directory
+# in the city's data directory
+RUNS_DIR = 'runs'
+# Environment variable telling a stage run in its own process
+# where to write the counts it reports
+COUNTS_ENV_VAR = 'PIPELINE_COUNTS_FILE'
+
+# Config file keys that stages depend on, grouped by what they affect
+MAP_CONFIG_KEYS = [
+    'city', 'city_latitude', 'city_longitude', 'city_radius',
+    'map_geography', 'boundary_shapefile', 'osm_extract', 'osm_date']
+CRASH_CONFIG_KEYS = ['crashes_files', 'timezone', 'startdate', 'enddate']
+STORAGE_CONFIG_KEYS = ['intermediate_format']
+SEGMENT_CONFIG_KEYS = ['segmentation']
+FEATURE_CONFIG_KEYS = [
+    'openstreetmap_features', 'waze_features', 'additional_map_features',
+    'data_source', 'atr', 'atr_cols', 'tmc', 'tmc_cols', 'speed_limit']
+
+
+# Counts reported by the stage that's currently running
+_counts = {}
+
+
+def report_count(name, value):
+    """
+    Record a count for the stage that's currently running,
+    e.g. the number of crashes read, to go in the run manifest
+    Args:
+        name - name of the count, e.g. crashes_read
+        value - integer
+    """
+    _counts[name] = value
+    if os.environ.get(COUNTS_ENV_VAR):
+        with open(os.environ[COUNTS_ENV_VAR], 'w') as f:
+            json.dump(_counts, f)
+
+
+def _peak_rss(usage_type):
+    """
+    Get the peak resident memory of this process or its children, in MB
+    """
+    if usage_type == 'self' and os.path.exists('/proc/self/status'):
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    if resource is None:
+        return None
+    usage = resource.getrusage(
+        resource.RUSAGE_SELF if usage_type == 'self'
+        else resource.RUSAGE_CHILDREN)
+    # ru_maxrss is in bytes on mac, kilobytes elsewhere
+    if sys.platform == 'darwin':
+        return usage.ru_maxrss / 1024 ** 2
+    return usage.ru_maxrss / 1024
+
+
+def _reset_peak_rss():
+    # Linux lets a process reset its peak memory, so each stage
+    # gets its own. Elsewhere it's the process's peak so far
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def run_stage(name, args, isolated=False):
+    """
+    Run a single stage of the pipeline.
+    By default the stage's main function is called in this interpreter,
+    so libraries that have already been imported by an earlier stage
+    (geopandas, osmnx, sklearn...) don't get loaded again
+    Args:
+        name - the stage name, one of the keys in STAGES
+        args - list of command line arguments to pass to the stage
+        isolated - if True, run the stage in its own python process,
+            the way it would be run from the command line
+    Returns:
+        dict of the stage's start and end times, wall and cpu time in
+        seconds, peak resident memory in MB, and the counts it reported
+    """
+    global _counts
+
+    if name not in STAGES:
+        raise ValueError("Unknown pipeline stage {}".format(name))
+    module = STAGES[name]
+
+    outer_counts = _counts
+    _counts = {}
+    start = datetime.datetime.now()
+    wall_start = time.perf_counter()
+    cpu_start = sum(os.times()[:4])
+    try:
+        if isolated:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                counts_file = os.path.join(tmpdir, 'counts.json')
+                env = dict(os.environ)
+                env[COUNTS_ENV_VAR] = counts_file
+                subprocess.check_call(
+                    ['python', '-m', module] + args, env=env)
+                if os.path.exists(counts_file):
+                    with open(counts_file) as f:
+                        _counts = json.load(f)
+            peak_rss = _peak_rss('children')
+        else:
+            _reset_peak_rss()
+            importlib.import_module(module).main(args)
+            peak_rss = _peak_rss('self')
+
+        return {
+            'start': start.isoformat(),
+            'end': datetime.datetime.now().isoformat(),
+            'wall_time': round(time.perf_counter() - wall_start, 3),
+            'cpu_time': round(sum(os.times()[:4]) - cpu_start, 3),
+            'peak_rss_mb': round(peak_rss, 1) if peak_rss else None,
+            'counts': _counts,
+        }
+    finally:
+        _counts = outer_counts
+
+
+def hash_file(filename):
+    """
+    Get the sha256 of a file's contents, reading it in blocks
+    Args:
+        filename
+    Returns:
+        hex digest string
+    """
+    sha = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class Build(object):
+    """
+    Decides which stages need to be run for a city, and records why.
+
+    Each stage declares the files it reads, the files it writes, and the
+    config file keys it depends on. From these, along with the stage's
+    arguments, the build makes a fingerprint; a stage is only run if its
+    fingerprint differs from the last time it was run, or if one of its
+    outputs is missing. Since an input written by an earlier stage is
+    fingerprinted by that stage's recorded output, a change propagates to
+    everything downstream of it, and nothing else.
+
+    What was decided for each stage, and why, is stored in
+    build_manifest.json in the city's data directory
+    """
+
+    def __init__(self, datadir, config_file=None, forceupdate=False,
+                 isolated=False):
+        """
+        Args:
+            datadir - the city's data directory; relative file paths
+                given to run are relative to this
+            config_file - the city's config file
+            forceupdate - if True, run every stage regardless
+            isolated - run each stage in its own python process
+        """
+        self.datadir = datadir
+        self.forceupdate = forceupdate
+        self.isolated = isolated
+        self.manifest_file = os.path.join(datadir, MANIFEST_FILE)
+
+        self.config = {}
+        if config_file:
+            with open(config_file) as f:
+                self.config = yaml.safe_load(f)
+
+        self.manifest = {'stages': {}, 'files': {}}
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file) as f:
+                self.manifest = json.load(f)
+
+        # Files written by stages in this build, and the hash they had
+        # when that stage finished
+        self.produced = {}
+        # Stage records and file hashes that were updated in this build
+        self.updated_stages = {}
+        self.updated_files = {}
+
+    def _path(self, filename):
+        return os.path.normpath(os.path.join(self.datadir, filename))
+
+    def _hash(self, filename):
+        """
+        Hash a file or directory on disk. Hashes are cached in the manifest
+        by size and modification time, so large unchanged raw files
+        are only read once
+        Args:
+            filename - absolute path
+        Returns:
+            hex digest string, or None if the file doesn't exist
+        """
+        if os.path.isdir(filename):
+            sha = hashlib.sha256()
+            for root, dirs, files in os.walk(filename):
+                dirs.sort()
+                for name in sorted(files):
+                    path = os.path.join(root, name)
+                    sha.update(os.path.relpath(path, filename).encode())
+                    sha.update(self._hash(path).encode())
+            return sha.hexdigest()
+        if not os.path.exists(filename):
+            return None
+
+        stat = os.stat(filename)
+        cached = self.manifest['files'].get(filename)
+        if cached and cached['size'] == stat.st_size \
+           and cached['mtime'] == stat.st_mtime_ns:
+            return cached['sha256']
+
+        digest = hash_file(filename)
+        entry = {
+            'size': stat.st_size,
+            'mtime': stat.st_mtime_ns,
+            'sha256': digest
+        }
+        self.manifest['files'][filename] = entry
+        self.updated_files[filename] = entry
+        return digest
+
+    def _input_hash(self, filename):
+        # If an earlier stage in this build wrote the file, use the hash
+        # it had then; later stages may have since modified it in place
+        if filename in self.produced:
+            return self.produced[filename]
+        return self._hash(filename)
+
+    def _reason(self, previous, record):
+        """
+        Compare a stage's fingerprint against its last run
+        Returns:
+            the reason it needs to be run, or None if it's up to date
+        """
+        if self.forceupdate:
+            return 'forced update'
+        if not previous:
+            return 'no previous run recorded'
+        if previous['status'] == 'failed':
+            return 'previous run failed'
+        # Some outputs are only written if there's data for them,
+        # so only check for outputs the last run actually wrote
+        for output in record['outputs']:
+            if previous['outputs'].get(output) \
+               and not os.path.exists(self._path(output)):
+                return 'output {} missing'.format(output)
+        if previous['args'] != record['args']:
+            return 'arguments changed'
+        for key, value in record['config'].items():
+            if previous['config'].get(key) != value:
+                return 'config value {} changed'.format(key)
+        for filename, digest in record['inputs'].items():
+            if previous['inputs'].get(filename) != digest:
+                return 'input {} changed'.format(filename)
+        return None
+
+    def _plan(self, name, args, inputs=None, outputs=None, config_keys=None,
+              stage_id=None, force_args=None, runtime_args=None):
+        """
+        Fingerprint a stage and decide whether it needs to run.
+        Takes the same arguments as run
+        Returns:
+            dict with the stage's name, id, new manifest record, the
+            reason it needs to run (None if it doesn't), and the
+            arguments to run it with
+        """
+        inputs = inputs or []
+        outputs = outputs or []
+        config_keys = config_keys or []
+        force_args = force_args or []
+        runtime_args = runtime_args or []
+        stage_id = stage_id or name
+        previous = self.manifest['stages'].get(stage_id)
+        record = {
+            'args': args,
+            'config': {
+                key: json.loads(json.dumps(self.config.get(key), default=str))
+                for key in config_keys
+            },
+            'inputs': {
+                x: self._input_hash(self._path(x)) for x in inputs
+            },
+            'outputs': {x: None for x in outputs},
+        }
+
+        reason = self._reason(previous, record)
+        run_args = args
+        if reason is None:
+            print("{} is up to date, skipping".format(stage_id))
+            record['outputs'] = previous['outputs']
+            record.update(status='skipped', reason='up to date',
+                          time=previous['time'])
+            if 'stats' in previous:
+                record['stats'] = previous['stats']
+        else:
+            print("Running {} ({})".format(stage_id, reason))
+            if previous and reason != 'no previous run recorded':
+                run_args = args + [x for x in force_args if x not in args]
+        run_args = run_args + runtime_args
+
+        return {
+            'name': name,
+            'stage_id': stage_id,
+            'record': record,
+            'reason': reason,
+            'run_args': run_args,
+        }
+
+    def _size(self, filename):
+        """
+        Get the size in bytes of a file, or of everything in a directory
+        Returns:
+            size, or None if the file doesn't exist
+        """
+        path = self._path(filename)
+        if os.path.isdir(path):
+            return sum(
+                os.path.getsize(os.path.join(root, name))
+                for root, dirs, files in os.walk(path) for name in files)
+        if os.path.exists(path):
+            return os.path.getsize(path)
+        return None
+
+    def _finish(self, plan, error=None, stats=None):
+        """
+        Record the result of a planned stage in the manifest
+        Args:
+            plan - dict returned by _plan
+            error - the exception the stage failed with, if it did
+            stats - dict of resources used, returned by run_stage
+        """
+        record = plan['record']
+        if plan['reason'] is not None:
+            record['outputs'] = {
+                x: self._hash(self._path(x)) for x in record['outputs']
+            }
+            record.update(status='failed' if error else 'ran',
+                          reason=plan['reason'],
+                          time=datetime.datetime.now().isoformat())
+            if error:
+                record['error'] = str(error) or type(error).__name__
+            record['stats'] = dict(stats or {})
+            record['stats']['input_sizes'] = {
+                x: self._size(x) for x in record['inputs']}
+            record['stats']['output_sizes'] = {
+                x: self._size(x) for x in record['outputs']}
+        record['checked'] = datetime.datetime.now().isoformat()
+
+        for output, digest in record['outputs'].items():
+            self.produced[self._path(output)] = digest
+
+        self.manifest['stages'][plan['stage_id']] = record
+        self.updated_stages[plan['stage_id']] = record
+        self.save()
+
+    def run(self, name, args, inputs=None, outputs=None, config_keys=None,
+            stage_id=None, force_args=None, runtime_args=None):
+        """
+        Run a stage if anything it depends on has changed
+        Args:
+            name - the stage name, one of the keys in STAGES
+            args - list of command line arguments to pass to the stage
+            inputs - files or directories the stage reads
+            outputs - files the stage writes
+            config_keys - keys in the config file the stage uses
+            stage_id - name to record the stage under in the manifest,
+                if the same stage is run more than once in a build
+            force_args - extra arguments for the stage when it's rerun
+                because something changed, e.g. --forceupdate for stages
+                that would otherwise reuse their existing output
+            runtime_args - extra arguments that change how the stage runs
+                but not what it outputs, e.g. a number of worker processes,
+                so changing them doesn't make the stage rerun
+        Returns:
+            True if the stage was run, False if it was skipped
+        """
+        plan = self._plan(name, args, inputs=inputs, outputs=outputs,
+                          config_keys=config_keys, stage_id=stage_id,
+                          force_args=force_args, runtime_args=runtime_args)
+        stats = None
+        if plan['reason'] is not None:
+            try:
+                stats = run_stage(
+                    name, plan['run_args'], isolated=self.isolated)
+            except (Exception, SystemExit) as error:
+                self._finish(plan, error)
+                raise
+        self._finish(plan, stats=stats)
+
+        return plan['record']['status'] == 'ran'
+
+    def run_parallel(self, stages, workers=None):
+        """
+        Run stages that don't depend on each other at the same time,
+        each in a separate worker process.
+        Every stage is run to completion even if another fails, and
+        results are recorded in the order the stages were given
+        Args:
+            stages - list of dicts of keyword arguments to run
+            workers - maximum number of stages to run at once. Defaults
+                to one per stage, up to the number of cores. If 1, the
+                stages are run one after another in this process
+        Returns:
+            list of whether each stage was run
+        """
+        plans = [self._plan(**stage) for stage in stages]
+        to_run = [x for x in plans if x['reason'] is not None]
+        if not workers:
+            workers = min(len(to_run), os.cpu_count() or 1)
+
+        errors = {}
+        stats = {}
+        if workers <= 1:
+            for plan in to_run:
+                try:
+                    stats[plan['stage_id']] = run_stage(
+                        plan['name'], plan['run_args'],
+                        isolated=self.isolated)
+                except (Exception, SystemExit) as error:
+                    errors[plan['stage_id']] = error
+        elif to_run:
+            with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+                futures = [(plan, pool.submit(
+                    run_stage, plan['name'], plan['run_args'], self.isolated
+                )) for plan in to_run]
+                for plan, future in futures:
+                    try:
+                        stats[plan['stage_id']] = future.result()
+                    except (Exception, SystemExit) as error:
+                        errors[plan['stage_id']] = error
+
+        for plan in plans:
+            if plan['stage_id'] in errors:
+                print("{} failed: {}".format(
+                    plan['stage_id'], errors[plan['stage_id']]))
+            self._finish(plan, errors.get(plan['stage_id']),
+                         stats.get(plan['stage_id']))
+
+        if errors:
+            raise SystemExit("{} failed".format(', '.join(errors.keys())))
+        return [x['record']['status'] == 'ran' for x in plans]
+
+    def save(self):
+        """
+        Write this build's stage records to the manifest. The manifest
+        is reread first, so records written in the meantime by another
+        build (e.g. make_dataset run as a stage) are kept
+        """
+        manifest = {'stages': {}, 'files': {}}
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file) as f:
+                manifest = json.load(f)
+        manifest['stages'].update(self.updated_stages)
+        manifest['files'].update(self.updated_files)
+
+        tmp_file = self.manifest_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(manifest, f, indent=4)
+        os.replace(tmp_file, self.manifest_file)
+
+
+# Resource usage and counts compared between runs
+COMPARED_STATS = ['wall_time', 'cpu_time', 'peak_rss_mb']
+
+
+def compare_runs(previous, current):
+    """
+    Compare the stages run in two run manifests
+    Args:
+        previous - the earlier run manifest
+        current - the later run manifest
+    Returns:
+        dict of stage id to dict of each stat or count that both runs
+        recorded, with its previous and current values and the change
+    """
+    previous_stages = {
+        x['stage']: x for x in previous['stages'] if x['status'] == 'ran'}
+    comparison = {}
+    for stage in current['stages']:
+        if stage['status'] != 'ran' \
+           or stage['stage'] not in previous_stages:
+            continue
+        before = previous_stages[stage['stage']]
+        values = [(x, before.get(x), stage.get(x)) for x in COMPARED_STATS]
+        values += [
+            (x, before['counts'].get(x), stage['counts'][x])
+            for x in sorted(stage['counts'])
+        ]
+        comparison[stage['stage']] = {
+            name: {
+                'previous': old,
+                'current': new,
+                'change': round(new - old, 3),
+            } for name, old, new in values
+            if old is not None and new is not None
+        }
+    return comparison
+
+
+def write_run_manifest(datadir, start):
+    """
+    Write a manifest of one invocation of the pipeline to the city's
+    runs directory: every stage that was checked since start, whether
+    it ran, the time and memory it used, the size of its input and output
+    files, and the counts it reported. Stages that ran are compared
+    against the city's previous run manifest
+    Args:
+        datadir - the city's data directory
+        start - datetime the pipeline started
+    Returns:
+        the run manifest's filename
+    """
+    manifest_file = os.path.join(datadir, MANIFEST_FILE)
+    records = {}
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            records = json.load(f)['stages']
+
+    stages = []
+    for stage_id, record in records.items():
+        if record.get('checked', '') < start.isoformat():
+            continue
+        stats = record.get('stats', {}) if record['status'] != 'skipped' \
+            else {}
+        stage = {
+            'stage': stage_id,
+            'status': record['status'],
+            'reason': record['reason'],
+        }
+        if 'error' in record:
+            stage['error'] = record['error']
+        stage.update({x: stats.get(x) for x in [
+            'start', 'end', 'wall_time', 'cpu_time', 'peak_rss_mb',
+            'input_sizes', 'output_sizes']})
+        stage['counts'] = stats.get('counts', {})
+        stages.append((record['checked'], stage))
+
+    end = datetime.datetime.now()
+    run = {
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'wall_time': round((end - start).total_seconds(), 3),
+        'stages': [x[1] for x in sorted(stages, key=lambda x: x[0])],
+    }
+
+    runs_dir = os.path.join(datadir, RUNS_DIR)
+    if not os.path.exists(runs_dir):
+        os.makedirs(runs_dir)
+    filename = os.path.join(
+        runs_dir, 'run_{}.json'.format(start.strftime('%Y%m%d_%H%M%S_%f')))
+
+    previous_runs = sorted(
+        x for x in os.listdir(runs_dir)
+        if x.startswith('run_') and x.endswith('.json')
+        and x < os.path.basename(filename))
+    run['previous'] = None
+    run['comparison'] = {}
+    if previous_runs:
+        run['previous'] = previous_runs[-1]
+        with open(os.path.join(runs_dir, previous_runs[-1])) as f:
+            run['comparison'] = compare_runs(json.load(f), run)
+
+    with open(filename, 'w') as f:
+        json.dump(run, f, indent=4)
+
+    print("Run manifest written to {}".format(filename))
+    for stage in run['stages']:
+        if stage['status'] != 'ran' or stage['wall_time'] is None:
+            continue
+        changes = run['comparison'].get(stage['stage'], {})
+        print("{}: {:.1f}s wall, {:.1f}s cpu, {} MB peak{}".format(
+            stage['stage'], stage['wall_time'], stage['cpu_time'],
+            stage['peak_rss_mb'],
+            " ({:+.1f}s wall vs previous run)".format(
+                changes['wall_time']['change'])
+            if 'wall_time' in changes else ''))
+
+    return filename
@@ -0,0 +1,102 @@
+import os
+import json
+import numpy as np
+import pytest
+from shapely.geometry import Point, LineString
+from .. import columnar, util
+from ..segment import Segment
+
+pyarrow = pytest.importorskip('pyarrow')
+
+
+def test_intermediate_file(tmpdir):
+    filename = os.path.join(str(tmpdir), 'crash_joined.json')
+    parquet_file = os.path.join(str(tmpdir), 'crash_joined.parquet')
+    assert columnar.intermediate_file(filename) == filename
+    assert columnar.intermediate_file(filename, 'parquet') == parquet_file
+    assert columnar.stored_format(filename) == 'geojson'
+
+    open(filename, 'w').close()
+    assert columnar.output_file(filename, 'parquet') == parquet_file
+    # The json copy is removed so it can't be read by mistake
+    assert not os.path.exists(filename)
+
+    open(parquet_file, 'w').close()
+    assert columnar.intermediate_file(filename) == parquet_file
+    assert columnar.stored_format(filename) == 'parquet'
+
+    with pytest.raises(ValueError):
+        columnar.intermediate_file(filename, 'csv')
+
+
+def test_write_read_table(tmpdir):
+    filename = os.path.join(str(tmpdir), 'test.parquet')
+    properties = [
+        {'id': 1, 'name': 'a', 'near_id': 3, 'flag': True, 'score': 1.5,
+         'values': [1, 2], 'mixed': '1'},
+        {'id': 2, 'name': None, 'near_id': np.int64(4), 'flag': False,
+         'score': np.float64(2.5), 'values': {'a': 1}, 'mixed': 1},
+        {'id': 3, 'extra': 'x'},
+    ]
+    geometries = [Point(0, 0), LineString([(0, 0), (1, 1)]), Point(2, 2)]
+    columnar.write_table(filename, properties, geometries)
+
+    result, result_geometries = columnar.read_table(filename)
+    assert result == [
+        {'id': 1, 'name': 'a', 'near_id': 3, 'flag': True, 'score': 1.5,
+         'values': [1, 2], 'mixed': '1'},
+        {'id': 2, 'name': None, 'near_id': 4, 'flag': False,
+         'score': 2.5, 'values': {'a': 1}, 'mixed': 1},
+        {'id': 3, 'extra': 'x'},
+    ]
+    assert [x.wkt for x in result_geometries] == [x.wkt for x in geometries]
+
+    # Columns are typed, and other tools can read the geometries
+    table = pyarrow.parquet.read_table(filename)
+    assert table.schema.field('id').type == pyarrow.int64()
+    assert table.schema.field('score').type == pyarrow.float64()
+    assert json.loads(table.schema.metadata[b'geo'])['primary_column'] \
+        == columnar.GEOMETRY_COLUMN
+
+    # Rows without properties or geometries are kept
+    columnar.write_table(filename, [{}, {}])
+    assert columnar.read_table(filename) == ([{}, {}], None)
+
+
+def test_write_segments_parquet(tmpdir):
+    mapfp = str(tmpdir)
+    inters = [Segment(Point(0, 0).buffer(5), {
+        'id': 1, 'data': [{'id': '5', 'name': 'Main St'}]})]
+    non_inters = [Segment(LineString([(0, 0), (10, 10)]), {
+        'id': '00', 'orig_id': '5', 'width': 10})]
+
+    util.write_segments(non_inters, inters, mapfp, fmt='geojson')
+    util.write_segments(non_inters, inters, mapfp, fmt='parquet')
+    for name in ['inters_segments', 'non_inters_segments',
+                 'inter_and_non_int']:
+        assert os.path.exists(os.path.join(mapfp, name + '.parquet'))
+        assert not os.path.exists(os.path.join(mapfp, name + '.geojson'))
+
+    segments, index = util.read_segments(dirname=mapfp)
+    assert [x.properties for x in segments] == [
+        inters[0].properties, non_inters[0].properties]
+    assert segments[1].geometry.equals(non_inters[0].geometry)
+    assert len(list(index.intersection((9, 9, 11, 11)))) == 1
+
+    # Without a format, the format on disk is kept
+    util.write_segments(non_inters, inters, mapfp)
+    assert os.path.exists(os.path.join(mapfp, 'inters_segments.parquet'))
+
+
+def test_write_read_json_records(tmpdir):
+    filename = os.path.join(str(tmpdir), 'crash_joined.json')
+    items = [{'id': 1, 'near_id': '001'}, {'id': 2, 'near_id': ''}]
+
+    util.write_json_records(items, filename, fmt='parquet')
+    assert not os.path.exists(filename)
+    assert util.read_json_records(filename) == items
+
+    util.write_json_records(items, filename, fmt='geojson')
+    assert not os.path.exists(
+        os.path.join(str(tmpdir), 'crash_joined.parquet'))
+    assert util.read_json_records(filename) == items
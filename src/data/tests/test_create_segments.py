@@ -7,7 +7,7 @@ import os
 from .. import util
 import shutil
 import json
-from shapely.geometry import LineString, MultiLineString
+from shapely.geometry import Point, LineString, MultiLineString
 
 TEST_FP = os.path.dirname(os.path.abspath(__file__))
 
@@ -57,6 +57,90 @@ def test_find_non_ints():
     assert len(non_int_lines) == 8
     assert len(inter_segments) == 2
 
+
+def test_find_non_ints_workers(monkeypatch):
+    def find_non_ints(workers):
+        roads, inters = util.get_roads_and_inters(os.path.join(
+            TEST_FP, 'data/test_create_segments/test_adjacency.geojson'))
+        for i, road in enumerate(roads):
+            road.properties['orig_id'] = int(str(99) + str(i))
+        int_buffers = create_segments.get_intersection_buffers(inters, 20)
+        non_int_lines, inter_segments = create_segments.find_non_ints(
+            roads, int_buffers, workers=workers)
+        return (
+            [(x.geometry.wkt, x.properties) for x in non_int_lines],
+            [(x.id, [y.wkt for y in x.lines], x.data, x.connected_segments)
+             for x in inter_segments])
+
+    expected = find_non_ints(1)
+
+    # Split into many small tiles, processed on several processes
+    monkeypatch.setattr(create_segments, 'TILE_SIZE', 50)
+    assert len(create_segments._tiles(range(2), [
+        Point(0, 0), Point(100, 100)])) == 2
+    assert find_non_ints(2) == expected
+
+def test_find_segments_by_topology():
+    # Nodes joined by short roads are one intersection
+    roads, inters = util.get_roads_and_inters(os.path.join(
+        TEST_FP, 'data/test_create_segments/no_non_inter.geojson'))
+    for i, road in enumerate(roads):
+        road.properties['orig_id'] = int(str(99) + str(i))
+    non_int_lines, inter_segments = create_segments.find_segments_by_topology(
+        roads, inters, 20)
+    assert len(non_int_lines) == 8
+    assert [len(x.nodes) for x in inter_segments] == [3, 1]
+    non_int_ids = set(x.properties['id'] for x in non_int_lines)
+    for inter_segment in inter_segments:
+        assert set(inter_segment.connected_segments) <= non_int_ids
+
+    # Stubs are cut from whichever end of the line the node is at
+    def node(osmid, x, y):
+        return {'geometry': Point(x, y), 'properties': {'osmid': osmid}}
+
+    inters = [node('1', 0, 0), node('2', 100, 0)]
+    roads = [
+        Segment(LineString([(0, 0), (100, 0)]), {'from': '1', 'to': '2'}),
+        Segment(LineString([(0, 100), (0, 0)]), {'from': '1', 'to': '3'}),
+        Segment(LineString([(100, 0), (100, 10)]), {'from': '2', 'to': '4'}),
+    ]
+    for i, road in enumerate(roads):
+        road.properties['orig_id'] = i
+    non_int_lines, inter_segments = create_segments.find_segments_by_topology(
+        roads, inters, 20)
+    assert [x.geometry.wkt for x in non_int_lines] == [
+        'LINESTRING (20 0, 80 0)', 'LINESTRING (0 100, 0 20)']
+    assert [[x.wkt for x in y.lines] for y in inter_segments] == [
+        ['LINESTRING (0 0, 20 0)', 'LINESTRING (0 20, 0 0)'],
+        ['LINESTRING (80 0, 100 0)', 'LINESTRING (100 0, 100 10)'],
+    ]
+    assert [x.connected_segments for x in inter_segments] == [
+        ['000', '001'], ['000']]
+
+
+def test_compare_segmentations(tmpdir):
+    roads, inters = util.get_roads_and_inters(os.path.join(
+        TEST_FP, 'data/test_create_segments/test_adjacency.geojson'))
+    for i, road in enumerate(roads):
+        road.properties['orig_id'] = int(str(99) + str(i))
+    properties = [dict(x.properties) for x in roads]
+
+    report = create_segments.compare_segmentations(roads, inters)
+    assert report['buffer']['intersections'] == 5
+    assert report['topology']['intersections'] == 5
+    assert report['same_nodes'] == 5
+    assert report['only_buffer'] == report['only_topology'] == 0
+    # The roads are left for the segmentation that's used
+    assert [x.properties for x in roads] == properties
+
+    # Without from and to nodes, buffer segmentation is used instead
+    roads, inters = util.get_roads_and_inters(os.path.join(
+        TEST_FP, 'data/processed/maps/boston_test_elements.geojson'))
+    non_int_lines, inter_segments = create_segments.segment_roads(
+        roads, inters, 'topology')
+    assert len(non_int_lines) == 7
+
+
 def test_create_segments_from_json(tmpdir):
     """
     Just test that this runs, for now
@@ -273,6 +357,33 @@ def test_add_point_based_features(tmpdir):
         assert output == expected
 
 
+def test_aggregate_point_features():
+    def feature(near_id, feat_type, **properties):
+        properties.update(feature=feat_type, near_id=near_id)
+        return Record(properties, point=Point(0, 0))
+
+    features = [
+        feature('001', 'volume', feat_agg='latest', date='2015', value=1),
+        feature('001', 'signal'),
+        feature(2, 'crosswalk'),
+        feature('001', 'signal'),
+        feature('001', 'volume', feat_agg='latest', date='2016', value=2),
+        # Of values with the same date, the last is kept
+        feature('001', 'volume', feat_agg='latest', date='2016', value=3),
+        feature('001', 'volume', feat_agg='latest', date='2014', value=4),
+        feature('001', 'tickets', feat_agg='latest', date='2014',
+                category='METER'),
+        feature('', 'signal'),
+    ]
+    matches = create_segments.aggregate_point_features(features)
+    assert matches == {
+        '001': {'signal': 2, 'volume': 3, 'tickets': 'METER'},
+        '2': {'crosswalk': 1},
+    }
+    # Counted features come first
+    assert list(matches['001']) == ['signal', 'volume', 'tickets']
+
+
 def test_get_connections():
     test_path = os.path.join(
         os.path.dirname(
@@ -345,7 +456,21 @@ def test_get_connections():
     connections = create_segments.get_connections(
         [Record(inters[0]['properties'], point=inters[0]['geometry'])], roads)
     assert not connections
-    
+
+    # Lines are added to a point if they touch a line added before
+    # them, so the line touching only the last line added is left out
+    roads = [Segment(LineString(x), {'id': i}) for i, x in enumerate([
+        [(0, 0), (10, 0)],
+        [(10, 0), (20, 0)],
+        [(20, 0), (30, 0)],
+        [(-10, 5), (30, 5)],
+        [(30, 0), (30, 5)],
+    ])]
+    connections = create_segments.get_connections(
+        [Record({}, point=Point(0, 0))], roads)
+    assert sorted(x.properties['id'] for x in connections[0][0]) == \
+        [0, 1, 2, 4]
+
 
 def test_connected_segments():
     """
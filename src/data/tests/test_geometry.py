@@ -0,0 +1,70 @@
+import random
+import numpy as np
+from shapely.geometry import Point, LineString, MultiLineString, Polygon
+from .. import geometry, util
+from ..segment import Segment
+
+
+def random_lines(count, seed=0):
+    rnd = random.Random(seed)
+    lines = []
+    for _ in range(count):
+        coords = [(rnd.uniform(0, 1000), rnd.uniform(0, 1000))
+                  for _ in range(rnd.randint(2, 5))]
+        lines.append(LineString(coords))
+    return lines
+
+
+def test_buffer_and_clip():
+    lines = random_lines(50)
+    for distance in [3, 10, 20]:
+        buffers = geometry.buffer(lines, distance)
+        # The same as buffering each line on its own
+        assert [x.wkb for x in buffers] == [
+            x.buffer(distance).wkb for x in lines]
+
+    polygon = Polygon([(0, 0), (500, 0), (500, 500), (0, 500)])
+    assert [x.wkb for x in geometry.clip(lines, polygon)] == [
+        x.intersection(polygon).wkb for x in lines]
+    np.testing.assert_array_equal(
+        geometry.lengths(lines), [x.length for x in lines])
+    assert geometry.bounds(lines[:2]) == [x.bounds for x in lines[:2]]
+
+
+def test_multi_difference():
+    lines = random_lines(50)
+    rnd = random.Random(1)
+    others = [[Point(rnd.uniform(0, 1000), rnd.uniform(0, 1000)).buffer(
+        rnd.uniform(50, 200)) for _ in range(rnd.randint(0, 4))]
+        for _ in lines]
+
+    expected = []
+    for line, polygons in zip(lines, others):
+        for polygon in polygons:
+            line = line.difference(polygon)
+        expected.append(line.wkb)
+    assert [x.wkb for x in geometry.multi_difference(lines, others)] \
+        == expected
+    assert len(geometry.multi_difference([], [])) == 0
+
+
+def test_center_points():
+    geometries = random_lines(20) + [
+        MultiLineString([[(2, 0), (2, 4)], [(0, 2), (4, 2)]]),
+        MultiLineString([[(0, 0), (10, 0)], [(10, 0), (10, 30)]]),
+        LineString(),
+        Point(0, 0),
+    ]
+    centers = geometry.center_points(geometries)
+    # Half way along each linestring
+    for line, center in zip(geometries[:20], centers):
+        point = line.interpolate(.5, normalized=True)
+        assert (point.x, point.y) == tuple(center)
+    # The point on each multilinestring nearest the center of its bounds
+    np.testing.assert_array_equal(centers[20:22], [[2, 2], [10, 15]])
+    assert np.isnan(centers[-2:]).all()
+    assert util.get_center_point(Segment(geometries[-1], {})) == (None, None)
+
+    np.testing.assert_array_equal(
+        geometry.centroids([Point(1, 2), LineString([(0, 0), (2, 0)])]),
+        [[1, 2], [1, 0]])
@@ -0,0 +1,55 @@
+import networkx as nx
+import osmnx as ox
+from shapely.geometry import Polygon
+from .. import graph_cache
+
+
+def test_graph_key(monkeypatch):
+    square = Polygon([(0, 0), (0, 1), (1, 1), (1, 0)])
+    key = graph_cache.graph_key({'source': 'polygon', 'boundary': square})
+
+    # The same boundary, starting from a different corner
+    assert graph_cache.graph_key({'source': 'polygon', 'boundary': Polygon(
+        [(1, 1), (1, 0), (0, 0), (0, 1)])}) == key
+
+    assert graph_cache.graph_key({'source': 'polygon', 'boundary': Polygon(
+        [(0, 0), (0, 1), (1, 1.001), (1, 0)])}) != key
+    assert graph_cache.graph_key({
+        'source': 'extract', 'boundary': square, 'extract': 'abc'}) != key
+
+    # Data from another date
+    monkeypatch.setattr(
+        ox.settings, 'overpass_settings',
+        '[out:json][timeout:{timeout}][date:"2020-01-01T00:00:00Z"]{maxsize}')
+    assert graph_cache.graph_key(
+        {'source': 'polygon', 'boundary': square}) != key
+
+
+def test_get_graphs(tmpdir):
+    G1 = nx.MultiDiGraph(crs='epsg:4326')
+    for node, x in enumerate([0, .001, .002]):
+        G1.add_node(node, x=x, y=0, highway='traffic_signals' if node else None)
+    G1.add_edge(0, 1, osmid=10, length=80.0, oneway=False)
+    G1.add_edge(1, 2, osmid=10, length=80.0, oneway=False)
+    query = {'source': 'polygon', 'boundary': Polygon(
+        [(0, 0), (0, 1), (1, 1), (1, 0)])}
+    downloads = []
+
+    def download():
+        downloads.append(1)
+        return G1
+
+    first = graph_cache.get_graphs(query, download, str(tmpdir))
+    second = graph_cache.get_graphs(query, download, str(tmpdir))
+    assert len(downloads) == 1
+    for made, cached in zip(first, second):
+        assert list(made.nodes(data=True)) == list(cached.nodes(data=True))
+        assert list(made.edges(keys=True, data=True)) == \
+            list(cached.edges(keys=True, data=True))
+    # The unsimplified graph, and the simplified one without node 1
+    assert len(second[0]) == 3
+    assert len(second[1]) == 2
+
+    # Without a cache, it's always downloaded
+    graph_cache.get_graphs(query, download)
+    assert len(downloads) == 2
@@ -1,7 +1,12 @@
+import os
+import json
+import pytest
 import geopandas as gpd
-from shapely.geometry import Point
+from shapely.geometry import Point, LineString
 from pandas.testing import assert_frame_equal
-from .. import join_segments_crash
+from .. import join_segments_crash, util
+from ..segment import Segment
+from ..record import RecordBatch, transformer_3857_to_4326
 
 
 def test_make_rollup():
@@ -113,3 +118,129 @@ def test_make_rollup():
     assert_frame_equal(results['all'], expected_rollup_total)
     assert_frame_equal(results['pedestrian'], expected_rollup_pedestrian)
     assert_frame_equal(results['bike'], expected_rollup_bike)
+
+    # The same, from crashes read a batch at a time
+    batches = [
+        RecordBatch.from_items(
+            standardized_crashes[i:i + 2], 'crash', split_columns)
+        for i in range(0, len(standardized_crashes), 2)]
+    results = join_segments_crash.make_crash_rollup_from_batches(
+        iter(batches), split_columns)
+    assert_frame_equal(results['all'], expected_rollup_total)
+    assert_frame_equal(results['pedestrian'], expected_rollup_pedestrian)
+    assert_frame_equal(results['bike'], expected_rollup_bike)
+    assert_frame_equal(
+        results['vehicle'], join_segments_crash.make_crash_rollup(
+            standardized_crashes, split_columns)['vehicle'])
+
+
+def test_snap_records(tmpdir, monkeypatch):
+    monkeypatch.setattr(join_segments_crash, 'PROCESSED_DATA_FP',
+                        tmpdir.strpath)
+    counts = {}
+    monkeypatch.setattr(join_segments_crash, 'report_count',
+                        lambda name, value: counts.update({name: value}))
+
+    # One segment along a street, crashes at points along it,
+    # and one far away that doesn't snap
+    segments = [Segment(LineString([(0, 0), (1000, 0)]), {'id': '001'})]
+    segments, index = util.index_segments(
+        segments, geojson=False, segment=True)
+    crashes = []
+    for i, x in enumerate([0, 250, 500, 750, 1000, 5000]):
+        lon, lat = transformer_3857_to_4326.transform(x, 10)
+        crashes.append({
+            'id': i,
+            'dateOccurred': '2016-01-0{}T10:00:00-05:00'.format(i + 1),
+            'location': {'latitude': lat, 'longitude': lon},
+        })
+    infile = os.path.join(tmpdir.strpath, 'crashes.json')
+    with open(infile, 'w') as f:
+        json.dump(crashes, f)
+
+    # Snapped a few at a time
+    join_segments_crash.snap_records(
+        segments, index, infile, endyear='2016-01-04', batch_size=2)
+    with open(os.path.join(tmpdir.strpath, 'crash_joined.json')) as f:
+        result = json.load(f)
+    assert [x['id'] for x in result] == [0, 1, 2, 3]
+    assert all(x['near_id'] == '001' for x in result)
+    assert counts == {'crashes_read': 4, 'crashes_dropped': 0}
+
+    join_segments_crash.snap_records(segments, index, infile, batch_size=4)
+    with open(os.path.join(tmpdir.strpath, 'crash_joined.json')) as f:
+        assert len(json.load(f)) == 5
+    assert counts == {'crashes_read': 6, 'crashes_dropped': 1}
+
+    # The same on several processes
+    join_segments_crash.snap_records(
+        segments, index, infile, batch_size=1, workers=2)
+    with open(os.path.join(tmpdir.strpath, 'crash_joined.json')) as f:
+        assert [x['id'] for x in json.load(f)] == [0, 1, 2, 3, 4]
+    assert counts == {'crashes_read': 6, 'crashes_dropped': 1}
+
+
+def test_snap_records_cache(tmpdir, monkeypatch):
+    monkeypatch.setattr(join_segments_crash, 'PROCESSED_DATA_FP',
+                        tmpdir.strpath)
+    counts = {}
+    monkeypatch.setattr(join_segments_crash, 'report_count',
+                        lambda name, value: counts.update({name: value}))
+
+    # Crashes passed to find_nearest, i.e. not found in the cache
+    snapped = []
+    find_nearest = util.find_nearest
+
+    def find_nearest_spy(records, *args, **kwargs):
+        snapped.extend(x.properties['id'] for x in records)
+        return find_nearest(records, *args, **kwargs)
+    monkeypatch.setattr(util, 'find_nearest', find_nearest_spy)
+
+    segments = [
+        Segment(LineString([(0, 0), (1000, 0)]), {'id': '001'}),
+        Segment(LineString([(0, 500), (1000, 500)]), {'id': '002'}),
+    ]
+    segments, index = util.index_segments(
+        segments, geojson=False, segment=True)
+    infile = os.path.join(tmpdir.strpath, 'crashes.json')
+
+    def snap(ys, fingerprint):
+        crashes = []
+        for i, y in enumerate(ys):
+            lon, lat = transformer_3857_to_4326.transform(100, y)
+            crashes.append({
+                'id': i,
+                'dateOccurred': '2016-01-01T10:00:00-05:00',
+                'location': {'latitude': lat, 'longitude': lon},
+            })
+        with open(infile, 'w') as f:
+            json.dump(crashes, f)
+
+        del snapped[:]
+        join_segments_crash.snap_records(
+            segments, index, infile, map_fingerprint=fingerprint)
+        with open(os.path.join(tmpdir.strpath, 'crash_joined.json')) as f:
+            return [(x['id'], x['near_id']) for x in json.load(f)]
+
+    assert snap([10, 20, 5000], 'a') == [(0, '001'), (1, '001')]
+    assert snapped == [0, 1, 2]
+    assert counts['crashes_cached'] == 0
+    with open(os.path.join(
+            tmpdir.strpath, join_segments_crash.SNAP_CACHE_FILE)) as f:
+        cache = json.load(f)
+    assert cache['fingerprint'] == 'a'
+    assert cache['records']['0'][1] == '001'
+    assert cache['records']['0'][2] == pytest.approx(10)
+    assert cache['records']['2'][1:] == ['', None]
+
+    # Only new and moved crashes are snapped again
+    assert snap([10, 490, 5000, 510], 'a') == [
+        (0, '001'), (1, '002'), (3, '002')]
+    assert snapped == [1, 3]
+    assert counts['crashes_cached'] == 2
+
+    # All of them once the map has changed
+    assert snap([10, 490, 5000, 510], 'b') == [
+        (0, '001'), (1, '002'), (3, '002')]
+    assert snapped == [0, 1, 2, 3]
+    assert counts['crashes_cached'] == 0
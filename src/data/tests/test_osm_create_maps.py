@@ -5,6 +5,7 @@ import networkx as nx
 import json
 import fiona
 import pickle
+import pandas as pd
 from .. import osm_create_maps
 from .. import util
 from .. import config
@@ -86,14 +87,48 @@ def test_expand_polygon():
     assert result_shape.contains(records[2].point)
 
 
+def test_expand_polygon_cached(tmpdir, monkeypatch):
+    test_polygon = {
+        'type': 'Polygon',
+        'coordinates': [[[-71.0770265, 42.3364517], [-71.0810509, 42.3328703],
+                         [-71.0721386, 42.3325241]]]
+    }
+    points_file = os.path.join(str(tmpdir), 'crashes.json')
+    shutil.copy(os.path.join(TEST_FP, 'data', 'osm_crash_file.json'),
+                points_file)
+    cache_file = os.path.join(str(tmpdir), 'expanded_polygon.json')
+    assert osm_create_maps.expand_polygon(
+        test_polygon, points_file, cache_file=cache_file) is None
+    expected = osm_create_maps.expand_polygon(
+        test_polygon, points_file, max_percent=.7, cache_file=cache_file)
+
+    # The crashes aren't read again while they're the same
+    calls = []
+    monkeypatch.setattr(osm_create_maps, '_expand_polygon',
+                        lambda *args: calls.append(args))
+    result = osm_create_maps.expand_polygon(
+        test_polygon, points_file, max_percent=.7, cache_file=cache_file)
+    assert not calls
+    assert result.equals(expected)
+
+    with open(points_file, 'a') as f:
+        f.write('\n')
+    osm_create_maps.expand_polygon(
+        test_polygon, points_file, max_percent=.7, cache_file=cache_file)
+    assert len(calls) == 1
+
+
 def mockreturn(config):
-    G1 = pickle.load(open(os.path.join(TEST_FP, 'data', 'osm_output.gpickle'), 'rb'))
-    return G1
+    def download():
+        return pickle.load(open(
+            os.path.join(TEST_FP, 'data', 'osm_output.gpickle'), 'rb'))
+    return {'source': 'test', 'boundary': Polygon(
+        [(0, 0), (0, 1), (1, 1), (1, 0)])}, download
 
 
 def test_simple_get_roads(tmpdir, monkeypatch):
 
-    monkeypatch.setattr(osm_create_maps, 'get_graph', mockreturn)
+    monkeypatch.setattr(osm_create_maps, 'graph_query', mockreturn)
     c = config.Configuration(
         os.path.join(TEST_FP, 'data', 'config_features.yml'))
     osm_create_maps.simple_get_roads(c, tmpdir)
@@ -116,3 +151,63 @@ def test_simple_get_roads(tmpdir, monkeypatch):
     # It's just coincidence that the number of ways and nodes is the same
     assert len(nodes) == 28
     assert len(ways) == 28
+
+
+def test_simple_get_roads_cached(tmpdir, monkeypatch):
+    monkeypatch.setattr(osm_create_maps, 'graph_query', mockreturn)
+    c = config.Configuration(
+        os.path.join(TEST_FP, 'data', 'config_features.yml'))
+    cache_dir = os.path.join(str(tmpdir), 'cache')
+    first = os.path.join(str(tmpdir), 'first')
+    second = os.path.join(str(tmpdir), 'second')
+    os.makedirs(first)
+    os.makedirs(second)
+    osm_create_maps.simple_get_roads(c, first, cache_dir)
+    assert len(os.listdir(cache_dir)) == 1
+
+    # The second time, the graph isn't downloaded again
+    def cached_query(config):
+        query, _ = mockreturn(config)
+        return query, None
+    monkeypatch.setattr(osm_create_maps, 'graph_query', cached_query)
+    osm_create_maps.simple_get_roads(c, second, cache_dir)
+
+    with open(os.path.join(first, 'features.geojson')) as f:
+        expected = f.read()
+    with open(os.path.join(second, 'features.geojson')) as f:
+        assert f.read() == expected
+    for layer in ['nodes', 'edges']:
+        assert list(fiona.open(os.path.join(first, 'osm.gpkg'),
+                               layer=layer)) == \
+            list(fiona.open(os.path.join(second, 'osm.gpkg'), layer=layer))
+
+
+def test_get_connections():
+    def way(osmid, name, from_node, to_node):
+        return {'properties': {
+            'osmid': osmid, 'name': name, 'from': from_node, 'to': to_node}}
+    ways = [
+        way(1, 'Main Street', 10, 11),
+        way(2, "['Main Street', 'Side_St']", 11, 12),
+        way(3, None, 12, 13),
+        way(4, 'Main Street', 11, 10),
+    ]
+    nodes = [{'properties': {'osmid': x}} for x in [10, 11, 12, 13]]
+    nodes, ways = osm_create_maps.get_connections(ways, nodes)
+
+    assert [x['properties']['segment_id'] for x in ways] == [
+        '1-10-11', '2-11-12', '3-12-13', '4-11-10']
+    assert ways[1]['properties']['name'] == 'Main Street/SideSt'
+    assert ways[2]['properties']['name'] is None
+    streets = [x['properties']['streets'] for x in nodes]
+    assert streets[0] == 'Main Street'
+    assert sorted(streets[1].split(', ')) == [
+        'Main Street', 'Main Street/SideSt']
+    assert streets[2:] == ['Main Street/SideSt', '']
+
+
+def test_map_values():
+    values = pd.Series(['25 mph', None, '30', '25 mph', ''], dtype=object)
+    assert osm_create_maps.map_values(
+        values, osm_create_maps.get_speed).tolist() == [25, 0, 30, 25, 0]
+    assert osm_create_maps.get_lanes('2;3') == 3
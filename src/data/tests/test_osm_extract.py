@@ -0,0 +1,106 @@
+import os
+import osmnx as ox
+import pytest
+from shapely.geometry import box
+from .. import osm_extract
+
+
+def write_extract(filename, nodes, ways):
+    with open(filename, 'w') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6">\n')
+        for node_id, (lon, lat, tags) in nodes.items():
+            f.write('<node id="{}" lat="{}" lon="{}">'.format(
+                node_id, lat, lon))
+            f.write(''.join('<tag k="{}" v="{}"/>'.format(k, v)
+                            for k, v in tags.items()))
+            f.write('</node>\n')
+        for way_id, refs, tags in ways:
+            f.write('<way id="{}">'.format(way_id))
+            f.write(''.join('<nd ref="{}"/>'.format(x) for x in refs))
+            f.write(''.join('<tag k="{}" v="{}"/>'.format(k, v)
+                            for k, v in tags.items()))
+            f.write('</way>\n')
+        f.write('<relation id="1"><member type="way" ref="100" role=""/>'
+                '</relation>\n</osm>\n')
+
+
+def test_matches_filter():
+    clauses = osm_extract.parse_filter(osm_extract.DRIVE_FILTER)
+    assert osm_extract.matches_filter({'highway': 'residential'}, clauses)
+    assert osm_extract.matches_filter(
+        {'highway': 'primary', 'oneway': 'yes'}, clauses)
+    assert not osm_extract.matches_filter({'name': 'Main St'}, clauses)
+    assert not osm_extract.matches_filter({'highway': 'footway'}, clauses)
+    assert not osm_extract.matches_filter({'highway': 'service'}, clauses)
+    assert not osm_extract.matches_filter(
+        {'highway': 'residential', 'access': 'private'}, clauses)
+    assert not osm_extract.matches_filter(
+        {'highway': 'residential', 'motor_vehicle': 'no'}, clauses)
+
+
+def test_graph_from_extract(tmpdir):
+    # A grid of streets, 8 by 8 nodes about 170m apart, and a street
+    # far away from the city
+    nodes = {}
+    ways = []
+    for row in range(8):
+        for col in range(8):
+            nodes[row * 10 + col + 1] = (
+                -71.07 + col * .002, 42.35 + row * .002, {})
+    nodes[100] = (-71.5, 42.0, {})
+    nodes[101] = (-71.49, 42.0, {})
+    nodes[45][2]['highway'] = 'traffic_signals'
+    for row in range(8):
+        ways.append((1000 + row, [row * 10 + col + 1 for col in range(8)], {
+            'highway': 'residential', 'name': 'Row {}'.format(row)}))
+        ways.append((2000 + row, [col * 10 + row + 1 for col in range(8)], {
+            'highway': 'primary', 'name': 'Col {}'.format(row),
+            'oneway': 'yes'}))
+    ways += [
+        (3000, [34, 45], {'highway': 'footway'}),
+        (3001, [35, 46], {'highway': 'service', 'service': 'driveway'}),
+        (3002, [44, 55], {'highway': 'residential', 'access': 'private'}),
+        (3003, [100, 101], {'highway': 'residential'}),
+    ]
+
+    # The city is the middle of the grid
+    boundary = box(-71.0655, 42.3545, -71.0585, 42.3615)
+    extract_file = os.path.join(str(tmpdir), 'extract.osm')
+    write_extract(extract_file, nodes, ways)
+    G = osm_extract.graph_from_extract(extract_file, boundary)
+
+    # What osmnx makes from a file with just the drivable roads
+    expected_file = os.path.join(str(tmpdir), 'expected.osm')
+    write_extract(expected_file, nodes, [
+        x for x in ways if x[0] < 3000])
+    expected = ox.graph_from_xml(
+        expected_file, simplify=False, retain_all=True)
+    expected = ox.truncate.truncate_graph_polygon(expected, boundary)
+
+    assert sorted(G.nodes) == sorted(expected.nodes) == [
+        row * 10 + col + 1 for row in range(3, 6) for col in range(3, 6)]
+    assert G.nodes[45]['highway'] == 'traffic_signals'
+    assert sorted(G.edges(keys=True)) == sorted(expected.edges(keys=True))
+    for u, v, k, data in G.edges(keys=True, data=True):
+        assert data['osmid'] == expected.edges[u, v, k]['osmid']
+        assert data['length'] == expected.edges[u, v, k]['length']
+
+    # Streets are counted with the ones going out of the city
+    assert G.nodes[34]['street_count'] == 4
+    assert len(G.edges(34)) == 2
+
+    # No roads in the city
+    with pytest.raises(SystemExit):
+        osm_extract.graph_from_extract(extract_file, box(0, 0, 1, 1))
+
+
+def test_read_extract_unsorted(tmpdir):
+    extract_file = os.path.join(str(tmpdir), 'extract.osm')
+    with open(extract_file, 'w') as f:
+        f.write('<osm version="0.6">'
+                '<node id="1" lat="0.5" lon="0.5"/>'
+                '<way id="1"><nd ref="1"/><tag k="highway" v="primary"/></way>'
+                '<node id="2" lat="0.5" lon="0.5"/>'
+                '</osm>')
+    with pytest.raises(SystemExit):
+        osm_extract.read_extract(extract_file, box(0, 0, 1, 1))
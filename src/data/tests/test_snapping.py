@@ -0,0 +1,136 @@
+import random
+import numpy as np
+import rtree
+from shapely.geometry import Point, LineString
+from .. import util
+from ..segment import Segment
+from ..snapping import SegmentTree, SnapPool
+
+
+def insertion_index(segments):
+    # How util.index_segments used to index segments, one at a time
+    segments_index = rtree.index.Index()
+    for idx, element in enumerate(segments):
+        segments_index.insert(idx, element.geometry.bounds)
+    return segments_index
+
+
+def nearest_one_at_a_time(point, segments, segments_index, tolerance):
+    # How util.find_nearest used to snap each point
+    candidates = [
+        (segment_id, segments[segment_id].geometry.distance(point))
+        for segment_id in segments_index.intersection(
+            point.buffer(tolerance).bounds)]
+    if not candidates:
+        return -1
+    return min(candidates, key=lambda x: x[1])[0]
+
+
+def test_nearest():
+    # A grid of streets, so many points are equally near two of them
+    segments = []
+    for i in range(10):
+        segments.append(Segment(
+            LineString([(0, i * 100), (900, i * 100)]), {'id': 'h' + str(i)}))
+        segments.append(Segment(
+            LineString([(i * 100, 0), (i * 100, 900)]), {'id': 'v' + str(i)}))
+
+    segments_index = insertion_index(segments)
+
+    rnd = random.Random(0)
+    points = [Point(rnd.randrange(-50, 950), rnd.randrange(-50, 950))
+              for _ in range(2000)]
+    # Corners of the grid's blocks are equally near two streets
+    points += [Point(x * 100 + 10, y * 100 + 10)
+               for x in range(9) for y in range(9)]
+
+    tree = SegmentTree(segments)
+    for tolerance in [5, 20, 30]:
+        nearest, distances = tree.nearest(
+            [(p.x, p.y) for p in points], tolerance)
+        expected = [nearest_one_at_a_time(
+            p, segments, segments_index, tolerance) for p in points]
+        assert nearest.tolist() == expected
+        for point, segment_id, distance in zip(points, nearest, distances):
+            if segment_id >= 0:
+                assert distance == segments[segment_id].geometry.distance(
+                    point)
+            else:
+                assert np.isnan(distance)
+
+
+def test_find_nearest():
+    segments, segments_index = util.index_segments([
+        Segment(LineString([(0, 0), (100, 0)]), {'id': '001'}),
+        Segment(LineString([(0, 50), (100, 50)]), {'id': '002'}),
+    ], segment=True)
+
+    records = [{'point': Point(x, y), 'properties': {}}
+               for x, y in [(10, 5), (10, 45), (10, 500)]]
+    util.find_nearest(records, segments, segments_index, 20)
+    assert [x['properties']['near_id'] for x in records] == \
+        ['001', '002', '']
+
+    # No points, or no segments
+    util.find_nearest([], segments, segments_index, 20)
+    nearest, distances = SegmentTree([]).nearest([(0, 0)], 20)
+    assert nearest.tolist() == [-1]
+
+
+def test_snap_pool():
+    segments = [Segment(LineString([(0, i * 10), (1000, i * 10)]),
+                        {'id': str(i)}) for i in range(50)]
+    segments, segments_index = util.index_segments(segments, segment=True)
+    tree = SegmentTree(segments)
+
+    rnd = random.Random(0)
+    coords = [(rnd.uniform(0, 1000), rnd.uniform(-50, 550))
+              for _ in range(1000)]
+    expected = tree.nearest(coords, 20)
+
+    # Split into chunks across processes, in the same order
+    with SnapPool(tree, 2, chunk_size=64) as pool:
+        nearest, distances = pool.nearest(coords, 20)
+        assert nearest.tolist() == expected[0].tolist()
+        np.testing.assert_array_equal(distances, expected[1])
+
+    records = [{'point': Point(x, y), 'properties': {}} for x, y in coords]
+    util.find_nearest(records, segments, segments_index, 20, workers=2)
+    assert [x['properties']['near_id'] for x in records] == [
+        segments[x].properties['id'] if x >= 0 else '' for x in expected[0]]
+
+
+def test_find_nearest_ties(tmpdir):
+    # Each point is equally near two or more segments
+    segments = [
+        Segment(LineString([(0, 0), (100, 0)]), {'id': '001'}),
+        Segment(LineString([(0, 20), (100, 20)]), {'id': '002'}),
+        Segment(LineString([(50, -50), (50, 50)]), {'id': '003'}),
+        Segment(LineString([(0, 10), (0, 100)]), {'id': '004'}),
+        Segment(LineString([(-20, 0), (-20, 100)]), {'id': '005'}),
+    ]
+    points = [Point(10, 10), Point(40, 10), Point(-10, 50), Point(60, 10),
+              Point(-10, 0)]
+
+    expected = [
+        segments[nearest_one_at_a_time(
+            p, segments, insertion_index(segments), 30)].properties['id']
+        for p in points]
+    assert expected == ['001', '001', '004', '001', '001']
+
+    # However the index was built, ties go the same way
+    indexes = [
+        insertion_index(segments),
+        util.index_segments(segments, segment=True)[1],
+        rtree.index.Index(
+            (idx, segments[idx].geometry.bounds, None)
+            for idx in reversed(range(len(segments)))),
+    ]
+    for segments_index in indexes:
+        records = [{'point': p, 'properties': {}} for p in points]
+        util.find_nearest(records, segments, segments_index, 30)
+        assert [x['properties']['near_id'] for x in records] == expected
+
+        records = [{'point': p, 'properties': {}} for p in points]
+        util.find_nearest(records, segments, segments_index, 30, workers=2)
+        assert [x['properties']['near_id'] for x in records] == expected
@@ -0,0 +1,206 @@
+import datetime
+import importlib
+import json
+import os
+import pytest
+from .. import stages
+
+
+def test_stages_have_main():
+    for module in stages.STAGES.values():
+        assert callable(importlib.import_module(module).main)
+
+
+def test_run_stage(monkeypatch):
+    calls = []
+    monkeypatch.setattr(
+        'data.propagate_volume.main', lambda args: calls.append(args))
+    monkeypatch.setattr(
+        stages.subprocess, 'check_call',
+        lambda args, env=None: calls.append(args))
+
+    stages.run_stage('propagate_volume', ['-d', 'test_dir'])
+    assert calls == [['-d', 'test_dir']]
+
+    stages.run_stage('propagate_volume', ['-d', 'test_dir'], isolated=True)
+    assert calls[1] == [
+        'python', '-m', 'data.propagate_volume', '-d', 'test_dir']
+
+    with pytest.raises(ValueError):
+        stages.run_stage('not_a_stage', [])
+
+
+def test_run_stage_in_process(tmpdir):
+    # No volume data, so this should return without exiting the interpreter
+    stats = stages.run_stage('propagate_volume', ['-d', tmpdir.strpath])
+    assert stats['wall_time'] >= 0
+    assert stats['cpu_time'] >= 0
+    assert stats['start'] <= stats['end']
+    assert stats['counts'] == {}
+
+
+def test_run_stage_counts(monkeypatch):
+    def fake_main(args):
+        stages.report_count('crashes_read', 10)
+        stages.report_count('crashes_dropped', 2)
+    monkeypatch.setattr('data.propagate_volume.main', fake_main)
+
+    stats = stages.run_stage('propagate_volume', [])
+    assert stats['counts'] == {'crashes_read': 10, 'crashes_dropped': 2}
+    # Counts don't leak into the next stage
+    monkeypatch.setattr('data.propagate_volume.main', lambda args: None)
+    assert stages.run_stage('propagate_volume', [])['counts'] == {}
+
+
+def test_build(tmpdir, monkeypatch):
+    datadir = tmpdir.strpath
+    calls = []
+
+    # Each fake stage just copies its input to its output
+    def fake_run_stage(name, args, isolated=False):
+        calls.append((name, args))
+        with open(os.path.join(datadir, args[0])) as f:
+            contents = f.read()
+        with open(os.path.join(datadir, args[1]), 'w') as f:
+            f.write(contents)
+    monkeypatch.setattr(stages, 'run_stage', fake_run_stage)
+
+    config_file = os.path.join(datadir, 'config.yml')
+    with open(config_file, 'w') as f:
+        f.write("city: Boston\nname: boston\n")
+    with open(os.path.join(datadir, 'raw.txt'), 'w') as f:
+        f.write("raw")
+
+    def run_build(runtime_args=[], **kwargs):
+        calls.clear()
+        build = stages.Build(datadir, config_file=config_file, **kwargs)
+        build.run('standardize_crashes', ['raw.txt', 'std.txt'],
+                  inputs=['raw.txt'], outputs=['std.txt'],
+                  config_keys=['city'], force_args=['--forceupdate'])
+        build.run('join_segments_crash', ['std.txt', 'joined.txt'],
+                  inputs=['std.txt'], outputs=['joined.txt'],
+                  runtime_args=runtime_args)
+        with open(os.path.join(datadir, stages.MANIFEST_FILE)) as f:
+            return json.load(f)['stages']
+
+    manifest = run_build()
+    assert [x[0] for x in calls] == [
+        'standardize_crashes', 'join_segments_crash']
+    assert manifest['standardize_crashes']['reason'] == \
+        'no previous run recorded'
+
+    # Nothing changed, so nothing runs
+    manifest = run_build()
+    assert calls == []
+    assert manifest['join_segments_crash']['status'] == 'skipped'
+
+    # A changed input reruns that stage and everything downstream,
+    # with the stage's force arguments
+    with open(os.path.join(datadir, 'raw.txt'), 'w') as f:
+        f.write("new raw")
+    manifest = run_build()
+    assert calls == [
+        ('standardize_crashes', ['raw.txt', 'std.txt', '--forceupdate']),
+        ('join_segments_crash', ['std.txt', 'joined.txt']),
+    ]
+    assert manifest['standardize_crashes']['reason'] == \
+        'input raw.txt changed'
+    assert manifest['join_segments_crash']['reason'] == \
+        'input std.txt changed'
+
+    # A missing output only reruns the stage that writes it, since
+    # the rewritten output is the same as before
+    os.remove(os.path.join(datadir, 'std.txt'))
+    manifest = run_build()
+    assert [x[0] for x in calls] == ['standardize_crashes']
+    assert manifest['standardize_crashes']['reason'] == \
+        'output std.txt missing'
+
+    with open(config_file, 'w') as f:
+        f.write("city: Cambridge\nname: boston\n")
+    manifest = run_build()
+    assert manifest['standardize_crashes']['reason'] == \
+        'config value city changed'
+    assert manifest['join_segments_crash']['status'] == 'skipped'
+
+    # Arguments that only change how a stage runs don't rerun it
+    manifest = run_build(runtime_args=['--workers', '4'])
+    assert calls == []
+
+    manifest = run_build(forceupdate=True, runtime_args=['--workers', '4'])
+    assert len(calls) == 2
+    assert calls[1] == (
+        'join_segments_crash', ['std.txt', 'joined.txt', '--workers', '4'])
+    assert manifest['join_segments_crash']['reason'] == 'forced update'
+
+
+def test_build_run_parallel(tmpdir):
+    datadir = tmpdir.strpath
+    steps = [{
+        'name': 'propagate_volume',
+        'args': ['-d', datadir],
+    }, {
+        # Missing its required arguments, so this one fails
+        'name': 'standardize_volume',
+        'args': [],
+    }]
+
+    build = stages.Build(datadir)
+    with pytest.raises(SystemExit) as error:
+        build.run_parallel(steps, workers=2)
+    assert str(error.value) == 'standardize_volume failed'
+
+    with open(os.path.join(datadir, stages.MANIFEST_FILE)) as f:
+        manifest = json.load(f)['stages']
+    assert list(manifest.keys()) == ['propagate_volume', 'standardize_volume']
+    assert manifest['propagate_volume']['status'] == 'ran'
+    assert manifest['standardize_volume']['status'] == 'failed'
+
+    # Only the stage that failed is rerun
+    build = stages.Build(datadir)
+    with pytest.raises(SystemExit):
+        build.run_parallel(steps, workers=1)
+    assert build.manifest['stages']['propagate_volume']['status'] == \
+        'skipped'
+    assert build.manifest['stages']['standardize_volume']['reason'] == \
+        'previous run failed'
+
+    build = stages.Build(datadir)
+    assert build.run_parallel(steps[:1]) == [False]
+
+
+def test_write_run_manifest(tmpdir, monkeypatch):
+    datadir = tmpdir.strpath
+    wall_times = iter([1.5, 2.0, 1.0])
+    monkeypatch.setattr(stages, 'run_stage', lambda name, args, isolated: {
+        'wall_time': next(wall_times), 'cpu_time': 1.0, 'peak_rss_mb': 100.0,
+        'counts': {'segments_created': 5}})
+    with open(os.path.join(datadir, 'in.txt'), 'w') as f:
+        f.write("input")
+
+    first = datetime.datetime.now()
+    build = stages.Build(datadir, forceupdate=True)
+    build.run('create_segments', [], inputs=['in.txt'], outputs=['out.txt'])
+    build.run('add_map', [])
+    filename = stages.write_run_manifest(datadir, first)
+    with open(filename) as f:
+        run = json.load(f)
+    assert [x['stage'] for x in run['stages']] == [
+        'create_segments', 'add_map']
+    assert run['stages'][0]['input_sizes'] == {'in.txt': 5}
+    assert run['stages'][0]['output_sizes'] == {'out.txt': None}
+    assert run['previous'] is None
+
+    second = datetime.datetime.now()
+    build = stages.Build(datadir, forceupdate=True)
+    build.run('create_segments', [], inputs=['in.txt'], outputs=['out.txt'])
+    filename = stages.write_run_manifest(datadir, second)
+    with open(filename) as f:
+        run = json.load(f)
+    assert [x['stage'] for x in run['stages']] == ['create_segments']
+    assert run['previous'] == 'run_{}.json'.format(
+        first.strftime('%Y%m%d_%H%M%S_%f'))
+    comparison = run['comparison']['create_segments']
+    assert comparison['wall_time'] == {
+        'previous': 1.5, 'current': 1.0, 'change': -0.5}
+    assert comparison['segments_created']['change'] == 0
@@ -1,6 +1,8 @@
 from .. import util
 from ..segment import Segment
 import os
+import json
+import pytest
 from shapely.geometry import Point, LineString, MultiLineString
 import fiona
 import geojson
@@ -38,6 +40,99 @@ def test_reproject_records():
     # successfully get reprojected
     assert len(start_lines) == len(result)
 
+    # All coordinates are transformed at once, but the results are the
+    # same as transforming each one; other geometry types are left out
+    records = [
+        {'geometry': {'type': 'Point', 'coordinates': (-71.1, 42.3, 5)},
+         'properties': {'id': 1}},
+        {'geometry': {'type': 'Polygon', 'coordinates': [[
+            (-71.1, 42.3), (-71.0, 42.3), (-71.0, 42.4), (-71.1, 42.3)]]},
+         'properties': {'id': 2}},
+        {'geometry': {'type': 'MultiLineString', 'coordinates': [
+            [(-71.1, 42.3), (-71.0, 42.3)], [(-71.0, 42.3), (-71.0, 42.4)]]},
+         'properties': {'id': 3}},
+        {'geometry': {'type': 'LineString', 'coordinates': [
+            (-71.2, 42.3), (-71.1, 42.35), (-71.0, 42.3)]},
+         'properties': {'id': 4}},
+    ]
+    result = util.reproject_records(records)
+    assert [x['properties']['id'] for x in result] == [1, 3, 4]
+
+    def transform(coords):
+        return [util.transformer_4326_to_3857.transform(x[0], x[1])
+                for x in coords]
+    assert result[0]['geometry'] == Point(
+        transform([records[0]['geometry']['coordinates']])[0])
+    assert result[1]['geometry'] == MultiLineString([
+        transform(x) for x in records[2]['geometry']['coordinates']])
+    assert result[2]['geometry'] == LineString(
+        transform(records[3]['geometry']['coordinates']))
+
+
+def test_make_records():
+    items = [{'id': i, 'location': {
+        'latitude': 42.3 + i / 100., 'longitude': -71.1}} for i in range(3)]
+    records = util.make_records(items, 'crash')
+    assert [type(x) for x in records] == [util.Crash] * 3
+    for item, record in zip(items, records):
+        assert record.properties is item
+        assert record.point == util.get_reproject_point(
+            item['location']['latitude'], item['location']['longitude'],
+            util.transformer_4326_to_3857)
+    assert util.make_records([], 'record') == []
+
+
+def test_record_batch():
+    items = [{
+        'id': i,
+        'dateOccurred': date,
+        'location': {'latitude': 42.3 + i / 100., 'longitude': -71.1},
+    } for i, date in enumerate([
+        '2016-01-01T23:30:00-05:00', '2016-01-02T01:00:00Z',
+        '2016-01-02 10:00:00'])]
+    items[1]['bike'] = 1
+    records = util.RecordBatch.from_items(items, 'crash', ['bike'])
+
+    # Records have the same API as Crashes
+    crashes = util.make_records(items, 'crash')
+    assert len(records) == 3
+    for record, crash in zip(records, crashes):
+        assert record.properties is crash.properties
+        assert record.point == crash.point
+        assert record.timestamp == crash.timestamp
+        assert record.near_id is None
+    assert records[-1].properties['id'] == 2
+    assert records.flags['bike'].tolist() == [False, True, False]
+
+    records[0].near_id = '001'
+    assert records.near_ids.tolist() == ['001', None, None]
+    assert records[0].properties['near_id'] == '001'
+
+    # Dates without a time zone are in each crash's local time
+    start = util.parse('2016-01-02')
+    assert records.in_range(start=start).tolist() == [False, True, True]
+    assert records.in_range(start=util.parse(
+        '2016-01-02T00:00:00Z')).tolist() == [True, True, True]
+    assert records.in_range(end=start).tolist() == [True, False, False]
+
+    subset = records[records.flags['bike']]
+    assert [x.properties['id'] for x in subset] == [1]
+    joined = util.RecordBatch.concatenate([records[:1], subset])
+    assert [x.properties['id'] for x in joined] == [0, 1]
+    assert joined.flags['bike'].tolist() == [False, True]
+    assert joined.timestamps.tolist() == [
+        records.timestamps[0], records.timestamps[1]]
+
+    # Snapped all at once
+    segments, index = util.index_segments([Segment(
+        LineString([crashes[0].point, crashes[1].point]), {'id': '002'})],
+        segment=True)
+    util.find_nearest(records, segments, index, 30, verbose=False)
+    assert records.near_ids.tolist() == ['002', '002', '']
+    assert list(records.iter_properties(records.near_ids != '')) == \
+        items[:2]
+    assert items[1]['near_id'] == '002'
+
 
 def test_group_json_by_location(tmpdir):
 
@@ -232,3 +327,134 @@ def test_output_from_shapes(tmpdir):
             items['features'][1]['geometry']['coordinates'][0][0],
             [-71.11198305054148, 42.37143999999999])
 
+
+
+def test_iter_json_records(tmpdir):
+    items = [{'id': i, 'name': 'x' * i, 'values': [1, {'a': None}]}
+             for i in range(50)]
+
+    path = os.path.join(tmpdir.strpath, 'records.json')
+    with open(path, 'w') as f:
+        json.dump(items, f)
+    # Small chunks, so items are split across reads
+    assert list(util.iter_json_records(path, chunk_size=7)) == items
+
+    # json lines
+    with open(path, 'w') as f:
+        f.write('\n'.join(json.dumps(x) for x in items) + '\n')
+    assert list(util.iter_json_records(path, chunk_size=7)) == items
+
+    with open(path, 'w') as f:
+        f.write('  [ ] ')
+    assert list(util.iter_json_records(path, chunk_size=2)) == []
+
+    with open(path, 'w') as f:
+        f.write('[{"id": 1}, {"id"')
+    with pytest.raises(ValueError):
+        list(util.iter_json_records(path, chunk_size=4))
+
+    # Writing from a generator gives the same file as json.dump
+    util.write_json_records((x for x in items), path)
+    with open(path) as f:
+        assert f.read() == json.dumps(items)
+
+
+def test_iter_records(tmpdir):
+    crashes = [{
+        'id': i,
+        'dateOccurred': '2016-0{}-15T10:00:00-05:00'.format(i),
+        'location': {'latitude': 42.37, 'longitude': -71.11},
+    } for i in range(1, 6)]
+    path = os.path.join(tmpdir.strpath, 'crashes.json')
+    with open(path, 'w') as f:
+        json.dump(crashes, f)
+
+    records = util.iter_records(path, 'crash')
+    assert not isinstance(records, list)
+    assert [x.properties['id'] for x in records] == [1, 2, 3, 4, 5]
+
+    # Filtered as it's read; dates without a time zone are local time
+    records = util.iter_records(
+        path, 'crash', startdate='2016-02-15', enddate='2016-04-14')
+    assert [x.properties['id'] for x in records] == [2, 3]
+    records = util.read_records(path, 'crash', enddate='2016-04-15')
+    assert [x.properties['id'] for x in records] == [1, 2, 3, 4]
+
+
+def test_batches():
+    assert list(util.batches(iter(range(5)), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(util.batches([], 2)) == []
+
+
+def test_write_segments(tmpdir):
+    inters = [Segment(MultiLineString([
+        [(0, 0), (10, 0)], [(0, 0), (0, 10)]]), {'id': 1, 'width': 5})]
+    non_inters = [
+        Segment(LineString([(10, 0), (100, 0)]),
+                {'id': '000', 'width': float('nan')}),
+        Segment(LineString([(0, 10), (0, 100)]), {'id': '001'}),
+    ]
+    util.write_segments(non_inters, inters, tmpdir.strpath, fmt='geojson')
+
+    # Same files as writing whole feature collections at once
+    def expected(segments):
+        return geojson.dumps(util.prepare_geojson([{
+            'geometry': x.geometry.__geo_interface__,
+            'properties': x.properties} for x in segments]), allow_nan=True)
+
+    for segments, name in [
+            (non_inters, 'non_inters_segments'),
+            (inters, 'inters_segments'),
+            (non_inters + inters, 'inter_and_non_int')]:
+        with open(os.path.join(tmpdir.strpath, name + '.geojson')) as f:
+            assert f.read() == expected(segments)
+
+    path = os.path.join(tmpdir.strpath, 'empty.geojson')
+    assert util.write_records_to_geojson([], path) == 0
+    with open(path) as f:
+        assert geojson.load(f) == geojson.FeatureCollection([])
+
+
+def test_open_segments_index(tmpdir, monkeypatch):
+    mapfp = tmpdir.strpath
+    inters = [Segment(MultiLineString([[(0, 0), (10, 0)], [(0, 0), (0, 10)]]),
+                      {'id': 1})]
+    non_inters = [Segment(LineString([(10, 0), (100, 0)]), {'id': '000'}),
+                  Segment(LineString([(0, 10), (0, 100)]), {'id': '001'})]
+
+    # Written along with the segments, without reading them back
+    monkeypatch.setattr(util, 'read_segment_file', None)
+    util.write_segments(non_inters, inters, mapfp, fmt='geojson')
+    monkeypatch.undo()
+    basename = os.path.join(mapfp, util.SEGMENTS_INDEX)
+    assert os.path.exists(basename + '.idx')
+
+    # Opened rather than rebuilt, while the segments are unchanged
+    monkeypatch.setattr(util, 'bulk_index', None)
+    segments, index = util.read_segments(dirname=mapfp)
+    assert sorted(index.intersection((50, -1, 60, 1))) == [1]
+    assert sorted(index.intersection((-200, -200, 200, 200))) == [0, 1, 2]
+    index.close()
+    segments, index = util.read_segments(dirname=mapfp)
+    assert sorted(index.intersection((-1, 50, 1, 60))) == [2]
+    index.close()
+    monkeypatch.undo()
+
+    # Rebuilt when they change
+    non_inters[0] = Segment(LineString([(10, 500), (100, 500)]),
+                            {'id': '000'})
+    with open(basename + '.json') as f:
+        fingerprint = json.load(f)['fingerprint']
+    util.write_segments(non_inters, inters, mapfp, fmt='geojson')
+    with open(basename + '.json') as f:
+        assert json.load(f)['fingerprint'] != fingerprint
+    segments, index = util.read_segments(dirname=mapfp)
+    assert sorted(index.intersection((50, -1, 60, 1))) == []
+    assert sorted(index.intersection((50, 499, 60, 501))) == [1]
+    index.close()
+
+    # Or when it's missing, from the segments read
+    os.remove(basename + '.json')
+    segments, index = util.read_segments(dirname=mapfp)
+    assert sorted(index.intersection((50, 499, 60, 501))) == [1]
+    assert os.path.exists(basename + '.json')
@@ -5,12 +5,18 @@ import rtree
 from matplotlib import pyplot
 import os
 import json
+import hashlib
 from dateutil.parser import parse
 import datetime
-from .record import Crash, Record
+import numpy as np
+import shapely
+from .record import Crash, Record, RecordBatch
 import geojson
 from collections import OrderedDict
 from .segment import Segment
+from . import columnar
+from .geometry import center_points
+from . import snapping
 from .record import transformer_4326_to_3857, transformer_3857_to_4326
 
 
@@ -23,6 +29,17 @@ BASE_DIR = os.path.dirname(
 MAP_FP = BASE_DIR + '/data/processed/maps'
 PROCESSED_DATA_FP = BASE_DIR + '/data/processed/'
 
+# Geometry types reproject_records handles; records with
+# other types of geometry are left out
+REPROJECTED_TYPES = ['Point', 'LineString', 'MultiLineString']
+
+# Number of records reprojected together when they're read or written
+# a batch at a time
+BATCH_SIZE = 10000
+
+# Basename of the spatial index of a map's segments, kept in its directory
+SEGMENTS_INDEX = 'segments_index'
+
 
 
 def get_hourly_rates(volume_file):
@@ -68,7 +85,13 @@ def plot_hourly_rates(all_counts, outfile):
 
 def read_geojson(fp):
     """ Read geojson file, reproject to 3857, and
-    output tuple geometry + property """
+    output tuple geometry + property
+    If the file is stored as parquet instead, read that """
+
+    if columnar.stored_format(fp) == 'parquet':
+        properties, geometries = columnar.read_table(
+            columnar.intermediate_file(fp))
+        return [Segment(x, y) for x, y in zip(geometries, properties)]
 
     with open(fp) as f:
         data = json.load(f)
@@ -110,58 +133,64 @@ def read_records_from_geojson(filename):
         A list of Records
     """
 
-    records = []
+    items = []
     with open(filename) as f:
-        items = geojson.load(f)
-        for item in items['features']:
+        features = geojson.load(f)
+        for item in features['features']:
             properties = item['properties']
             properties['location'] = {
                 'latitude': item['geometry']['coordinates'][1],
                 'longitude': item['geometry']['coordinates'][0]
             }
-            record = Record(properties)
-            records.append(record)
-    return records
+            items.append(properties)
+    return make_records(items, 'record')
+
+
+def make_records(items, record_type):
+    """
+    Turns a list of dicts with a location into Crashes or Records,
+    reprojecting all of their points to 3857 projection at once
+    Args:
+        items - list of dicts
+        record_type - 'crash' for Crashes, otherwise Records
+    Returns:
+        list of Crashes or Records
+    """
+    x, y = transform_coords(
+        [x['location']['longitude'] for x in items],
+        [x['location']['latitude'] for x in items],
+        transformer_4326_to_3857)
+    record_class = Crash if record_type == 'crash' else Record
+    return [record_class(item, point)
+            for item, point in zip(items, shapely.points(x, y))]
 
 
 def read_records(filename, record_type,
-                 startdate=None, enddate=None):
+                 startdate=None, enddate=None, split_columns=[]):
     """
     Reads appropriately formatted json file,
     pulls out currently relevant features,
     converts latitude and longitude to projection 4326, and turns into
-    a Crash object
+    a batch of records
     Args:
         filename - json file
         start - optionally give start for date range of crashes
         end - optionally give end date after which to exclude crashes
+        split_columns - properties to keep flags for, see RecordBatch
     Returns:
-        A list of Crashes
+        A RecordBatch
     """
 
-    records = []
-    items = json.load(open(filename))
-    if not items:
-        return []
-
-    for item in items:
-        record = None
-        if record_type == 'crash':
-            record = Crash(item)
-        else:
-            record = Record(item)
-        records.append(record)
-
-    if startdate:
-        records = [x for x in records if x.timestamp >= parse(startdate)]
-    if enddate:
-        records = [x for x in records
-                   if x.timestamp < parse(enddate) + datetime.timedelta(1)]
+    records = RecordBatch.concatenate(list(iter_record_batches(
+        filename, record_type, startdate, enddate,
+        split_columns=split_columns)), record_type, split_columns)
+    if not len(records):
+        return records
 
     # Keep track of the earliest and latest crash date used
-    start = min([x.timestamp for x in records])
-    end = max([x.timestamp for x in records])
-    if start and end:
+    if records.timestamps is not None:
+        start = records.timestamps.min().astype(datetime.datetime)
+        end = records.timestamps.max().astype(datetime.datetime)
         print("Read in data from {} crashes from {} to {}".format(
             len(records), start.date(), end.date()))
     print("Read in data from {} records".format(len(records)))
@@ -169,52 +198,193 @@ def read_records(filename, record_type,
     return records
 
 
+def iter_records(filename, record_type, startdate=None, enddate=None,
+                 batch_size=BATCH_SIZE):
+    """
+    Reads records one at a time from a json, json lines or parquet file,
+    so the whole file is never held in memory. See iter_record_batches
+    Yields:
+        records with the same API as Crashes or Records
+    """
+    for batch in iter_record_batches(
+            filename, record_type, startdate, enddate, batch_size):
+        for record in batch:
+            yield record
+
+
+def iter_record_batches(filename, record_type, startdate=None, enddate=None,
+                        batch_size=BATCH_SIZE, split_columns=[]):
+    """
+    Reads records a batch at a time from a json, json lines or parquet
+    file, so the whole file is never held in memory. Crashes outside the
+    date range are dropped from each batch
+    Args:
+        filename - json file
+        record_type - 'crash' for crashes, otherwise records
+        startdate - optionally give start for date range of crashes
+        enddate - optionally give end date after which to exclude crashes
+        batch_size - number of records read at once
+        split_columns - properties to keep flags for, see RecordBatch
+    Yields:
+        RecordBatches
+    """
+    start = parse(startdate) if startdate else None
+    end = parse(enddate) + datetime.timedelta(1) if enddate else None
+
+    items = iter_json_records(filename)
+    if record_type != 'crash' and (start or end):
+        items = (x for x in items if _in_range(x['timestamp'], start, end))
+    for batch in batches(items, batch_size):
+        records = RecordBatch.from_items(batch, record_type, split_columns)
+        if record_type == 'crash' and (start or end):
+            records = records.take(records.in_range(start, end))
+        if len(records):
+            yield records
+
+
+def _in_range(timestamp, start, end):
+    if start and not _before(start, timestamp):
+        return False
+    return not (end and _before(end, timestamp))
+
+
+def _before(date, timestamp):
+    """
+    Whether date is at or before timestamp. A date given without a
+    time zone is taken to be in the timestamp's time zone
+    """
+    if date.tzinfo is None and timestamp.tzinfo is not None:
+        timestamp = timestamp.replace(tzinfo=None)
+    return date <= timestamp
+
+
+def iter_json_records(filename, chunk_size=2 ** 16):
+    """
+    Reads the items in a file written by write_json_records one at a time.
+    json files can hold either a list of items or one item per line
+    (json lines); parquet files are read a batch of rows at a time
+    Args:
+        filename - the file's json path
+        chunk_size - number of characters to read from a json file at once
+    Yields:
+        dicts
+    """
+    if columnar.stored_format(filename) == 'parquet':
+        for item in columnar.iter_table(columnar.intermediate_file(filename)):
+            yield item
+        return
+
+    decoder = json.JSONDecoder()
+    with open(filename) as f:
+        buf = f.read(chunk_size)
+        done = not buf
+        pos = _skip(buf, 0, ' \t\r\n')
+        while pos == len(buf) and not done:
+            buf = f.read(chunk_size)
+            done = not buf
+            pos = _skip(buf, 0, ' \t\r\n')
+        in_list = buf[pos:pos + 1] == '['
+        if in_list:
+            pos += 1
+        while True:
+            pos = _skip(buf, pos, ' \t\r\n,' if in_list else ' \t\r\n')
+            # Read more once what's left of the buffer has been used up,
+            # or may only hold part of the next item
+            if pos == len(buf) and not done:
+                buf = f.read(chunk_size)
+                done = not buf
+                pos = 0
+                continue
+            if pos == len(buf) or (in_list and buf[pos] == ']'):
+                return
+            try:
+                item, item_end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                item_end = None
+            if item_end is None or (item_end == len(buf) and not done):
+                if done:
+                    raise ValueError(
+                        "Can't read item at end of {}".format(filename))
+                more = f.read(chunk_size)
+                done = not more
+                buf = buf[pos:] + more
+                pos = 0
+                continue
+            yield item
+            pos = item_end
+
+
+def _skip(buf, pos, chars):
+    while pos < len(buf) and buf[pos] in chars:
+        pos += 1
+    return pos
+
+
+def batches(items, size):
+    """
+    Splits an iterable of items into lists of at most size items
+    """
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
 def find_nearest(records, segments, segments_index, tolerance,
-                 type_record=False):
+                 type_record=False, verbose=True, tree=None, workers=1):
     """ Finds nearest segment to records
+    records : a RecordBatch, or a list of Records (if type_record)
+        or of dicts with a point and properties
     tolerance : max units distance from record point to consider
+    segments_index : rtree index of the segments. Candidates are the
+        segments it would return, but of equally near ones the first in
+        the list is chosen, however the index orders them
+    verbose : whether to print the tolerance; turned off when
+        records are snapped a batch at a time
+    tree : a snapping.SegmentTree or SnapPool of the segments, made if not
+        given; pass one in when snapping several batches to the same segments
+    workers : number of processes to snap with, if tree isn't given
+    Returns the distance from each record to its nearest segment,
+    nan where there isn't one
     """
 
-    print("Using tolerance {}".format(tolerance))
-
-    for record in records:
+    if verbose:
+        print("Using tolerance {}".format(tolerance))
 
+    if isinstance(records, RecordBatch):
+        coords = records.coords
+    else:
         # We are in process of transition to using Record class
         # but haven't converted it everywhere, so until we do, need
         # to look at whether the records are of type record or not
-        record_point = None
-        if type_record:
-            record_point = record.point
-        else:
-            record_point = record['point']
-
-        record_buffer_bounds = record_point.buffer(tolerance).bounds
-        nearby_segments = segments_index.intersection(record_buffer_bounds)
+        points = [record.point if type_record else record['point']
+                  for record in records]
+        coords = shapely.get_coordinates(points)
 
-        segment_id_with_distance = [
-            # Get db index and distance to point
-            (
-                segments[segment_id].properties['id'],
-                segments[segment_id].geometry.distance(record_point)
-            )
-            for segment_id in nearby_segments
-        ]
-
-        # Find nearest segment
-        if len(segment_id_with_distance):
-            nearest = min(segment_id_with_distance, key=lambda tup: tup[1])
-            db_segment_id = nearest[0]
-            # Add db_segment_id to record
-            if type_record:
-                record.near_id = db_segment_id
-            else:
-                record['properties']['near_id'] = db_segment_id
-        # If no segment matched, populate key = ''
+    if tree is not None:
+        nearest, distances = tree.nearest(coords, tolerance)
+    else:
+        with snapping.SnapPool(
+                snapping.SegmentTree(segments), workers) as pool:
+            nearest, distances = pool.nearest(coords, tolerance)
+
+    # If no segment matched, populate key = ''
+    segment_ids = np.array(
+        [x.properties['id'] for x in segments] + [''], dtype=object)
+    if isinstance(records, RecordBatch):
+        records.near_ids = segment_ids[nearest]
+        return distances
+
+    for record, segment_id in zip(records, segment_ids[nearest]):
+        if type_record:
+            record.near_id = segment_id
         else:
-            if type_record:
-                record.near_id = ''
-            else:
-                record['properties']['near_id'] = ''
+            record['properties']['near_id'] = segment_id
+    return distances
 
 
 def read_segments(dirname=MAP_FP, get_inter=True, get_non_inter=True):
@@ -234,24 +404,37 @@ def read_segments(dirname=MAP_FP, get_inter=True, get_non_inter=True):
     non_inter = []
 
     if get_inter:
-        inter = fiona.open(dirname + '/inters_segments.geojson')
-        inter = reproject_records([x for x in inter])
-        inter = [{
-            'geometry': mapping(x['geometry']),
-            'properties': x['properties']} for x in inter]
+        inter = read_segment_file(dirname + '/inters_segments.geojson')
 
     if get_non_inter:
-        non_inter = fiona.open(
+        non_inter = read_segment_file(
             dirname + '/non_inters_segments.geojson')
-        non_inter = reproject_records([x for x in non_inter])
-        non_inter = [{
-            'geometry': mapping(x['geometry']),
-            'properties': x['properties']} for x in non_inter]
 
     print("Read in {} intersection, {} non-intersection segments".format(
         len(inter), len(non_inter)))
 
-    return index_segments(list(inter) + list(non_inter))
+    if get_inter and get_non_inter:
+        return inter + non_inter, open_segments_index(
+            dirname, inter + non_inter)
+    return index_segments(inter + non_inter, segment=True)
+
+
+def read_segment_file(filename):
+    """
+    Reads a segment file written by write_segments, in whichever
+    format it's stored
+    Args:
+        filename - the segment file's geojson path
+    Returns:
+        list of Segments in 3857 projection
+    """
+    if columnar.stored_format(filename) == 'parquet':
+        return read_geojson(filename)
+
+    segments = fiona.open(filename)
+    segments = reproject_records([x for x in segments])
+    return [Segment(shape(mapping(x['geometry'])), x['properties'])
+            for x in segments]
 
 
 def index_segments(segments, geojson=True, segment=False):
@@ -274,13 +457,106 @@ def index_segments(segments, geojson=True, segment=False):
         combined_seg = [Segment(shape(x['geometry']), x['properties']) for x in
                         segments]
     # Create spatial index for quick lookup
-    segments_index = rtree.index.Index()
-    for idx, element in enumerate(combined_seg):
-        segments_index.insert(idx, element.geometry.bounds)
+    segments_index = bulk_index([x.geometry.bounds for x in combined_seg])
 
     return combined_seg, segments_index
 
 
+def bulk_index(bounds, basename=None):
+    """
+    Makes a spatial index, loading all the bounds at once,
+    which is much faster than inserting them one at a time
+    Args:
+        bounds - list of (minx, miny, maxx, maxy), indexed by position
+        basename - if given, the index is written to basename.idx
+            and basename.dat, otherwise it's kept in memory
+    Returns:
+        rtree index
+    """
+    if not bounds:
+        return rtree.index.Index(basename) if basename \
+            else rtree.index.Index()
+    stream = ((idx, bound, None) for idx, bound in enumerate(bounds))
+    if basename:
+        return rtree.index.Index(basename, stream)
+    return rtree.index.Index(stream)
+
+
+def segments_fingerprint(dirname):
+    """
+    Hash the contents of a map's intersection and non-intersection
+    segment files, in whichever format they're stored
+    Args:
+        dirname - maps directory
+    Returns:
+        hex digest string
+    """
+    sha = hashlib.sha256()
+    for name in ['inters_segments.geojson', 'non_inters_segments.geojson']:
+        filename = columnar.intermediate_file(os.path.join(dirname, name))
+        sha.update(os.path.basename(filename).encode())
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(2 ** 20), b''):
+                sha.update(chunk)
+    return sha.hexdigest()
+
+
+def open_segments_index(dirname, segments):
+    """
+    Opens the spatial index of a map's segments saved in its directory,
+    so it doesn't have to be rebuilt by every stage that reads the map.
+    It's rebuilt if it's missing, or the segment files have changed
+    since it was built
+    Args:
+        dirname - maps directory
+        segments - the map's intersection segments followed by its
+            non-intersection segments, as read_segments reads them
+    Returns:
+        rtree index of the segments, by position in the list
+    """
+    basename = os.path.join(dirname, SEGMENTS_INDEX)
+    fingerprint = segments_fingerprint(dirname)
+    try:
+        with open(basename + '.json') as f:
+            saved = json.load(f)
+    except (IOError, ValueError):
+        saved = {}
+    if saved.get('fingerprint') == fingerprint \
+       and saved.get('count') == len(segments) \
+       and os.path.exists(basename + '.idx') \
+       and os.path.exists(basename + '.dat'):
+        return rtree.index.Index(basename)
+
+    write_segments_index(dirname, [x.geometry.bounds for x in segments])
+    return rtree.index.Index(basename)
+
+
+def write_segments_index(dirname, bounds):
+    """
+    Builds the spatial index of a map's segments and saves it in its
+    directory, for open_segments_index. The segment files have to be
+    written first, as the index is only valid for the files it was
+    built alongside
+    Args:
+        dirname - maps directory
+        bounds - list of the bounds of the map's intersection segments
+            followed by its non-intersection segments, in 3857 projection
+    """
+    print("Building spatial index of segments in {}".format(dirname))
+    basename = os.path.join(dirname, SEGMENTS_INDEX)
+    if os.path.exists(basename + '.json'):
+        os.remove(basename + '.json')
+
+    # Built under a temporary name, so an interrupted build is never opened
+    tmp_basename = '{}_{}'.format(basename, os.getpid())
+    bulk_index(bounds, tmp_basename).close()
+    for ext in ['.idx', '.dat']:
+        os.replace(tmp_basename + ext, basename + ext)
+    with open(basename + '.json', 'w') as f:
+        json.dump({'fingerprint': segments_fingerprint(dirname),
+                   'count': len(bounds)}, f)
+
+
 def group_json_by_field(items, field):
     results = {}
     for item in items:
@@ -337,15 +613,14 @@ def reproject(coords, transformer=None):
     Returns:
         new_coords = a list of reprojected json points
     """
-    new_coords = []
     if not transformer:
         transformer = transformer_4326_to_3857
 
-    for coord in coords:
-        re_point = transformer.transform(coord[0], coord[1])
-        point = Point(re_point)
-        new_coords.append(mapping(point))
-    return new_coords
+    coords = np.array([(x[0], x[1]) for x in coords], dtype=float)
+    if not len(coords):
+        return []
+    x, y = transform_coords(coords[:, 0], coords[:, 1], transformer)
+    return [mapping(point) for point in shapely.points(x, y)]
 
 
 def reproject_records(records, transformer=None):
@@ -358,60 +633,199 @@ def reproject_records(records, transformer=None):
     Returns:
         list of reprojected records
     """
-    results = []
-
     if not transformer:
         transformer = transformer_4326_to_3857
 
+    records = [x for x in records
+               if x['geometry']['type'] in REPROJECTED_TYPES]
+
+    # Flatten the coordinates of all the records, so they can be
+    # transformed in one call. Each coordinate is given the number of
+    # the line it's on, each line in a multiline string the number of
+    # the multiline string, and each record the number of its
+    # point, line or multiline string
+    point_coords = []
+    line_coords = []
+    line_ids = []
+    multi_lines = []
+    multi_ids = []
+    record_ids = []
+    lines = 0
+    multis = 0
     for record in records:
-        coords = record['geometry']['coordinates']
-        if record['geometry']['type'] == 'Point':
-            re_point = transformer.transform(coords[0], coords[1])
-            point = Point(re_point)
-            results.append({'geometry': point,
-                            'properties': record['properties']})
-        elif record['geometry']['type'] == 'MultiLineString':
-            new_coords = []
-            for segment in coords:
-                new_segment = []
-                for coord in segment:
-                    new_segment.append(transformer.transform(
-                        coord[0], coord[1]))
-                new_coords.append(new_segment)
-
-            results.append({'geometry': MultiLineString(new_coords),
-                            'properties': record['properties']})
-        elif record['geometry']['type'] == 'LineString':
-            new_coords = []
-            for coord in coords:
-                new_coords.append(
-                    transformer.transform(coord[0], coord[1])
-                )
-            results.append({'geometry': LineString(new_coords),
-                            'properties': record['properties']})
+        geometry = record['geometry']
+        if geometry['type'] == 'Point':
+            record_ids.append(len(point_coords))
+            point_coords.append(geometry['coordinates'][:2])
+            continue
 
-    return results
+        multi = geometry['type'] == 'MultiLineString'
+        record_ids.append(multis if multi else lines)
+        for part in geometry['coordinates'] if multi \
+                else [geometry['coordinates']]:
+            line_coords.extend(x[:2] for x in part)
+            line_ids.extend([lines] * len(part))
+            if multi:
+                multi_lines.append(lines)
+                multi_ids.append(multis)
+            lines += 1
+        multis += multi
+
+    coords = np.array(
+        point_coords + line_coords, dtype=float).reshape(-1, 2)
+    if len(coords):
+        coords = np.column_stack(
+            transform_coords(coords[:, 0], coords[:, 1], transformer))
+
+    # Rebuild the geometries from the transformed coordinates
+    geometries = {
+        'Point': shapely.points(coords[:len(point_coords)]),
+        'LineString': np.array([LineString()] * lines, dtype=object),
+        'MultiLineString': np.array(
+            [MultiLineString()] * multis, dtype=object),
+    }
+    if line_ids:
+        shapely.linestrings(coords[len(point_coords):], indices=line_ids,
+                            out=geometries['LineString'])
+    if multi_ids:
+        shapely.multilinestrings(
+            geometries['LineString'][multi_lines], indices=multi_ids,
+            out=geometries['MultiLineString'])
+
+    return [{
+        'geometry': geometries[record['geometry']['type']][record_id],
+        'properties': record['properties']
+    } for record, record_id in zip(records, record_ids)]
+
+
+def transform_coords(x, y, transformer):
+    """
+    Transforms arrays of x and y coordinates in one call
+    Args:
+        x, y - lists or arrays of coordinates
+        transformer - a pyproj transformer object
+    Returns:
+        arrays of transformed x and y coordinates
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if len(x) == 1:
+        # pyproj treats single element arrays as scalars, which is
+        # deprecated in numpy, so transform them as scalars
+        x, y = transformer.transform(x[0], y[0])
+        return np.array([x]), np.array([y])
+    return transformer.transform(x, y)
+
+
+def reproject_geometries(geometries, transformer=None):
+    """
+    Reprojects shapely geometries from one projection to another,
+    transforming the coordinates of all of them in one call
+    Args:
+        geometries - list of shapely geometries
+        optional: transformer object (if not given, defaults to 4326->3857)
+    Returns:
+        list of reprojected geometries, in 2d
+    """
+    if not transformer:
+        transformer = transformer_4326_to_3857
+
+    geometries = shapely.force_2d(np.array(geometries, dtype=object))
+    coords = shapely.get_coordinates(geometries)
+    if len(coords):
+        x, y = transform_coords(coords[:, 0], coords[:, 1], transformer)
+        geometries = shapely.set_coordinates(
+            geometries, np.column_stack([x, y]))
+    return list(geometries)
+
+
+class GeojsonWriter(object):
+    """
+    Writes a geojson feature collection a feature at a time,
+    so the whole collection never needs to be held in memory.
+    The file is the same as geojson.dump would write
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.count = 0
+        self.file = open(filename, 'w')
+        self.file.write('{"type": "FeatureCollection", "features": [')
+
+    def write(self, feature):
+        """
+        Args:
+            feature - a geojson Feature, or one already
+                serialized with dump_feature
+        """
+        if not isinstance(feature, str):
+            feature = dump_feature(feature)
+        if self.count:
+            self.file.write(', ')
+        self.file.write(feature)
+        self.count += 1
+
+    def close(self):
+        self.file.write(']}')
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def dump_feature(feature):
+    """
+    Serialize a geojson Feature the way geojson.dump does
+    """
+    return json.dumps(feature, cls=geojson.GeoJSONEncoder, allow_nan=True)
+
+
+def make_features(records):
+    """
+    Makes geojson features from records with shapely geometries in 3857
+    projection, reprojecting to 4326, the way prepare_geojson does
+    Args:
+        records - list of objects that contain geometry and properties
+    Returns:
+        list of geojson Features; records with other types of
+        geometry are left out
+    """
+    records = [x for x in records
+               if x.geometry.geom_type in REPROJECTED_TYPES]
+    geometries = reproject_geometries(
+        [x.geometry for x in records], transformer_3857_to_4326)
+    return [_make_feature(geometry, record.properties)
+            for geometry, record in zip(geometries, records)]
+
+
+def _make_feature(geometry, properties):
+    return geojson.Feature(
+        geometry=mapping(geometry),
+        id=properties['id'] if 'id' in properties else '',
+        # properties are usually Fiona.model.Feature - circular ref error
+        properties=OrderedDict(properties))
 
 
 def write_records_to_geojson(records, outfilename):
     """
     Given a list of record objects, write them to geojson file
+    a record at a time
     Args:
-        records - a list of objects that contain geometry and properties
+        records - a list or other iterable of objects
+            that contain geometry and properties
         outfilename - geojson file to write to
     Returns:
-        records as a geojson list
+        number of records written
     """
 
-    records = [{
-        'geometry': mapping(record.geometry),
-        'properties': OrderedDict(record.properties)
-        } for record in records]
-
-    records = prepare_geojson(records)
-    with open(outfilename, 'w') as outfile:
-        geojson.dump(records, outfile, allow_nan=True)
-    return records
+    with GeojsonWriter(outfilename) as writer:
+        for batch in batches(records, BATCH_SIZE):
+            for feature in make_features(batch):
+                writer.write(feature)
+    return writer.count
 
 
 def prepare_geojson(elements):
@@ -425,11 +839,8 @@ def prepare_geojson(elements):
     """
 
     elements = reproject_records(elements, transformer_3857_to_4326)
-    results = [geojson.Feature(
-        geometry=mapping(x['geometry']),
-        id=x['properties']['id'] if 'id' in x['properties'] else '',
-        # properties are usually Fiona.model.Feature - circular ref error
-        properties=OrderedDict(x['properties'])) for x in elements]
+    results = [_make_feature(x['geometry'], x['properties'])
+               for x in elements]
 
     return geojson.FeatureCollection(results)
 
@@ -460,28 +871,10 @@ def get_center_point(segment):
     Returns:
         x, y tuple for the centerpoint
     """
-    if not segment.geometry.is_empty:
-        if segment.geometry.geom_type == 'LineString':
-            point = segment.geometry.interpolate(
-                .5, normalized=True)
-            return point.x, point.y
-        elif segment.geometry.geom_type == 'MultiLineString':
-            lines = [x for x in [line for line in segment.geometry.geoms]]
-            coords = []
-            for line in lines:
-                coords.extend([x for x in line.coords])
-
-            minx = min([x[0] for x in coords])
-            maxx = max([x[0] for x in coords])
-            miny = min([x[1] for x in coords])
-            maxy = max([x[1] for x in coords])
-            point = LineString([[minx, miny], [maxx, maxy]]).interpolate(
-                .5, normalized=True)
-            point = segment.geometry.interpolate(segment.geometry.project(point))
-
-            return point.x, point.y
-
-    return None, None
+    x, y = center_points([segment.geometry])[0]
+    if np.isnan(x):
+        return None, None
+    return float(x), float(y)
 
 
 def get_roads_and_inters(filename):
@@ -565,29 +958,95 @@ def output_from_shapes(items, filename):
         geojson.dump(geojson.FeatureCollection(output), outfile, allow_nan=True)
 
 
-def write_segments(non_inters, inters, mapfp):
+def write_segments(non_inters, inters, mapfp, fmt=None):
     """
     Writes non_inters, inters and combined inter_and_non_int.geojson
     Args:
         non_inters - list of non_inters segment objects
         inters - list of inters segment objects
         mapfp - maps directory to write to
+        fmt - 'geojson' or 'parquet', defaults to the format
+            the segments are stored in now
     """
-    # Store non-intersection segments
-
-    non_inters = write_records_to_geojson(
-        non_inters, os.path.join(
-            mapfp, 'non_inters_segments.geojson'))
-
-    # Store the individual intersections
-    int_w_ids = write_records_to_geojson(
-        inters, os.path.join(
-            mapfp, 'inters_segments.geojson'))
-
-    # Store the combined segments with all properties
-    segments = non_inters['features'] + int_w_ids['features']
-
-    with open(os.path.join(mapfp, 'inter_and_non_int.geojson'), 'w') as outfile:
-        geojson.dump(geojson.FeatureCollection(segments), outfile, allow_nan=True)
+    if fmt is None:
+        fmt = columnar.stored_format(
+            os.path.join(mapfp, 'inters_segments.geojson'))
+    # add_map passes its intersections as a dict's values
+    non_inters, inters = list(non_inters), list(inters)
+    files = [
+        (non_inters, os.path.join(mapfp, 'non_inters_segments.geojson')),
+        (inters, os.path.join(mapfp, 'inters_segments.geojson')),
+        (non_inters + inters,
+         os.path.join(mapfp, 'inter_and_non_int.geojson')),
+    ]
+
+    # The index is built from the bounds of the segments as they're
+    # written, in the order read_segments reads them back, rather than
+    # by reading the files again
+    if fmt == 'parquet':
+        for segments, filename in files:
+            columnar.write_table(
+                columnar.output_file(filename, fmt),
+                [x.properties for x in segments],
+                [x.geometry for x in segments])
+        write_segments_index(
+            mapfp, [x.geometry.bounds for x in inters + non_inters])
+        return
+
+    # Each segment is reprojected and serialized once, then written to
+    # its own file and to the combined file with all properties
+    writers = [GeojsonWriter(columnar.output_file(filename, fmt))
+               for _, filename in files]
+    try:
+        for segments, writer in [(non_inters, writers[0]),
+                                 (inters, writers[1])]:
+            for batch in batches(segments, BATCH_SIZE):
+                for feature in make_features(batch):
+                    feature = dump_feature(feature)
+                    writer.write(feature)
+                    writers[2].write(feature)
+    finally:
+        for writer in writers:
+            writer.close()
+
+    # Segments make_features leaves out aren't read back either
+    write_segments_index(mapfp, [
+        x.geometry.bounds for x in inters + non_inters
+        if x.geometry.geom_type in REPROJECTED_TYPES])
+
+
+def read_json_records(filename):
+    """
+    Reads a list of records (e.g. crash_joined.json) written by
+    write_json_records, in whichever format it's stored
+    Args:
+        filename - the file's json path
+    Returns:
+        list of dicts
+    """
+    if columnar.stored_format(filename) == 'parquet':
+        return columnar.read_table(columnar.intermediate_file(filename))[0]
+    return list(iter_json_records(filename))
 
 
+def write_json_records(items, filename, fmt=None):
+    """
+    Writes a list of records to json or parquet
+    Args:
+        items - list or other iterable of dicts
+        filename - the file's json path
+        fmt - 'geojson' (meaning json) or 'parquet', defaults to
+            the format the file is stored in now
+    """
+    filename = columnar.output_file(filename, fmt)
+    if filename.endswith('.parquet'):
+        columnar.write_table(filename, list(items))
+    else:
+        # Written an item at a time, so items can be a generator
+        with open(filename, 'w') as f:
+            f.write('[')
+            for i, item in enumerate(items):
+                if i:
+                    f.write(', ')
+                json.dump(item, f)
+            f.write(']')
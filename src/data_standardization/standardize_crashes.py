@@ -11,6 +11,7 @@ import random
 import dateutil.parser as date_parser
 from .standardization_util import parse_date, validate_and_write_schema
 from data.geocoding_util import read_geocode_cache
+from data.stages import report_count
 import data.config
 
 CURR_FP = os.path.dirname(
@@ -277,15 +278,14 @@ def add_id(csv_file, id_field):
                 writer.writerow(row)
 
 
-if __name__ == '__main__':
-
+def main(args=None):
     parser = argparse.ArgumentParser()
     parser.add_argument("-c", "--config", type=str, required=True,
                         help="config file")
     parser.add_argument("-d", "--datadir", type=str, required=True,
                         help="data directory")
 
-    args = parser.parse_args()
+    args = parser.parse_args(args)
 
     # load config
     config_file = args.config
@@ -297,6 +297,7 @@ if __name__ == '__main__':
 
     print("searching "+crash_dir+" for raw files:")
     dict_crashes = {}
+    crashes_read = 0
 
     for csv_file, csv_config in config.crashes_files.items():
         if not os.path.exists(os.path.join(crash_dir, csv_file)):
@@ -311,6 +312,7 @@ if __name__ == '__main__':
         df_crashes = pd.read_csv(os.path.join(
             crash_dir, csv_file), na_filter=False)
         raw_crashes = df_crashes.to_dict("records")
+        crashes_read += len(raw_crashes)
 
         std_crashes = read_standardized_fields(
             raw_crashes,
@@ -328,8 +330,14 @@ if __name__ == '__main__':
         dict_crashes.update(std_crashes)
 
     print("{} crashes loaded, validating against schema".format(len(dict_crashes)))
+    report_count('crashes_read', crashes_read)
+    report_count('crashes_dropped', crashes_read - len(dict_crashes))
 
     schema_path = os.path.join(BASE_FP, "standards", "crashes-schema.json")
     list_crashes = list(dict_crashes.values())
     crashes_output = os.path.join(args.datadir, "standardized/crashes.json")
     validate_and_write_schema(schema_path, list_crashes, crashes_output)
+
+
+if __name__ == '__main__':
+    main()
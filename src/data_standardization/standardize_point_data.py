@@ -117,8 +117,7 @@ def read_file_info(config: data.config.Configuration,
             schema_path, points, output)
 
 
-if __name__ == '__main__':
-
+def main(args=None):
     parser = argparse.ArgumentParser()
     parser.add_argument("-c", "--config", type=str,
                         help="config file for city")
@@ -126,7 +125,7 @@ if __name__ == '__main__':
                         help="path to destination's data folder," +
                         "e.g. ../data/boston")
 
-    args = parser.parse_args()
+    args = parser.parse_args(args)
 
     # load config for this city
     config_file = os.path.join(BASE_FP, args.config)
@@ -134,4 +133,8 @@ if __name__ == '__main__':
     if config.data_source:
         read_file_info(config, args.datadir)
     else:
-        print("No point data found, skipping")    
+        print("No point data found, skipping")
+
+
+if __name__ == '__main__':
+    main()
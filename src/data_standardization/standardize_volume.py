@@ -22,7 +22,8 @@ def write_volume(volume_counts):
             json.dump(volume_counts, f)
 
 
-if __name__ == '__main__':
+def main(args=None):
+    global BASE_FP
 
     parser = argparse.ArgumentParser()
     parser.add_argument("-c", "--config", type=str, required=True,
@@ -30,7 +31,7 @@ if __name__ == '__main__':
     parser.add_argument("-d", "--datadir", type=str,
                         help="data directory")
 
-    args = parser.parse_args()
+    args = parser.parse_args(args)
     BASE_FP = os.path.join(args.datadir)
 
     config = data.config.Configuration(args.config)
@@ -39,3 +40,7 @@ if __name__ == '__main__':
         write_volume(volume_counts)
     else:
         print("No volume data given for {}".format(config.name))
+
+
+if __name__ == '__main__':
+    main()
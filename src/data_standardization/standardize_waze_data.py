@@ -1,15 +1,31 @@
 import argparse
+import concurrent.futures
+import multiprocessing
 import os
+import shutil
+import tempfile
+from collections import OrderedDict
 from dateutil.parser import parse
 import gzip
 import json
 import datetime
+import pytz
 import data.config
+from data.stages import report_count
+from data.util import batches, track, write_json_records
 
 CURR_FP = os.path.dirname(
     os.path.abspath(__file__))
 BASE_FP = os.path.dirname(os.path.dirname(CURR_FP))
 
+# Number of snapshots sent to a worker process at a time
+CHUNKSIZE = 64
+
+# Number of snapshots read before they're added to the store, so a run
+# that stops part way through keeps most of what it's read. Also the
+# number given to the worker processes at a time
+STORE_CHUNK_SIZE = 1000
+
 
 def get_datetime(date, timezone):
     """
@@ -44,104 +60,361 @@ def convert_from_millis(millis, timezone):
     ).strftime('%Y-%m-%d %H:%M:%S')
 
 
-def read_snapshots(dirname, config, startdate=None, enddate=None):
+def read_snapshot(filename, city, timezone):
     """
-    Read in files, either .json.gz or .json from a directory
-    Create a dictionary of lists of jams, alerts, and irregularities
-    To do: handle time zone
+    Read one snapshot, either .json.gz or .json, and pull out its jams,
+    alerts and irregularities for a city
+    Args:
+        filename - snapshot file
+        city - city name the events' city has to include
+        timezone - a pytz object
+    Returns:
+        dict of the snapshot's start and end, in the city's timezone,
+        and list of its events, without snapshot ids
+    """
+    if filename.endswith('.gz'):
+        # Decompressed as it's parsed, rather than into a string first
+        with gzip.open(filename, 'rt', encoding='utf-8') as f:
+            data = json.load(f)
+    else:
+        with open(filename) as f:
+            data = json.load(f)
+
+    events = []
+    # We care about jams, alerts, and irregularities
+    if 'jams' in data:
+        events += [
+            dict(x, eventType='jam',
+                 pubTimeStamp=convert_from_millis(
+                     x['pubMillis'],
+                     timezone
+                 ))
+            for x in data['jams']
+            if 'city' in x and city in x['city']
+        ]
+    if 'alerts' in data:
+        events += [
+            dict(x, eventType='alert',
+                 pubTimeStamp=convert_from_millis(
+                     x['pubMillis'],
+                     timezone
+                 ),
+                 location={
+                     'latitude': x['location']['y'],
+                     'longitude': x['location']['x']
+                 })
+            for x in data['alerts']
+            if 'city' in x and city in x['city']]
+    if 'irregularities' in data:
+        events += [
+            dict(x, eventType='irregularity')
+            for x in data['irregularities']
+            if 'city' in x and city in x['city']]
+
+    return {
+        'start': get_datetime(data['startTime'], timezone).isoformat(),
+        'end': get_datetime(data['endTime'], timezone).isoformat(),
+        'events': events,
+    }
+
+
+def list_snapshots(dirname):
+    """
+    List the snapshot files in a directory
+    Args:
+        dirname - directory the waze data lives in
+    Returns:
+        dict of each file's size and modification time, by name
+    """
+    files = {}
+    for name in os.listdir(dirname):
+        if os.path.splitext(name)[1] in ('.gz', '.json'):
+            stat = os.stat(os.path.join(dirname, name))
+            files[name] = [stat.st_size, stat.st_mtime_ns]
+    return files
+
+
+def current_snapshots(snapshots, files):
+    """
+    Get the ingested snapshots whose files are still there, unchanged.
+    Snapshots deleted from the directory are left out, and if a file
+    was rewritten, only the snapshot read from it since then is kept
+    Args:
+        snapshots - list of dicts from SnapshotStore.index
+        files - dict from list_snapshots
+    Returns:
+        dict of the snapshots, by file name
+    """
+    return {x['file']: x for x in snapshots
+            if files.get(x['file']) == [x.get('size'), x.get('mtime')]
+            and 'offset' in x}
+
+
+def _read_snapshot_file(args):
+    # Runs in a worker process
+    dirname, name, stat, city, timezone = args
+    return dict(read_snapshot(os.path.join(dirname, name), city, timezone),
+                file=name, size=stat[0], mtime=stat[1])
+
+
+def _iter_new_snapshots(dirname, files, city, timezone, workers):
+    """
+    Read snapshots in order of their names, on a pool of processes if
+    there's more than one worker. The pool is given a chunk of snapshots
+    at a time, the next while the last one's results are taken, so no
+    more than two chunks are ever waiting to be added to the store
+    """
+    tasks = [(dirname, x, files[x], city, timezone) for x in sorted(files)]
+    if workers > 1 and len(tasks) > 1 \
+            and 'fork' in multiprocessing.get_all_start_methods():
+        with concurrent.futures.ProcessPoolExecutor(
+                min(workers, len(tasks)),
+                mp_context=multiprocessing.get_context('fork')) as executor:
+            results = []
+            for chunk in batches(tasks, STORE_CHUNK_SIZE):
+                next_results = executor.map(
+                    _read_snapshot_file, chunk, chunksize=CHUNKSIZE)
+                for snapshot in results:
+                    yield snapshot
+                results = next_results
+            for snapshot in results:
+                yield snapshot
+    else:
+        for task in tasks:
+            yield _read_snapshot_file(task)
+
+
+class SnapshotStore(object):
+    """
+    An append-only store of the events read from Waze snapshots,
+    partitioned by the day each snapshot starts on, in the city's
+    timezone.
+
+    Each day's directory holds parts, json lines files with a line for
+    each snapshot: its file name, the file's size and modification
+    time, start, end and events. Every part has an index of the
+    snapshots in it and where their lines are, and store.json lists the parts that have been
+    completely written. Together, the indexes of those parts are the
+    watermark of which snapshots have been ingested; a part that was
+    being written when a run stopped isn't listed, so its snapshots are
+    read again the next time. A file that's changed since it was read
+    is read again into a new part, and the old version is ignored
+    """
+
+    def __init__(self, dirname, city, timezone):
+        """
+        Args:
+            dirname - directory of the store, made if it doesn't exist.
+                If it was made for another city or timezone, it's
+                emptied, since the events it has would be different
+            city - city name
+            timezone - a pytz object
+        """
+        self.dirname = dirname
+        self.settings = {'city': city, 'timezone': str(timezone)}
+        self.state = {'parts': [], 'next_part': 0}
+
+        store_file = os.path.join(dirname, 'store.json')
+        if os.path.exists(store_file):
+            with open(store_file) as f:
+                state = json.load(f)
+            if state['settings'] == self.settings:
+                self.state = state
+            else:
+                print("Waze snapshots were read for another city or " +
+                      "timezone, reading them all again")
+                shutil.rmtree(dirname)
+        os.makedirs(dirname, exist_ok=True)
+
+    def _part_file(self, part, suffix):
+        return os.path.join(self.dirname, part + suffix)
+
+    def index(self):
+        """
+        Get the snapshots that have been ingested
+        Returns:
+            list of dicts of each snapshot's file name, size,
+            modification time, start and end, and the part it's in and
+            the offset of its line there, in the order they were added
+        """
+        snapshots = []
+        for part in self.state['parts']:
+            with open(self._part_file(part, '.index.json')) as f:
+                snapshots += [dict(x, part=part) for x in json.load(f)]
+        return snapshots
+
+    def append(self, snapshots):
+        """
+        Add snapshots to the store, a new part for each day they start on
+        Args:
+            snapshots - list of dicts of each snapshot's file name,
+                size, modification time, start, end and events
+        """
+        days = OrderedDict()
+        for snapshot in snapshots:
+            days.setdefault(snapshot['start'][:10], []).append(snapshot)
+
+        parts = []
+        for day, day_snapshots in days.items():
+            part = '{}/{:06d}'.format(day, self.state['next_part'])
+            self.state['next_part'] += 1
+            os.makedirs(os.path.join(self.dirname, day), exist_ok=True)
+            offsets = []
+            with open(self._part_file(part, '.jsonl'), 'wb') as f:
+                for snapshot in day_snapshots:
+                    offsets.append(f.tell())
+                    f.write((json.dumps(snapshot) + '\n').encode('utf-8'))
+            with open(self._part_file(part, '.index.json'), 'w') as f:
+                json.dump([dict({
+                    key: x[key]
+                    for key in ['file', 'size', 'mtime', 'start', 'end']
+                }, offset=offset)
+                    for x, offset in zip(day_snapshots, offsets)], f)
+            parts.append(part)
+
+        # The parts only count as written once they're in store.json
+        self.state['parts'] += parts
+        store_file = os.path.join(self.dirname, 'store.json')
+        tmp_file = '{}_{}'.format(store_file, os.getpid())
+        with open(tmp_file, 'w') as f:
+            json.dump(dict(self.state, settings=self.settings), f)
+        os.replace(tmp_file, store_file)
+
+    def iter_events(self, snapshots):
+        """
+        Read the events of some of the snapshots, one snapshot at a time.
+        Each snapshot's line is read from where the index says it is,
+        keeping a part open while the snapshots in it come one after
+        another
+        Args:
+            snapshots - list of dicts from index
+        Yields:
+            list of each snapshot's events, in the order given
+        """
+        part = None
+        f = None
+        try:
+            for snapshot in snapshots:
+                if snapshot['part'] != part:
+                    if f is not None:
+                        f.close()
+                    part = snapshot['part']
+                    f = open(self._part_file(part, '.jsonl'), 'rb')
+                f.seek(snapshot['offset'])
+                yield json.loads(f.readline().decode('utf-8'))['events']
+        finally:
+            if f is not None:
+                f.close()
+
+
+def ingest_snapshots(dirname, store, workers=1):
+    """
+    Read the snapshots in a directory that aren't in the store yet,
+    or have changed since they were read, into it, a chunk at a time
+    Args:
+        dirname - directory the waze data lives in
+        store - SnapshotStore
+        workers - number of processes to read snapshots with
+    Returns:
+        number of snapshots read
+    """
+    files = list_snapshots(dirname)
+    ingested = current_snapshots(store.index(), files)
+    new_files = {x: files[x] for x in files if x not in ingested}
+    if not new_files:
+        return 0
+
+    print("Reading {} new waze snapshots".format(len(new_files)))
+    city = store.settings['city']
+    timezone = pytz.timezone(store.settings['timezone'])
+    chunk = []
+    for i, snapshot in enumerate(_iter_new_snapshots(
+            dirname, new_files, city, timezone, workers)):
+        chunk.append(snapshot)
+        if len(chunk) == STORE_CHUNK_SIZE:
+            store.append(chunk)
+            chunk = []
+            track(i + 1, STORE_CHUNK_SIZE * 10, len(new_files))
+    if chunk:
+        store.append(chunk)
+    return len(new_files)
+
+
+def iter_snapshot_events(dirname, config, startdate=None, enddate=None,
+                         store_dir=None, workers=1):
+    """
+    Read in files, either .json.gz or .json from a directory, and get
+    the jams, alerts and irregularities in each, one snapshot at a time.
+    Snapshots are ingested into a store first, so ones read before
+    aren't read again
     Args:
         dirname - directory the waze data lives in
         config - configuration object for city
         startdate - drop days before this date
         enddate - drop days after this date
-    returns
-        a list of all jams, alerts and irregularities for this city
+        store_dir - directory of the snapshot store, see SnapshotStore.
+            If not given, a temporary one is used
+        workers - number of processes to read new snapshots with
+    Yields:
+        each snapshot's id and list of events, in order of snapshot id
     """
-    files = os.listdir(dirname)
-    city = config.city.split(',')[0]
-
-    all_data = []
-    min_start = None
-    max_end = None
+    if store_dir is None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            yield from iter_snapshot_events(
+                dirname, config, startdate, enddate,
+                os.path.join(tmpdir, 'store'), workers)
+        return
 
+    city = config.city.split(',')[0]
     timezone = config.timezone
-    count = 0
+    store = SnapshotStore(store_dir, city, timezone)
+    report_count('snapshots_read', ingest_snapshots(dirname, store, workers))
+
     if startdate:
         startdate = timezone.localize(parse(startdate))
     if enddate:
         enddate = timezone.localize(parse(enddate))
 
-    files.sort()
-    for jsonfilename in files:
-        _, ext = os.path.splitext(jsonfilename)
-
-        if ext == '.gz':
-            with gzip.GzipFile(os.path.join(dirname, jsonfilename), 'r') as f:
-                json_bytes = f.read()
-                json_str = json_bytes.decode('utf-8')
-                data = json.loads(json_str)
-        elif ext == '.json':
-            with open(os.path.join(dirname, jsonfilename)) as f:
-                data = json.load(f)
-        else:
-            continue
-
-        end = get_datetime(data['endTime'], timezone)
-        if max_end is None or max_end < end:
-            max_end = end
-
-        start = get_datetime(data['startTime'], timezone)
-        if min_start is None or min_start > start:
-            min_start = start
-
-        if (startdate and start < startdate) \
-           or (enddate and end > enddate + datetime.timedelta(1)):
-            continue
-        count += 1
-
-        # We care about jams, alerts, and irregularities
-        if 'jams' in data:
-            all_data += [
-                dict(x, eventType='jam',
-                     pubTimeStamp=convert_from_millis(
-                         x['pubMillis'],
-                         timezone
-                     ),
-                     snapshotId=count
-                )
-                for x in data['jams']
-                if 'city' in x and city in x['city']
-            ]
-        if 'alerts' in data:
-            all_data += [
-                dict(x, eventType='alert',
-                     pubTimeStamp=convert_from_millis(
-                         x['pubMillis'],
-                         timezone
-                     ),
-                     location={
-                         'latitude': x['location']['y'],
-                         'longitude': x['location']['x']
-                     },
-                     snapshotId=count
-                )
-                for x in data['alerts']
-                if 'city' in x and city in x['city']]
-            
-        if 'irregularities' in data:
-            all_data += [
-                dict(x, eventType='irregularity',
-                     snapshotId=count) for x in data['irregularities']
-                if 'city' in x and city in x['city']]
+    # Snapshots are numbered in the order of their file names, skipping
+    # those outside the dates. Snapshots whose files have since been
+    # deleted are left out, and of one that's been changed, only the
+    # current version is read
+    snapshots = list(current_snapshots(
+        store.index(), list_snapshots(dirname)).values())
+    for snapshot in snapshots:
+        snapshot['start'] = datetime.datetime.fromisoformat(snapshot['start'])
+        snapshot['end'] = datetime.datetime.fromisoformat(snapshot['end'])
+    min_start = min((x['start'] for x in snapshots), default=None)
+    max_end = max((x['end'] for x in snapshots), default=None)
+    selected = [
+        x for x in sorted(snapshots, key=lambda x: x['file'])
+        if not (startdate and x['start'] < startdate)
+        and not (enddate and x['end'] > enddate + datetime.timedelta(1))]
 
     print("Reading waze data from {} snapshots between {} and {}".format(
-        count, min_start, max_end))
+        len(selected), min_start, max_end))
 
-    return all_data
+    for snapshot_id, events in enumerate(store.iter_events(selected), 1):
+        yield snapshot_id, events
 
 
-if __name__ == '__main__':
+def read_snapshots(dirname, config, startdate=None, enddate=None,
+                   store_dir=None, workers=1):
+    """
+    Read in files, either .json.gz or .json from a directory
+    Create a dictionary of lists of jams, alerts, and irregularities
+    Args:
+        see iter_snapshot_events
+    returns
+        a list of all jams, alerts and irregularities for this city
+    """
+    return [dict(x, snapshotId=snapshot_id)
+            for snapshot_id, events in iter_snapshot_events(
+                dirname, config, startdate, enddate, store_dir, workers)
+            for x in events]
+
 
+def main(args=None):
     parser = argparse.ArgumentParser()
     parser.add_argument("-c", "--config", type=str, required=True,
                         help="config file for city")
@@ -152,21 +425,41 @@ if __name__ == '__main__':
                         help="If given, start date in format YYYY-MM-DD")
     parser.add_argument("-e", "--enddate",
                         help="If given, last day included in format YYYY-MM-DD")
-    args = parser.parse_args()
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                        help="Number of processes to read snapshots with")
+    args = parser.parse_args(args)
 
     # load config for this city
     config_file = args.config
     config = data.config.Configuration(config_file)
 
-    snapshots = read_snapshots(
+    # Snapshots already read are kept here, so only new ones are read
+    snapshots = iter_snapshot_events(
         os.path.join(args.datadir, 'raw', 'waze'),
         config,
         startdate=args.startdate,
-        enddate=args.enddate
+        enddate=args.enddate,
+        store_dir=os.path.join(args.datadir, 'standardized', 'waze_store'),
+        workers=args.workers
     )
 
+    # Written a snapshot's events at a time, so only one snapshot's are
+    # ever in memory
+    count = 0
+
+    def records():
+        nonlocal count
+        for snapshot_id, events in snapshots:
+            for event in events:
+                count += 1
+                yield dict(event, snapshotId=snapshot_id)
+
     jsonfile = os.path.join(
         args.datadir, 'standardized', 'waze.json')
-    print("output {} records to {}".format(len(snapshots), jsonfile))
-    with open(jsonfile, 'w') as f:
-        json.dump(snapshots, f)
+    print("output waze records to {}".format(jsonfile))
+    write_json_records(records(), jsonfile, fmt='geojson')
+    print("output {} records".format(count))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,9 @@
 import ruamel.yaml
+import json
 from .. import standardize_waze_data
 import data.config
 import os
+import shutil
 import pytz
 
 TEST_FP = os.path.dirname(os.path.abspath(__file__))
@@ -128,3 +130,134 @@ def test_read_snapshots(tmpdir):
             'snapshotId': 1
         },
     ]
+
+
+def test_read_snapshots_incremental(tmpdir, monkeypatch):
+    config_dict = {
+        'name': 'cambridge',
+        'city_latitude': 42.3600825,
+        'city_longitude': -71.0588801,
+        'city_radius': 15,
+        'crashes_files': {'test': {}},
+        'city': "Cambridge, Massachusetts, USA",
+        'timezone': "America/New_York"
+    }
+    filename = os.path.join(tmpdir, 'test.yml')
+    with open(filename, "w") as f:
+        ruamel.yaml.round_trip_dump(config_dict, f)
+    config = data.config.Configuration(filename)
+
+    orig_dir = os.path.join(TEST_FP, 'data', 'waze')
+    expected = standardize_waze_data.read_snapshots(orig_dir, config)
+    expected_dates = standardize_waze_data.read_snapshots(
+        orig_dir, config, startdate='2018-10-16', enddate='2018-10-16')
+
+    # Two snapshots are ingested, then the third is added
+    waze_dir = os.path.join(str(tmpdir), 'waze')
+    store_dir = os.path.join(str(tmpdir), 'store')
+    os.makedirs(waze_dir)
+    names = sorted(os.listdir(orig_dir))
+    for name in names[:2]:
+        shutil.copy(os.path.join(orig_dir, name), waze_dir)
+    assert len(standardize_waze_data.read_snapshots(
+        waze_dir, config, store_dir=store_dir)) == 4
+    shutil.copy(os.path.join(orig_dir, names[2]), waze_dir)
+
+    read = []
+    read_snapshot = standardize_waze_data.read_snapshot
+
+    def counted(filename, city, timezone):
+        read.append(os.path.basename(filename))
+        return read_snapshot(filename, city, timezone)
+    monkeypatch.setattr(standardize_waze_data, 'read_snapshot', counted)
+
+    assert standardize_waze_data.read_snapshots(
+        waze_dir, config, store_dir=store_dir) == expected
+    assert read == [names[2]]
+    assert standardize_waze_data.read_snapshots(
+        waze_dir, config, startdate='2018-10-16', enddate='2018-10-16',
+        store_dir=store_dir) == expected_dates
+    assert read == [names[2]]
+    # Partitioned by the day each snapshot starts on
+    assert sorted(x for x in os.listdir(store_dir) if x != 'store.json') == [
+        '2018-10-15', '2018-10-16', '2018-10-17']
+
+    # Read on several processes, a chunk at a time
+    assert standardize_waze_data.read_snapshots(
+        waze_dir, config, store_dir=os.path.join(str(tmpdir), 'store2'),
+        workers=2) == expected
+    monkeypatch.setattr(standardize_waze_data, 'STORE_CHUNK_SIZE', 2)
+    assert standardize_waze_data.read_snapshots(
+        waze_dir, config, store_dir=os.path.join(str(tmpdir), 'store3'),
+        workers=2) == expected
+    assert len([x for x in os.listdir(os.path.join(
+        str(tmpdir), 'store3', '2018-10-17')) if x.endswith('.jsonl')]) == 1
+    monkeypatch.setattr(standardize_waze_data, 'STORE_CHUNK_SIZE', 1000)
+
+    # A store made for another timezone is read again
+    config.timezone = pytz.timezone('America/Chicago')
+    read = []
+    results = standardize_waze_data.read_snapshots(
+        waze_dir, config, store_dir=store_dir)
+    assert len(read) == 3
+    assert len(results) == len(expected)
+
+
+def test_main_deleted_and_changed_snapshots(tmpdir, monkeypatch):
+    config_dict = {
+        'name': 'cambridge',
+        'city_latitude': 42.3600825,
+        'city_longitude': -71.0588801,
+        'city_radius': 15,
+        'crashes_files': {'test': {}},
+        'city': "Cambridge, Massachusetts, USA",
+        'timezone': "America/New_York"
+    }
+    config_file = os.path.join(tmpdir, 'test.yml')
+    with open(config_file, "w") as f:
+        ruamel.yaml.round_trip_dump(config_dict, f)
+    config = data.config.Configuration(config_file)
+
+    orig_dir = os.path.join(TEST_FP, 'data', 'waze')
+    names = sorted(os.listdir(orig_dir))
+    datadir = str(tmpdir)
+    waze_dir = os.path.join(datadir, 'raw', 'waze')
+    os.makedirs(os.path.join(datadir, 'standardized'))
+    shutil.copytree(orig_dir, waze_dir)
+
+    def run():
+        standardize_waze_data.main(['-c', config_file, '-d', datadir])
+        with open(os.path.join(datadir, 'standardized', 'waze.json')) as f:
+            return json.load(f)
+
+    assert run() == json.loads(json.dumps(
+        standardize_waze_data.read_snapshots(orig_dir, config)))
+
+    # A deleted snapshot's events are dropped from waze.json
+    os.remove(os.path.join(waze_dir, names[0]))
+    expected = json.loads(json.dumps(
+        standardize_waze_data.read_snapshots(waze_dir, config)))
+    assert len(expected) == 3
+    assert run() == expected
+
+    # A snapshot rewritten under the same name is read again
+    changed = os.path.join(waze_dir, names[1])
+    with open(changed) as f:
+        snapshot = json.load(f)
+    snapshot['alerts'] = []
+    with open(changed, 'w') as f:
+        json.dump(snapshot, f)
+    os.utime(changed, ns=(0, 0))
+
+    read = []
+    read_snapshot = standardize_waze_data.read_snapshot
+
+    def counted(filename, city, timezone):
+        read.append(os.path.basename(filename))
+        return read_snapshot(filename, city, timezone)
+    monkeypatch.setattr(standardize_waze_data, 'read_snapshot', counted)
+
+    results = run()
+    assert read == [names[1]]
+    assert len(results) == 2
+    assert [x['eventType'] for x in results] == ['jam', 'irregularity']
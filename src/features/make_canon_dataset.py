@@ -2,9 +2,8 @@
 # coding: utf-8
 # Generate canonical dataset
 # Developed by: bpben, j-t-t
-import json
 import pandas as pd
-from data.util import read_geojson
+from data.util import read_geojson, read_json_records
 import os
 import argparse
 import warnings
@@ -32,8 +31,7 @@ def read_records(fp, id_col, split_columns=[]):
         Pandas dataframe with the segment/crash info
     """
 
-    with open(fp, 'r') as f:
-        data = json.load(f)
+    data = read_json_records(fp)
 
     df = pd.DataFrame(data)
     df = df.fillna(0)
@@ -131,14 +129,16 @@ def combine_crash_with_segments(crash, aggregated):
     return crash_roads
 
 
-if __name__ == '__main__':
+def main(args=None):
+    global DATA_FP, MAP_FP
+
     parser = argparse.ArgumentParser()
     parser.add_argument("-d", "--datadir", type=str,
                         help="Can give alternate data directory")
     parser.add_argument("-c", "--config", type=str,
                         help="Config file", required=True)
 
-    args = parser.parse_args()
+    args = parser.parse_args(args)
 
     config = data.config.Configuration(args.config)
 
@@ -147,7 +147,6 @@ if __name__ == '__main__':
         DATA_FP = os.path.join(args.datadir, 'processed')
         MAP_FP = os.path.join(DATA_FP, 'maps')
 
-    feats = config.features
     print("Data directory: " + DATA_FP)
 
     aggregated, crash = aggregate_roads(
@@ -167,3 +166,6 @@ if __name__ == '__main__':
         os.path.join(DATA_FP, 'vz_predict_dataset.csv.gz'),
         compression='gzip')
 
+
+if __name__ == '__main__':
+    main()
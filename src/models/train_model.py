@@ -279,8 +279,7 @@ def initialize_and_run(data_model, features, lm_features, target,
     output_importance(trained_model, features, datadir, target)
 
 
-if __name__ == '__main__':
-
+def main(args=None):
     parser = argparse.ArgumentParser()
     # parse arguments
     parser.add_argument("-c", "--config", type=str,
@@ -289,12 +288,15 @@ if __name__ == '__main__':
     parser.add_argument('-d', '--datadir', type=str,
                         help="data directory")
 
-    args = parser.parse_args()
+    args = parser.parse_args(args)
     config = data.config.Configuration(args.config)
     set_defaults(config)
 
     DATA_FP = os.path.join(BASE_DIR, 'data', config.name)
-    PROCESSED_DATA_FP = os.path.join(BASE_DIR, 'data', config.name, 'processed/')
+    # Can override the default data directory
+    if args.datadir:
+        DATA_FP = args.datadir
+    PROCESSED_DATA_FP = os.path.join(DATA_FP, 'processed/')
     seg_data = os.path.join(PROCESSED_DATA_FP, config.seg_data)
 
     # get the targets
@@ -306,13 +308,13 @@ if __name__ == '__main__':
     print(('Outputting to: %s' % PROCESSED_DATA_FP))
 
     # Read in data
-    data = pd.read_csv(seg_data, dtype={'segment_id': 'str'})
+    df = pd.read_csv(seg_data, dtype={'segment_id': 'str'})
 
-    f_cat, f_cont, features = get_features(config, data)
+    f_cat, f_cont, features = get_features(config, df)
 
-    data = add_extra_features(data, config, PROCESSED_DATA_FP)
+    df = add_extra_features(df, config, PROCESSED_DATA_FP)
     # grab the highest values from each column
-    data_segs = data.groupby('segment_id')[features].max()
+    data_segs = df.groupby('segment_id')[features].max()
     data_segs.reset_index(inplace=True)
 
     data_segs, features, lm_features = process_features(
@@ -321,7 +323,7 @@ if __name__ == '__main__':
 
     for target in targets:
         # want any instance of target
-        any_target = data.groupby('segment_id')[target].max()
+        any_target = df.groupby('segment_id')[target].max()
         any_target = (any_target>0).astype(int)
         any_target.name = target
         data_model = data_segs.set_index('segment_id').join(any_target).reset_index()    
@@ -330,3 +332,5 @@ if __name__ == '__main__':
                            PROCESSED_DATA_FP)
 
 
+if __name__ == '__main__':
+    main()
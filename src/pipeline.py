@@ -1,107 +1,101 @@
 import argparse
+import datetime
 import os
-import subprocess
 import shutil
 import data.config
+from data.columnar import intermediate_file
+from data.stages import run_stage, write_run_manifest, Build, \
+    CRASH_CONFIG_KEYS, FEATURE_CONFIG_KEYS
 
 BASE_DIR = os.path.dirname(
     os.path.dirname(
         os.path.abspath(__file__)))
 
 
-def data_standardization(config_file, DATA_FP, forceupdate=False):
+def data_standardization(config_file, DATA_FP, forceupdate=False,
+                         isolated=False, workers=None):
     """
     Standardize data from a csv file into compatible crashes
-    according to a config file
+    according to a config file.
+    The standardization steps don't depend on each other, so they're
+    run at the same time
     Args:
         config_file
         DATA_FP - data directory for this city
+        forceupdate - if True, standardize even if nothing has changed
+        isolated - if True, run each step in its own python process
+        workers - maximum number of steps to run at once, defaults to
+            one per step up to the number of cores
     """
 
-    # standardize data, if the files don't already exist
-    # or forceupdate
-    if not os.path.exists(os.path.join(
-            DATA_FP, 'standardized', 'crashes.json')) or forceupdate:
-        print("Standardizing crash data..")
-        subprocess.check_call([
-            'python',
-            '-m',
-            'data_standardization.standardize_crashes',
-            '-c',
-            config_file,
-            '-d',
-            DATA_FP
-        ])
+    args = ['-c', config_file, '-d', DATA_FP]
+    steps = [{
+        'name': 'standardize_crashes',
+        'args': args,
+        'inputs': [os.path.join('raw', 'crashes')],
+        'outputs': [os.path.join('standardized', 'crashes.json')],
+        'config_keys': ['city'] + CRASH_CONFIG_KEYS,
+    }, {
+        # Handling volume data
+        'name': 'standardize_volume',
+        'args': args,
+        'inputs': [os.path.join('raw', 'volume')],
+        'outputs': [os.path.join('standardized', 'volume.json')],
+        'config_keys': ['name'],
+    }, {
+        # Point data files are looked for in raw/crashes if they
+        # aren't in raw/supplemental
+        'name': 'standardize_point_data',
+        'args': args,
+        'inputs': [
+            os.path.join('raw', 'supplemental'),
+            os.path.join('raw', 'crashes'),
+        ],
+        'outputs': [os.path.join('standardized', 'points.json')],
+        'config_keys': ['data_source', 'timezone'],
+    }]
+
+    if os.path.exists(os.path.join(DATA_FP, 'raw', 'waze')):
+        # The script can filter by dates, but if this is something
+        # we'd like to add, dates should probably be specified
+        # Might be better to just only store the waze snapshots force
+        # the desired weeks in the raw waze directory
+        steps.append({
+            'name': 'standardize_waze_data',
+            'args': args,
+            'inputs': [os.path.join('raw', 'waze')],
+            'outputs': [os.path.join('standardized', 'waze.json')],
+            'config_keys': ['city', 'timezone'],
+            # Snapshots are read on as many processes as steps are run on
+            'runtime_args': ['--workers', str(workers)] if workers else [],
+        })
     else:
-        print("Already standardized crash data, skipping")
-
-    # Handling volume data
-    if (not os.path.exists(os.path.join(
-            DATA_FP, 'standardized', 'volume.json'))) or forceupdate:
-        subprocess.check_call([
-            'python',
-            '-m',
-            'data_standardization.standardize_volume',
-            '-c',
-            config_file,
-            '-d',
-            DATA_FP
-        ])
-    else:
-        print("Already standardized volume data, skipping")
-
-    if not os.path.exists(os.path.join(
-           DATA_FP, 'standardized', 'points.json')) or forceupdate:
-        subprocess.check_call([
-            'python',
-            '-m',
-            'data_standardization.standardize_point_data',
-            '-c',
-            config_file,
-            '-d',
-            DATA_FP
-        ])
-    else:
-        print("Already standardized point data, skipping")
-    forceupdate = True
-
-    if os.path.exists(os.path.join(DATA_FP, 'raw', 'waze')) and \
-       (not os.path.exists(os.path.join(BASE_DIR, 'standardized', 'waze.json')
-                           or forceupdate)):
-        subprocess.check_call([
-            'python',
-            '-m',
-            'data_standardization.standardize_waze_data',
-            '-c',
-            config_file,
-            '-d',
-            DATA_FP,
-            # The script can filter by dates, but if this is something
-            # we'd like to add, dates should probably be specified
-            # Might be better to just only store the waze snapshots force
-            # the desired weeks in the raw waze directory
-        ])
-    elif not os.path.exists(os.path.join(DATA_FP, 'raw', 'waze')):
         print("No waze data, skipping")
-    else:
-        print("Already standardized waze data, skipping")
+
+    # standardize data, if the raw files or config have changed
+    # since the last time, or forceupdate
+    build = Build(DATA_FP, config_file=config_file,
+                  forceupdate=forceupdate, isolated=isolated)
+    build.run_parallel(steps, workers=workers)
 
 
 def data_generation(config_file, DATA_FP, startdate=None, enddate=None,
-                    forceupdate=False):
+                    forceupdate=False, isolated=False, workers=None):
     """
     Generate the map and feature data for this city
+    Each step is only rerun if something it depends on has changed,
+    see data.make_dataset
     Args:
         config_file - path to config file
         DATA_FP - path to data directory, e.g. ../data/boston/
         startdate (optional)
         enddate (optional)
+        isolated - if True, run each step in its own python process
+        workers - number of processes to create segments and snap
+            crashes to segments with
     """
     print("Generating data and features...")
-    subprocess.check_call([
-        'python',
-        '-m',
-        'data.make_dataset',
+    run_stage('make_dataset', [
         '-c',
         config_file,
         '-d',
@@ -110,44 +104,78 @@ def data_generation(config_file, DATA_FP, startdate=None, enddate=None,
         + (['-s', str(startdate)] if startdate else [])
         + (['-e', str(enddate)] if enddate else [])
         + (['--forceupdate'] if forceupdate else [])
+        + (['--isolated'] if isolated else [])
+        + (['--workers', str(workers)] if workers else []),
+        isolated=isolated
     )
 
 
-def train_model(config_file, DATA_FP):
+def train_model(config_file, DATA_FP, forceupdate=False, isolated=False):
     """
-    Trains the model
+    Trains the model, if the canonical dataset or features have changed
     Args:
         config_file - path to config file
         DATA_FP - path to data directory, e.g. ../data/boston/
+        forceupdate - if True, train even if nothing has changed
+        isolated - if True, train in a separate python process
     """
     print("Training model...")
-    subprocess.check_call([
-        'python',
-        '-m',
-        'models.train_model',
+    config = data.config.Configuration(config_file)
+    targets = ['_' + x for x in config.split_columns] or ['']
+    build = Build(DATA_FP, config_file=config_file,
+                  forceupdate=forceupdate, isolated=isolated)
+    build.run('train_model', [
         '-c',
         config_file,
         '-d',
         DATA_FP
-    ])
-
-
-def visualize(DATA_FP, config_file):
+    ],
+        inputs=[
+            os.path.join('processed', 'vz_predict_dataset.csv.gz'),
+            os.path.join('processed', 'tmc_summary.json'),
+        ],
+        outputs=[
+            os.path.join('processed', name + x + ext)
+            for x in targets
+            for name, ext in [
+                ('seg_with_predicted', '.csv'),
+                ('seg_with_predicted', '.json'),
+                ('feature_importances', '.json'),
+            ]
+        ],
+        config_keys=FEATURE_CONFIG_KEYS + CRASH_CONFIG_KEYS)
+
+
+def visualize(DATA_FP, config_file, forceupdate=False, isolated=False):
     """
     Creates the visualization data set for a city
     Args:
         DATA_FP - path to data directory, e.g. ../data/boston/
+        forceupdate - if True, regenerate even if nothing has changed
+        isolated - if True, run in a separate python process
     """
     print("Generating visualization data")
-    subprocess.check_call([
-        'python',
-        '-m',
-        'data.make_preds_viz',
+    config = data.config.Configuration(config_file)
+    targets = ['_' + x for x in config.split_columns] or ['']
+    build = Build(DATA_FP, config_file=config_file,
+                  forceupdate=forceupdate, isolated=isolated)
+    build.run('make_preds_viz', [
         '-d',
         DATA_FP,
         '-c',
         config_file
-    ])
+    ],
+        inputs=[
+            os.path.join('processed', 'seg_with_predicted' + x + '.json')
+            for x in targets
+        ] + [intermediate_file(
+            os.path.join('processed', 'maps', 'inter_and_non_int.geojson'),
+            config.intermediate_format)],
+        outputs=[
+            os.path.join('processed', 'preds_viz' + x + '.geojson')
+            for x in targets
+        ],
+        config_keys=['crashes_files'])
 
 
 def copy_files(base_dir, data_fp, config):
@@ -247,6 +275,14 @@ if __name__ == '__main__':
                         help="Give list of steps to run, as comma-separated " +
                         "string.  Has to be among 'standardization'," +
                         "'generation', 'model', 'visualization'")
+    parser.add_argument('--isolated', action='store_true',
+                        help="Run each step in its own python process, " +
+                        "instead of all in this one")
+    parser.add_argument('--workers', type=int,
+                        help="Maximum number of standardization steps to " +
+                        "run at once, defaults to the number of cores. " +
+                        "If given, also the number of processes segments " +
+                        "are created and crashes snapped to segments with")
 
     args = parser.parse_args()
     if args.onlysteps:
@@ -257,21 +293,35 @@ if __name__ == '__main__':
 
     DATA_FP = os.path.join(BASE_DIR, 'data', config.name)
 
-    if not args.onlysteps or 'standardization' in args.onlysteps:
-        data_standardization(args.config_file, DATA_FP, forceupdate=args.forceupdate)
-
-    startdate = config.startdate
-    enddate = config.enddate
-    if not args.onlysteps or 'generation' in args.onlysteps:
-        data_generation(args.config_file, DATA_FP,
-                        startdate=startdate,
-                        enddate=enddate,
-                        forceupdate=args.forceupdate)
-
-    if not args.onlysteps or 'model' in args.onlysteps:
-        train_model(args.config_file, DATA_FP)
-
-    if not args.onlysteps or 'visualization' in args.onlysteps:
-        visualize(DATA_FP, args.config_file)
-        copy_files(BASE_DIR, DATA_FP, config)
-        make_js_config(BASE_DIR, config)
+    # Every stage checked from here on goes in this run's manifest
+    start = datetime.datetime.now()
+    try:
+        if not args.onlysteps or 'standardization' in args.onlysteps:
+            data_standardization(args.config_file, DATA_FP,
+                                 forceupdate=args.forceupdate,
+                                 isolated=args.isolated,
+                                 workers=args.workers)
+
+        startdate = config.startdate
+        enddate = config.enddate
+        if not args.onlysteps or 'generation' in args.onlysteps:
+            data_generation(args.config_file, DATA_FP,
+                            startdate=startdate,
+                            enddate=enddate,
+                            forceupdate=args.forceupdate,
+                            isolated=args.isolated,
+                            workers=args.workers)
+
+        if not args.onlysteps or 'model' in args.onlysteps:
+            train_model(args.config_file, DATA_FP,
+                        forceupdate=args.forceupdate,
+                        isolated=args.isolated)
+
+        if not args.onlysteps or 'visualization' in args.onlysteps:
+            visualize(DATA_FP, args.config_file,
+                      forceupdate=args.forceupdate,
+                      isolated=args.isolated)
+            copy_files(BASE_DIR, DATA_FP, config)
+            make_js_config(BASE_DIR, config)
+    finally:
+        write_run_manifest(DATA_FP, start)
@@ -1,7 +1,14 @@
 # -*- coding: utf-8 -*-
 import os
+import signal
 import subprocess
 import argparse
+import time
+try:
+    import resource
+except ImportError:
+    # Not available on windows, where memory budgets aren't enforced
+    resource = None
 
 
 DATA_FP = os.path.dirname(
@@ -9,9 +16,223 @@ DATA_FP = os.path.dirname(
         os.path.dirname(
             os.path.abspath(__file__)))) + '/data/'
 
+# numpy, sklearn and xgboost size their thread pools from these
+THREAD_ENV_VARS = [
+    'OMP_NUM_THREADS',
+    'OPENBLAS_NUM_THREADS',
+    'MKL_NUM_THREADS',
+    'NUMEXPR_NUM_THREADS',
+]
 
-if __name__ == '__main__':
 
+def group_memory(pgid):
+    """
+    Get the memory used by all the processes in a process group,
+    read from /proc, so only on linux
+    Args:
+        pgid - process group id
+    Returns:
+        resident memory in GB, or None if it can't be read here
+    """
+    if not os.path.isdir('/proc'):
+        return None
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    total = 0
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(os.path.join('/proc', pid, 'stat')) as f:
+                stat = f.read()
+            with open(os.path.join('/proc', pid, 'statm')) as f:
+                pages = int(f.read().split()[1])
+        except (IOError, ValueError, IndexError):
+            # The process has exited
+            continue
+        # The command name can have spaces in it, so the fields are
+        # counted from after it: state, parent pid, process group
+        fields = stat[stat.rindex(')') + 2:].split()
+        if int(fields[2]) == pgid:
+            total += pages * page_size
+    return total / 1024 ** 3
+
+
+class CityRun(object):
+    """
+    A pipeline run for one city, along with the number of cores
+    and memory (in GB) it's allowed.
+    The pipeline runs in its own process group, along with the worker
+    processes it starts. The memory budget is for the whole group: if
+    the memory they use together goes over it, they're all killed.
+    Each process is also limited to the budget on its own, so one that
+    grows quickly fails rather than running the machine out of memory
+    between checks
+    """
+
+    def __init__(self, city, cores=1, memory=None):
+        self.city = city
+        self.cores = cores
+        self.memory = memory
+        self.config_file = os.path.join(
+            'config', 'config_{}.yml'.format(city))
+        self.log_file = os.path.join(DATA_FP, city, 'pipeline.log')
+        self.process = None
+        self.log = None
+        self.start = None
+        self.end = None
+        self.returncode = None
+        self.peak_memory = None
+        self.over_memory = False
+
+    def _limit_memory(self):
+        # Runs in the child process before the pipeline starts, and is
+        # inherited by the workers it forks. It's a limit per process,
+        # the budget for them all together is checked in poll
+        limit = int(self.memory * 1024 ** 3)
+        resource.setrlimit(resource.RLIMIT_DATA, (limit, limit))
+
+    def run(self, pipeline_args):
+        """
+        Start the pipeline for this city in the background,
+        writing its output to the city's log file. The city's cores
+        are passed on as the pipeline's number of workers, and as the
+        size of numpy's and xgboost's thread pools
+        """
+        env = dict(os.environ)
+        for var in THREAD_ENV_VARS:
+            env[var] = str(self.cores)
+
+        print("Running pipeline for {}, logging to {}".format(
+            self.city, self.log_file))
+        self.log = open(self.log_file, 'w')
+        self.start = time.time()
+        self.process = subprocess.Popen(
+            ['python', 'pipeline.py', '-c', self.config_file] + pipeline_args
+            + ['--workers', str(self.cores)],
+            stdout=self.log,
+            stderr=subprocess.STDOUT,
+            env=env,
+            start_new_session=True,
+            preexec_fn=self._limit_memory
+            if self.memory and resource else None
+        )
+
+    def poll(self):
+        """
+        Check whether the run has finished, killing it if it's using
+        more than its memory budget
+        Returns:
+            the exit status if it has, otherwise None
+        """
+        self.returncode = self.process.poll()
+        if self.returncode is None and self.memory:
+            used = group_memory(self.process.pid)
+            if used is not None:
+                self.peak_memory = max(self.peak_memory or 0, used)
+                if used > self.memory:
+                    print(("{} is using {:.1f}GB, over its budget of " +
+                           "{}GB, stopping it").format(
+                               self.city, used, self.memory))
+                    self.over_memory = True
+                    os.killpg(self.process.pid, signal.SIGKILL)
+                    self.returncode = self.process.wait()
+        if self.returncode is not None and self.end is None:
+            self.end = time.time()
+            self.log.close()
+            print("Finished {} ({})".format(self.city, self.status))
+        return self.returncode
+
+    @property
+    def status(self):
+        if self.returncode is None:
+            return 'not run'
+        if self.over_memory:
+            return 'over memory budget'
+        if self.returncode == 0:
+            return 'ok'
+        return 'failed ({})'.format(self.returncode)
+
+    @property
+    def wall_time(self):
+        if self.start is None or self.end is None:
+            return None
+        return self.end - self.start
+
+
+def run_cities(runs, pipeline_args, max_parallel, total_cores,
+               total_memory=None, interval=1):
+    """
+    Run the pipeline for several cities at once. A city is started
+    whenever there are fewer than max_parallel running, and its core and
+    memory budgets fit in what the running cities have left over. A city
+    that doesn't fit on its own is run by itself.
+    A failed city doesn't stop the others.
+    Args:
+        runs - list of CityRun objects, started in order
+        pipeline_args - arguments passed on to pipeline.py
+        max_parallel - maximum number of cities to run at once
+        total_cores - cores available to all the cities together
+        total_memory - memory available to all the cities together, in GB
+        interval - seconds to wait between checks on running cities
+    Returns:
+        runs
+    """
+    pending = list(runs)
+    running = []
+
+    while pending or running:
+        for run in list(pending):
+            if len(running) >= max_parallel:
+                break
+            cores = sum(x.cores for x in running) + run.cores
+            memory = sum(x.memory or 0 for x in running) + (run.memory or 0)
+            if running and (cores > total_cores or (
+                    total_memory and memory > total_memory)):
+                continue
+            run.run(pipeline_args)
+            pending.remove(run)
+            running.append(run)
+
+        time.sleep(interval)
+        running = [x for x in running if x.poll() is None]
+
+    return runs
+
+
+def print_summary(runs):
+    """
+    Print a table of each city's wall time and exit status
+    """
+    width = max([len(x.city) for x in runs] + [len('city')])
+    print("{}  {:>10}  {}".format('city'.ljust(width), 'wall time', 'status'))
+    for run in runs:
+        wall_time = '{:.1f}s'.format(run.wall_time) \
+            if run.wall_time is not None else '-'
+        print("{}  {:>10}  {}".format(
+            run.city.ljust(width), wall_time, run.status))
+
+
+def parse_budgets(budgets, cores, memory):
+    """
+    Parse per-city budget overrides
+    Args:
+        budgets - list of strings in form city:cores or city:cores:memory
+        cores - default number of cores
+        memory - default memory in GB
+    Returns:
+        dict of city to (cores, memory) tuple
+    """
+    results = {}
+    for budget in budgets:
+        parts = budget.split(':')
+        results[parts[0]] = (
+            int(parts[1]) if len(parts) > 1 and parts[1] else cores,
+            float(parts[2]) if len(parts) > 2 and parts[2] else memory
+        )
+    return results
+
+
+def main(args=None):
     parser = argparse.ArgumentParser()
     parser.add_argument('--forceupdate', action='store_true',
                         help='Whether to force update the maps')
@@ -20,21 +241,51 @@ if __name__ == '__main__':
                         help="Give list of steps to run, as comma-separated " +
                         "string.  Has to be among 'standardization'," +
                         "'generation', 'model', 'visualization'")
-    args = parser.parse_args()
-
-    cities = os.listdir(DATA_FP)
-    for city in cities:
-        config_file = os.path.join('config', 'config_{}.yml'.format(city))
-
-        print("Running pipeline for {}".format(city))
-        print(args.onlysteps)
-        subprocess.check_call([
-            'python',
-            'pipeline.py',
-            '-c',
-            config_file,
-        ] + (['--forceupdate'] if args.forceupdate else []) +
-            (['--onlysteps', args.onlysteps] if args.onlysteps else [])
-        )
-    city_list = ", ".join(cities)
+    parser.add_argument('-j', '--parallel', type=int, default=1,
+                        help="Maximum number of cities to run at once")
+    parser.add_argument('--cores', type=int, default=1,
+                        help="Number of cores each city can use")
+    parser.add_argument('--memory', type=float,
+                        help="Memory in GB each city can use, its " +
+                        "pipeline and worker processes together")
+    parser.add_argument('--total-cores', type=int, default=os.cpu_count(),
+                        help="Cores available to all cities together, " +
+                        "defaults to the number of cores on this machine")
+    parser.add_argument('--total-memory', type=float,
+                        help="Memory in GB available to all cities together")
+    parser.add_argument('--budget', action='append', default=[],
+                        help="Override the budget for a city, in form " +
+                        "city:cores or city:cores:memory. " +
+                        "Can be given more than once")
+    args = parser.parse_args(args)
+
+    budgets = parse_budgets(args.budget, args.cores, args.memory)
+
+    runs = []
+    for city in sorted(os.listdir(DATA_FP)):
+        # Skipping the road graph cache the cities share
+        if not os.path.isdir(os.path.join(DATA_FP, city)) \
+                or city.startswith('.'):
+            continue
+        run = CityRun(city, *budgets.get(city, (args.cores, args.memory)))
+        if not os.path.exists(run.config_file):
+            print("No config file found for {}, skipping".format(city))
+            continue
+        runs.append(run)
+
+    pipeline_args = (['--forceupdate'] if args.forceupdate else []) + \
+        (['--onlysteps', args.onlysteps] if args.onlysteps else [])
+
+    run_cities(runs, pipeline_args, args.parallel, args.total_cores,
+               total_memory=args.total_memory)
+
+    city_list = ", ".join([x.city for x in runs])
     print("Ran pipeline on {}".format(city_list))
+    print_summary(runs)
+
+    if any(x.returncode != 0 for x in runs):
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+import os
+import signal
+import subprocess
+import sys
+import pytest
+from .. import run_all_cities
+
+
+class FakeProcess(object):
+    """
+    Stands in for a pipeline process, finishing the second time it's
+    polled with the exit status given
+    """
+
+    def __init__(self, returncode, pid):
+        self.returncode = returncode
+        self.pid = pid
+        self.polls = 0
+
+    def poll(self):
+        self.polls += 1
+        return self.returncode if self.polls > 1 else None
+
+    def wait(self):
+        self.returncode = -signal.SIGKILL
+        self.polls = 2
+        return self.returncode
+
+
+@pytest.fixture
+def cities(tmpdir, monkeypatch):
+    """
+    Make data and config directories for some cities, and run their
+    pipelines as fake processes. Returns the list of the commands run
+    and of the cores in use each time a city starts
+    """
+    data_fp = os.path.join(str(tmpdir), 'data')
+    monkeypatch.setattr(run_all_cities, 'DATA_FP', data_fp)
+    monkeypatch.chdir(tmpdir)
+    os.makedirs(os.path.join(str(tmpdir), 'config'))
+    for city in ['boston', 'cambridge', 'dc']:
+        os.makedirs(os.path.join(data_fp, city))
+        open(os.path.join(
+            'config', 'config_{}.yml'.format(city)), 'w').close()
+
+    commands = []
+    cores_used = []
+    returncodes = {}
+    runs = []
+    orig_run = run_all_cities.CityRun.run
+
+    def run(self, pipeline_args):
+        runs.append(self)
+        cores_used.append(sum(
+            x.cores for x in runs if x.end is None))
+        orig_run(self, pipeline_args)
+
+    def popen(args, **kwargs):
+        commands.append(args)
+        return FakeProcess(returncodes.get(args[3], 0), len(commands))
+
+    monkeypatch.setattr(run_all_cities.CityRun, 'run', run)
+    monkeypatch.setattr(run_all_cities.subprocess, 'Popen', popen)
+    monkeypatch.setattr(run_all_cities.time, 'sleep', lambda x: None)
+    return commands, cores_used, returncodes
+
+
+def test_parse_budgets():
+    assert run_all_cities.parse_budgets([], 2, None) == {}
+    assert run_all_cities.parse_budgets(
+        ['boston:4', 'cambridge:2:8', 'dc::3.5', 'la'], 1, 2.0) == {
+            'boston': (4, 2.0),
+            'cambridge': (2, 8.0),
+            'dc': (1, 3.5),
+            'la': (1, 2.0),
+        }
+
+
+def test_run_cities(cities):
+    commands, cores_used, _ = cities
+    runs = [
+        run_all_cities.CityRun('boston', cores=3),
+        run_all_cities.CityRun('cambridge', cores=2),
+        run_all_cities.CityRun('dc', cores=1),
+    ]
+    assert run_all_cities.run_cities(
+        runs, ['--forceupdate'], max_parallel=3, total_cores=4,
+        interval=0) == runs
+
+    # cambridge doesn't fit alongside boston, but dc does
+    assert [x[3] for x in commands] == [
+        os.path.join('config', 'config_boston.yml'),
+        os.path.join('config', 'config_dc.yml'),
+        os.path.join('config', 'config_cambridge.yml'),
+    ]
+    assert cores_used == [3, 4, 2]
+    # Each city's pipeline runs with its own number of workers
+    assert commands[0][4:] == ['--forceupdate', '--workers', '3']
+    assert commands[2][4:] == ['--forceupdate', '--workers', '2']
+    assert [x.status for x in runs] == ['ok', 'ok', 'ok']
+    for run in runs:
+        assert run.wall_time is not None
+        assert run.log.closed
+
+
+def test_run_cities_too_big(cities):
+    commands, cores_used, _ = cities
+    # A city needing more cores than there are is run by itself
+    runs = [
+        run_all_cities.CityRun('boston', cores=8),
+        run_all_cities.CityRun('cambridge', cores=1),
+    ]
+    run_all_cities.run_cities(runs, [], max_parallel=2, total_cores=4,
+                              interval=0)
+    assert cores_used == [8, 1]
+    assert commands[0][4:] == ['--workers', '8']
+
+
+def test_print_summary(capsys):
+    ok = run_all_cities.CityRun('boston')
+    ok.returncode = 0
+    ok.start = 10
+    ok.end = 22.5
+    failed = run_all_cities.CityRun('cambridge')
+    failed.returncode = 2
+    failed.start = 10
+    failed.end = 11
+    not_run = run_all_cities.CityRun('dc')
+
+    run_all_cities.print_summary([ok, failed, not_run])
+    assert capsys.readouterr().out.splitlines() == [
+        "city        wall time  status",
+        "boston          12.5s  ok",
+        "cambridge        1.0s  failed (2)",
+        "dc                  -  not run",
+    ]
+
+
+def test_main(cities, capsys):
+    commands, _, returncodes = cities
+    run_all_cities.main(['--cores', '2', '--budget', 'dc:1'])
+    assert [x[-1] for x in commands] == ['2', '2', '1']
+
+    # A failed city doesn't stop the others, but fails the run
+    returncodes[os.path.join('config', 'config_cambridge.yml')] = 1
+    with pytest.raises(SystemExit) as e:
+        run_all_cities.main(['-j', '3'])
+    assert e.value.code == 1
+    assert len(commands) == 6
+    assert 'failed (1)' in capsys.readouterr().out
+
+
+def test_memory_budget(cities, monkeypatch):
+    commands, _, _ = cities
+    # Each city's processes use 3GB together
+    monkeypatch.setattr(run_all_cities, 'group_memory', lambda pgid: 3.0)
+    killed = []
+    monkeypatch.setattr(run_all_cities.os, 'killpg',
+                        lambda pgid, sig: killed.append(pgid))
+
+    runs = [
+        run_all_cities.CityRun('boston', cores=2, memory=2),
+        run_all_cities.CityRun('cambridge', cores=2, memory=4),
+    ]
+    run_all_cities.run_cities(runs, [], max_parallel=2, total_cores=4,
+                              total_memory=6, interval=0)
+    # Stopped, along with all its workers
+    assert killed == [1]
+    assert [x.status for x in runs] == ['over memory budget', 'ok']
+    assert runs[1].peak_memory == 3.0
+
+
+@pytest.mark.skipif(not os.path.isdir('/proc'), reason="needs /proc")
+def test_group_memory():
+    # A process in its own group, with a child in the group too
+    process = subprocess.Popen(
+        [sys.executable, '-c',
+         'import subprocess, sys, time; ' +
+         'subprocess.Popen([sys.executable, "-c", ' +
+         '"import time; time.sleep(30)"]); time.sleep(30)'],
+        start_new_session=True)
+    try:
+        used = run_all_cities.group_memory(process.pid)
+        assert 0 < used < 1
+    finally:
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+    # No processes are in the group any more, bar ones exiting
+    assert run_all_cities.group_memory(process.pid) < used
@@ -0,0 +1,178 @@
+# Benchmarks how the pipeline scales with the size of a city, by running
+# the data generation and training stages on synthetic cities of
+# increasing size (see synthetic_city.py)
+import argparse
+import importlib
+import json
+import math
+import os
+import shutil
+import tempfile
+from data.stages import run_stage, STAGES
+from .synthetic_city import make_city, grid_shape
+
+# The stages that are benchmarked, in the order they're run.
+# Each is given the synthetic city's data directory and config file
+BENCHMARK_STAGES = [
+    # Snaps waze jams and alerts onto osm_elements.geojson
+    ('add_waze_data', ['-d', '{datadir}']),
+    # create_segments_from_json
+    ('create_segments', ['-d', '{datadir}', '-c', '{config}']),
+    # snap_records and make_crash_rollup
+    ('join_segments_crash', ['-d', '{datadir}', '-c', '{config}']),
+    ('propagate_volume', ['-d', '{datadir}']),
+    ('make_canon_dataset', ['-d', '{datadir}', '-c', '{config}']),
+    ('train_model', ['-d', '{datadir}', '-c', '{config}']),
+]
+
+# A stage whose time grows faster than this power of the city's size
+# between two sizes is flagged
+SCALING_WARNING = 1.5
+
+
+def run_size(datadir, intersections, crashes, stages=None, seed=0):
+    """
+    Generate a synthetic city and time each stage on it
+    Args:
+        datadir - directory to write the synthetic city to
+        intersections - number of intersections
+        crashes - number of crashes
+        stages - names of the stages to run, defaults to all of them
+        seed
+    Returns:
+        list of dicts, one per stage, with the city's size and the
+        stage's wall time, cpu time and peak memory
+    """
+    config_file = make_city(datadir, intersections, crashes, seed=seed)
+    rows, cols = grid_shape(intersections)
+
+    results = []
+    for name, args in BENCHMARK_STAGES:
+        if stages and name not in stages:
+            continue
+        print("Running {} with {} intersections, {} crashes".format(
+            name, rows * cols, crashes))
+        stats = run_stage(name, [
+            x.format(datadir=datadir, config=config_file) for x in args])
+        results.append({
+            'stage': name,
+            'intersections': rows * cols,
+            'crashes': crashes,
+            'wall_time': stats['wall_time'],
+            'cpu_time': stats['cpu_time'],
+            'peak_rss_mb': stats['peak_rss_mb'],
+        })
+    return results
+
+
+def scaling_exponents(results, stat='wall_time'):
+    """
+    For each stage, estimate how its time grows with the number of
+    intersections, as the exponent k in time ~ size^k between each
+    pair of consecutive sizes
+    Args:
+        results - list of dicts returned by run_size
+        stat - which measurement to use
+    Returns:
+        dict of stage name to list of exponents, None where either
+        time is too small to measure
+    """
+    by_stage = {}
+    for result in results:
+        by_stage.setdefault(result['stage'], []).append(result)
+
+    exponents = {}
+    for stage, stage_results in by_stage.items():
+        stage_results = sorted(stage_results, key=lambda x: x['intersections'])
+        exponents[stage] = []
+        for small, large in zip(stage_results, stage_results[1:]):
+            if small[stat] <= 0 or large[stat] <= 0 \
+               or small['intersections'] == large['intersections']:
+                exponents[stage].append(None)
+                continue
+            exponents[stage].append(round(
+                math.log(large[stat] / small[stat])
+                / math.log(large['intersections'] / small['intersections']),
+                2))
+    return exponents
+
+
+def print_results(results):
+    """
+    Print a table of each stage's wall time at each size, and how it scales
+    """
+    sizes = sorted(set(x['intersections'] for x in results))
+    stages = []
+    for result in results:
+        if result['stage'] not in stages:
+            stages.append(result['stage'])
+    times = {(x['stage'], x['intersections']): x['wall_time']
+             for x in results}
+    exponents = scaling_exponents(results)
+
+    width = max(len(x) for x in stages + ['stage'])
+    print("{}  {}  {}".format(
+        'stage'.ljust(width),
+        '  '.join('{:>10}'.format(x) for x in sizes),
+        'scaling'))
+    for stage in stages:
+        warning = any(x and x > SCALING_WARNING for x in exponents[stage])
+        print("{}  {}  {}{}".format(
+            stage.ljust(width),
+            '  '.join('{:>9.2f}s'.format(times[(stage, x)])
+                      if (stage, x) in times else '{:>10}'.format('-')
+                      for x in sizes),
+            ', '.join(str(x) if x is not None else '-'
+                      for x in exponents[stage]),
+            '  (superlinear)' if warning else ''))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--sizes", type=str, default='100,400,1600',
+                        help="Comma-separated numbers of intersections " +
+                        "to benchmark")
+    parser.add_argument("-m", "--crashes_per_intersection", type=float,
+                        default=10,
+                        help="Number of crashes for each intersection")
+    parser.add_argument("-s", "--stages", type=str,
+                        help="Comma-separated stages to run, defaults to " +
+                        ", ".join(x[0] for x in BENCHMARK_STAGES))
+    parser.add_argument("-d", "--datadir", type=str,
+                        help="Directory to write the synthetic cities to; " +
+                        "if not given, a temporary directory is used " +
+                        "and removed afterwards")
+    parser.add_argument("-o", "--outfile", type=str,
+                        help="Write results to this json file")
+    parser.add_argument("--seed", type=int, default=0)
+
+    args = parser.parse_args()
+    stages = args.stages.split(',') if args.stages else None
+
+    # Import everything first, so the first size
+    # isn't charged for loading libraries
+    for name, _ in BENCHMARK_STAGES:
+        importlib.import_module(STAGES[name])
+
+    workdir = args.datadir or tempfile.mkdtemp()
+    results = []
+    try:
+        for size in [int(x) for x in args.sizes.split(',')]:
+            results += run_size(
+                os.path.join(workdir, 'synthetic_{}'.format(size)),
+                size,
+                int(size * args.crashes_per_intersection),
+                stages=stages,
+                seed=args.seed
+            )
+    finally:
+        if not args.datadir:
+            shutil.rmtree(workdir)
+
+    print_results(results)
+    if args.outfile:
+        with open(args.outfile, 'w') as f:
+            json.dump({
+                'results': results,
+                'scaling': scaling_exponents(results),
+            }, f, indent=4)
@@ -0,0 +1,351 @@
+# Generates a synthetic city: a grid road network in the same format as
+# osm_elements.geojson, along with standardized crashes, waze snapshots
+# and volume counts on that network.
+# Used for benchmarking how the pipeline scales with the size of a city
+import argparse
+import datetime
+import json
+import math
+import os
+import random
+import geojson
+import yaml
+
+# Roughly where the grid is placed, and the distance between intersections
+DEFAULT_LATITUDE = 42.3600825
+DEFAULT_LONGITUDE = -71.0588801
+DEFAULT_SPACING = 100
+
+HIGHWAY_TYPES = ['residential', 'tertiary', 'secondary', 'primary']
+
+# Crashes and waze snapshots are spread over this date range
+START_DATE = datetime.datetime(2016, 1, 1)
+DAYS = 730
+
+
+def grid_shape(intersections):
+    """
+    Get the number of rows and columns of a grid with
+    (at least) the given number of intersections
+    """
+    rows = max(int(math.ceil(math.sqrt(intersections))), 2)
+    cols = max(int(math.ceil(intersections / float(rows))), 2)
+    return rows, cols
+
+
+def make_grid(intersections, lat=DEFAULT_LATITUDE, lon=DEFAULT_LONGITUDE,
+              spacing=DEFAULT_SPACING, seed=0):
+    """
+    Make a grid of streets running east-west and avenues running north-south
+    Args:
+        intersections - approximate number of intersections
+        lat, lon - southwest corner of the grid
+        spacing - distance between intersections in meters
+        seed - for the random street properties
+    Returns:
+        ways - list of geojson LineString features, one per block,
+            with the properties osm_create_maps gives ways
+        nodes - list of geojson Point features, one per intersection
+    """
+    rnd = random.Random(seed)
+    rows, cols = grid_shape(intersections)
+    dlat = spacing / 111320.0
+    dlon = spacing / (111320.0 * math.cos(math.radians(lat)))
+
+    def node_id(row, col):
+        return str(1000000 + row * cols + col)
+
+    nodes = []
+    for row in range(rows):
+        for col in range(cols):
+            nodes.append(geojson.Feature(
+                geometry=geojson.Point(
+                    [lon + col * dlon, lat + row * dlat]),
+                properties={
+                    'osmid': node_id(row, col),
+                    'highway': 'traffic_signals'
+                    if rnd.random() < .1 else None,
+                    'dead_end': False,
+                    'streets': '{} Street, {} Avenue'.format(row, col),
+                    'intersection': 1,
+                }
+            ))
+
+    # Each street (row) and avenue (column) gets its own properties
+    streets = [(str(row) + ' Street', rnd.randrange(len(HIGHWAY_TYPES)))
+               for row in range(rows)]
+    avenues = [(str(col) + ' Avenue', rnd.randrange(len(HIGHWAY_TYPES)))
+               for col in range(cols)]
+
+    ways = []
+    blocks = [((row, col), (row, col + 1), streets[row], 2 * row)
+              for row in range(rows) for col in range(cols - 1)]
+    blocks += [((row, col), (row + 1, col), avenues[col], 2 * col + 1)
+               for row in range(rows - 1) for col in range(cols)]
+    for start, end, street, way in blocks:
+        name, hwy_type = street
+        lanes = hwy_type + 1
+        width = lanes * rnd.choice([3, 4])
+        osmid = str(5000000 + way)
+        from_id = node_id(*start)
+        to_id = node_id(*end)
+        ways.append(geojson.Feature(
+            id=str(len(ways)),
+            geometry=geojson.LineString([
+                [lon + start[1] * dlon, lat + start[0] * dlat],
+                [lon + end[1] * dlon, lat + end[0] * dlat],
+            ]),
+            properties={
+                'id': str(len(ways)),
+                'access': None,
+                'bridge': None,
+                'from': from_id,
+                'highway': HIGHWAY_TYPES[hwy_type],
+                'junction': None,
+                'key': '0',
+                'lanes': lanes,
+                'length': str(spacing),
+                'maxspeed': None,
+                'name': name,
+                'oneway': rnd.choice([0, 1]),
+                'osmid': osmid,
+                'ref': None,
+                'to': to_id,
+                'tunnel': None,
+                'width': width,
+                'hwy_type': hwy_type,
+                'cycleway_type': rnd.choice([0, 0, 1]),
+                'osm_speed': rnd.choice([0, 25, 30]),
+                'signal': 0,
+                'width_per_lane': round(width / lanes),
+                'segment_id': '-'.join([osmid, from_id, to_id]),
+            }
+        ))
+    return ways, nodes
+
+
+def random_point(way, rnd, jitter=5):
+    """
+    Pick a point along a way, up to jitter meters off the road
+    Returns:
+        latitude, longitude
+    """
+    (x1, y1), (x2, y2) = way['geometry']['coordinates']
+    t = rnd.random()
+    offset = (rnd.random() * 2 - 1) * jitter / 111320.0
+    return y1 + (y2 - y1) * t + offset, x1 + (x2 - x1) * t + offset
+
+
+def make_crashes(ways, count, seed=0):
+    """
+    Make standardized crashes, scattered along the given ways.
+    Crashes happen on fewer than half of the ways, more often on
+    ways with more lanes, so there's something for the model to learn
+    Returns:
+        list of dicts in the crashes-schema format
+    """
+    rnd = random.Random(seed)
+    weights = [x['properties']['lanes'] ** 2 if rnd.random() < .4 else 0
+               for x in ways]
+    if not any(weights):
+        weights = None
+
+    crashes = []
+    for i, way in enumerate(rnd.choices(ways, weights, k=count)):
+        lat, lon = random_point(way, rnd)
+        date = START_DATE + datetime.timedelta(
+            seconds=rnd.randrange(DAYS * 24 * 3600))
+        crashes.append({
+            'id': i + 1,
+            'dateOccurred': date.strftime('%Y-%m-%dT%H:%M:%S') + '-05:00',
+            'location': {
+                'latitude': round(lat, 6),
+                'longitude': round(lon, 6),
+            },
+        })
+    return crashes
+
+
+def make_waze(ways, snapshots, jams_per_snapshot, seed=0):
+    """
+    Make standardized waze data: each snapshot has a number of jams,
+    each along a single way, and an alert at the start of each jam
+    Returns:
+        list of jams and alerts in the format standardize_waze_data writes
+    """
+    rnd = random.Random(seed)
+    items = []
+    for snapshot in range(1, snapshots + 1):
+        timestamp = (START_DATE + datetime.timedelta(
+            minutes=5 * snapshot)).strftime('%Y-%m-%d %H:%M:%S')
+        for _ in range(jams_per_snapshot):
+            way = rnd.choice(ways)
+            coords = way['geometry']['coordinates']
+            common = {
+                'city': 'Synthetic',
+                'street': way['properties']['name'],
+                'level': rnd.randrange(1, 5),
+                'speed': rnd.randrange(0, 10),
+                'delay': rnd.randrange(-1, 120),
+                'pubTimeStamp': timestamp,
+                'snapshotId': snapshot,
+            }
+            jam = dict(common, eventType='jam', type='NONE', line=[
+                {'x': x, 'y': y} for x, y in coords])
+            alert = dict(common, eventType='alert', type='JAM', location={
+                'latitude': coords[0][1], 'longitude': coords[0][0]})
+            items += [jam, alert]
+    return items
+
+
+def make_volume(ways, count, seed=0):
+    """
+    Make standardized volume counts, each on a different way
+    Returns:
+        list of dicts in the volumes-schema format
+    """
+    rnd = random.Random(seed)
+    volumes = []
+    for way in rnd.sample(ways, min(count, len(ways))):
+        lat, lon = random_point(way, rnd, jitter=0)
+        hourly = [rnd.randrange(0, 60) for _ in range(24)]
+        heavy = rnd.randrange(0, 20)
+        bikes = rnd.randrange(0, 10)
+        volumes.append({
+            'startDateTime': START_DATE.strftime('%Y-%m-%d'),
+            'location': {
+                'latitude': lat,
+                'longitude': lon,
+                'address': way['properties']['name'],
+            },
+            'speed': {'averageSpeed': rnd.randrange(15, 40)},
+            'volume': {
+                'totalVolume': sum(hourly),
+                'totalLightVehicles': max(sum(hourly) - heavy - bikes, 0),
+                'totalHeavyVehicles': heavy,
+                'bikes': bikes,
+                'hourlyVolume': hourly,
+            },
+        })
+    return volumes
+
+
+def make_config(name, lat=DEFAULT_LATITUDE, lon=DEFAULT_LONGITUDE):
+    """
+    Make the config for a synthetic city, using the features
+    that the synthetic data has
+    Returns:
+        dict
+    """
+    return {
+        'city': 'Synthetic City ' + name,
+        'name': name,
+        'city_latitude': lat,
+        'city_longitude': lon,
+        'city_radius': 10,
+        'timezone': 'America/New_York',
+        'startdate': None,
+        'enddate': None,
+        'crashes_files': {
+            'crashes.csv': {
+                'required': {
+                    'id': 'ID',
+                    'latitude': 'Y',
+                    'longitude': 'X',
+                    'date_complete': 'Date',
+                },
+                'optional': {},
+            },
+        },
+        'openstreetmap_features': {
+            'categorical': {
+                'width': 'Width',
+                'cycleway_type': 'Bike lane',
+                'signal': 'Signal',
+                'oneway': 'One Way',
+                'lanes': 'Number of lanes',
+            },
+            'continuous': {
+                'width_per_lane': 'Average width per lane',
+            },
+        },
+        'waze_features': {
+            'categorical': {
+                'jam': 'Existence of a jam',
+            },
+            'continuous': {
+                'jam_percent': 'Percent of time there was a jam',
+                'avg_jam_level': 'Jam level',
+            },
+        },
+    }
+
+
+def make_city(datadir, intersections, crashes, snapshots=10,
+              jams_per_snapshot=None, volume_counts=None, seed=0):
+    """
+    Write a synthetic city's data directory, laid out the way the pipeline
+    expects after data standardization and osm_create_maps:
+        config.yml
+        processed/maps/osm_elements.geojson
+        standardized/crashes.json, waze.json and volume.json
+    Args:
+        datadir - directory to write to
+        intersections - approximate number of intersections
+        crashes - number of crashes
+        snapshots - number of waze snapshots
+        jams_per_snapshot - defaults to one for every 20 blocks
+        volume_counts - defaults to one for every 20 blocks
+        seed
+    Returns:
+        the config file's path
+    """
+    ways, nodes = make_grid(intersections, seed=seed)
+    if jams_per_snapshot is None:
+        jams_per_snapshot = max(len(ways) // 20, 1)
+    if volume_counts is None:
+        volume_counts = max(len(ways) // 20, 3)
+
+    for subdir in [os.path.join('processed', 'maps'), 'standardized']:
+        if not os.path.exists(os.path.join(datadir, subdir)):
+            os.makedirs(os.path.join(datadir, subdir))
+
+    with open(os.path.join(
+            datadir, 'processed', 'maps', 'osm_elements.geojson'), 'w') as f:
+        geojson.dump(geojson.FeatureCollection(ways + nodes), f)
+
+    outputs = [
+        ('crashes.json', make_crashes(ways, crashes, seed=seed)),
+        ('waze.json', make_waze(
+            ways, snapshots, jams_per_snapshot, seed=seed)),
+        ('volume.json', make_volume(ways, volume_counts, seed=seed)),
+    ]
+    for filename, items in outputs:
+        with open(os.path.join(datadir, 'standardized', filename), 'w') as f:
+            json.dump(items, f)
+
+    config_file = os.path.join(datadir, 'config.yml')
+    with open(config_file, 'w') as f:
+        yaml.safe_dump(
+            make_config(os.path.basename(os.path.normpath(datadir))),
+            f, default_flow_style=False)
+    return config_file
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--datadir", type=str, required=True,
+                        help="Directory to write the synthetic city to")
+    parser.add_argument("-n", "--intersections", type=int, default=100,
+                        help="Number of intersections")
+    parser.add_argument("-m", "--crashes", type=int, default=1000,
+                        help="Number of crashes")
+    parser.add_argument("--snapshots", type=int, default=10,
+                        help="Number of waze snapshots")
+    parser.add_argument("--seed", type=int, default=0)
+
+    args = parser.parse_args()
+    config_file = make_city(args.datadir, args.intersections, args.crashes,
+                            snapshots=args.snapshots, seed=args.seed)
+    print("Wrote synthetic city to {}, config file {}".format(
+        args.datadir, config_file))
@@ -0,0 +1,26 @@
+import os
+from .. import benchmark
+
+
+def test_scaling_exponents():
+    results = [
+        {'stage': 'linear', 'intersections': 100, 'wall_time': 1.0},
+        {'stage': 'linear', 'intersections': 400, 'wall_time': 4.0},
+        {'stage': 'quadratic', 'intersections': 100, 'wall_time': 1.0},
+        {'stage': 'quadratic', 'intersections': 400, 'wall_time': 16.0},
+        {'stage': 'quadratic', 'intersections': 800, 'wall_time': 0},
+    ]
+    assert benchmark.scaling_exponents(results) == {
+        'linear': [1.0],
+        'quadratic': [2.0, None],
+    }
+
+
+def test_run_size(tmpdir):
+    results = benchmark.run_size(
+        os.path.join(tmpdir.strpath, 'synthetic'), 9, 20,
+        stages=['create_segments'])
+    assert len(results) == 1
+    assert results[0]['stage'] == 'create_segments'
+    assert results[0]['intersections'] == 9
+    assert results[0]['wall_time'] > 0
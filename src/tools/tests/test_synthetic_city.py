@@ -0,0 +1,43 @@
+import json
+import os
+from .. import synthetic_city
+from data.create_segments import create_segments_from_json
+
+
+def test_make_grid():
+    ways, nodes = synthetic_city.make_grid(12)
+    # 4 x 3 grid: 4 streets of 2 blocks and 3 avenues of 3 blocks
+    assert synthetic_city.grid_shape(12) == (4, 3)
+    assert len(nodes) == 12
+    assert len(ways) == 17
+    assert len(set(x['properties']['segment_id'] for x in ways)) == 17
+
+    node_ids = set(x['properties']['osmid'] for x in nodes)
+    for way in ways:
+        assert way['properties']['from'] in node_ids
+        assert way['properties']['to'] in node_ids
+
+    # Same seed, same city
+    assert synthetic_city.make_grid(12) == (ways, nodes)
+
+
+def test_make_city(tmpdir):
+    datadir = os.path.join(tmpdir.strpath, 'synthetic')
+    config_file = synthetic_city.make_city(datadir, 9, 50, snapshots=3)
+    assert os.path.exists(config_file)
+
+    with open(os.path.join(datadir, 'standardized', 'crashes.json')) as f:
+        crashes = json.load(f)
+    assert len(crashes) == 50
+    assert len(set(x['id'] for x in crashes)) == 50
+
+    with open(os.path.join(datadir, 'standardized', 'waze.json')) as f:
+        waze = json.load(f)
+    assert max(x['snapshotId'] for x in waze) == 3
+
+    non_inters, inters = create_segments_from_json(
+        os.path.join(datadir, 'processed', 'maps', 'osm_elements.geojson'),
+        os.path.join(datadir, 'processed', 'maps'))
+    # A 3 x 3 grid has 9 intersections and 12 blocks between them
+    assert len(inters) == 9
+    assert len(non_inters) == 12